@@ -16,10 +16,25 @@ mkdir build
 echo "${GIT_REPO}_$MAJ_VER.$MIN_VER.$BUILD_NUMBER" > build/build_jenkins.txt
 
 # Capture the version from the library code. It is used by agents to determine if they need to download a new artifact.
-grep davraAgentVersion ./davra_lib.py | cut -f 2 -d '"' > build/build_version.txt
+grep davraAgentVersion ./davra-agent/davra_lib.py | head -1 | cut -f 2 -d '"' > build/build_version.txt
 
 # Assemble the artifact which is the installation bundle tar.gz
 tar --exclude="build" --exclude ".git" --exclude "node_modules" --exclude="build.sh" -zcf build/davra-agent.tar.gz ./davra-agent
 
 # Capture a checksum for those downloading the artifact
 md5sum build/davra-agent.tar.gz > build/build_checksum.txt
+
+# Publish each file of the agent under its sha256, with a manifest of the hash of every file.
+# Agents updating themselves download only the files whose hash has changed
+mkdir build/files
+manifestEntries=""
+for file in $(cd davra-agent && find . -type f ! -name "*.pyc" | sed 's|^\./||' | sort) ; do
+	fileHash=$(sha256sum "davra-agent/${file}" | cut -f 1 -d ' ')
+	fileSize=$(stat -c %s "davra-agent/${file}")
+	fileMode=$(stat -c %a "davra-agent/${file}")
+	cp "davra-agent/${file}" "build/files/${fileHash}"
+	manifestEntries="${manifestEntries}${manifestEntries:+,}
+    \"${file}\": {\"sha256\": \"${fileHash}\", \"size\": ${fileSize}, \"mode\": \"${fileMode}\"}"
+done
+echo "{\"version\": \"$(cat build/build_version.txt)\", \"files\": {${manifestEntries}
+}}" > build/manifest.json
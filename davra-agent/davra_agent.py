@@ -11,8 +11,21 @@ from requests.auth import HTTPBasicAuth
 import json 
 from pprint import pprint
 import datetime
+import threading
+import shutil
+import random
 import paho.mqtt.client as mqtt
 import davra_lib as comDavra
+import davra_uplink
+import davra_spool
+import davra_metrics
+import davra_scheduler
+import davra_jobs
+import davra_workers
+import davra_supervisor
+import davra_artifacts
+import davra_update
+import davra_dispatcher
 # If you add new libraries to the agent, update requirements.txt
 
 
@@ -25,19 +38,9 @@ if('server' not in comDavra.conf or 'UUID' not in comDavra.conf):
 comDavra.logInfo('Starting Davra Device Agent.')
 comDavra.logInfo('Server: ' + comDavra.conf['server'] + ". Device: " + comDavra.conf['UUID'])
 
-# The job details of currently running job for this device.
-# Files are used to track the currently running Job, script and function.
-# Each get a dirctory to themselves and a json for tracking.
-# The directory "currentJob" etc may be removed when job is finished.
-currentJobDir = comDavra.installationDir + '/currentJob'
-currentJobJson = currentJobDir + '/job.json'
-currentFunctionDir = comDavra.installationDir + "/currentFunction"
-currentFunctionJson = currentFunctionDir + "/currentFunction.json"
-# Some flags to cache in RAM whether a function/script/job is running 
-# rather than checking the hard drive continuously
-flagIsFunctionRunning = False
-flagIsScriptRunning = False
-flagIsJobRunning = False
+# The jobs and functions running on this device are tracked in memory by davra_jobs
+# and journalled to disk so they survive a restart of the agent or a reboot.
+davra_jobs.loadJournal()
 
 
 def sendHeartbeatMetricsToServer():
@@ -46,17 +49,11 @@ def sendHeartbeatMetricsToServer():
         "name": "uptime",
         "value": comDavra.getUptimeProcess(),
         "msg_type": "datum"
-    }, { 
-        "UUID": comDavra.conf['UUID'],
-        "name": "cpu",
-        "value": comDavra.getUptime()[1],
-        "msg_type": "datum",
-    }, { 
-        "UUID": comDavra.conf['UUID'],
-        "name": "ram",
-        "value": comDavra.getRam()[1],
-        "msg_type": "datum",
-    }, { 
+    }]
+    dataToSend.extend(getSampledMetricsForHeartbeat())
+    dataToSend.extend(getJobQueueMetricsForHeartbeat())
+    dataToSend.extend(getDispatcherMetricsForHeartbeat())
+    dataToSend.append({ 
         "UUID": comDavra.conf['UUID'],
         "name": "davra.agent.heartbeat",
         "value": {
@@ -64,115 +61,214 @@ def sendHeartbeatMetricsToServer():
             "heartbeatInterval": comDavra.conf['heartbeatInterval']
         },
         "msg_type": "event"
-    }]
+    })
     comDavra.logInfo('Sending heartbeat data to: ' + comDavra.conf['server'] + ": " + comDavra.conf['UUID'])
     #print(json.dumps(dataToSend, indent=4))
-    statusCode = comDavra.sendDataToServer(dataToSend).status_code
-    comDavra.log('Response after sending heartbeat data: ' + str(statusCode))
+    r = davra_uplink.sendIotDataNow(dataToSend)
+    comDavra.log('Response after sending heartbeat data: ' + str(r.status_code))
+    comDavra.log('Http client stats: ' + json.dumps(comDavra.getHttpStats()))
+    comDavra.log('Uplink stats: ' + json.dumps(davra_uplink.getUplinkStats()))
+    comDavra.log('Spool stats: ' + json.dumps(davra_spool.getSpoolStats()))
+    comDavra.log('Log shipping stats: ' + json.dumps(comDavra.getLogShipStats()))
+    comDavra.log('Scheduler stats: ' + json.dumps(davra_scheduler.getSchedulerStats()))
+    comDavra.log('Worker stats: ' + json.dumps(davra_workers.getWorkerStats()))
+    comDavra.log('Supervisor stats: ' + json.dumps(davra_supervisor.getSupervisorStats()))
+    comDavra.log('Dispatcher stats: ' + json.dumps(davra_dispatcher.getDispatcherStats()))
+    comDavra.log('Update stats: ' + json.dumps(davra_update.getUpdateStats()))
+    if(davra_metrics.isSamplerRunning()):
+        comDavra.log('Metric sampler stats: ' + json.dumps(davra_metrics.getSamplerStats()))
+    return r
+
+
+# Metrics sampled between heartbeats are summarised as min/max/mean/p95 datums, eg. "cpu.max",
+# with the latest sample as the plain metric name ("cpu"). 
+# Without the sampler, a single reading is taken now
+def getSampledMetricsForHeartbeat():
+    summaries = davra_metrics.takeSamplerWindow() if davra_metrics.isSamplerRunning() else {}
+    if("cpu" not in summaries):
+        summaries["cpu"] = {"last": comDavra.getCpuPercent()}
+    if("ram" not in summaries):
+        summaries["ram"] = {"last": comDavra.getRam()[1]}
+    metrics = []
+    for metricName, summary in summaries.items():
+        metrics.append({"UUID": comDavra.conf['UUID'], "name": metricName, "value": summary["last"], "msg_type": "datum"})
+        for aggregate in ["min", "max", "mean", "p95"]:
+            if(aggregate in summary):
+                metrics.append({"UUID": comDavra.conf['UUID'], "name": metricName + "." + aggregate, \
+                    "value": summary[aggregate], "msg_type": "datum"})
+    return metrics
+
+
+# How many jobs are queued, and the longest any job waited in the queue since the last heartbeat
+def getJobQueueMetricsForHeartbeat():
+    stats = davra_jobs.takeJobQueueStats()
+    return [
+        {"UUID": comDavra.conf['UUID'], "name": "jobs.queued", "value": stats["queued"], "msg_type": "datum"},
+        {"UUID": comDavra.conf['UUID'], "name": "jobs.wait.max", "value": stats["maxWaitSeconds"], "msg_type": "datum"}
+    ]
+
+
+# How deep the queue of mqtt messages got, and the longest a message took to be handled, since the last heartbeat
+def getDispatcherMetricsForHeartbeat():
+    window = davra_dispatcher.takeDispatcherWindow()
+    return [
+        {"UUID": comDavra.conf['UUID'], "name": "mqtt.queue.max", "value": window["maxQueued"], "msg_type": "datum"},
+        {"UUID": comDavra.conf['UUID'], "name": "mqtt.latency.max", "value": window["maxLatencyMs"], "msg_type": "datum"}
+    ]
+
+
+# Sample system metrics every metricsSampleInterval seconds (0 to disable) for the heartbeat summaries.
+# metricsSamplerMaxCostPercent caps how much cpu the sampling itself may use
+def startMetricsSampler():
+    sampleInterval = float(comDavra.conf.get('metricsSampleInterval', 1))
+    if(sampleInterval > 0):
+        windowSize = min(3600, int(int(comDavra.conf['heartbeatInterval']) / sampleInterval) + 1)
+        davra_metrics.startSampler(sampleInterval, windowSize, comDavra.conf.get('metricsSamplerMaxCostPercent', 1))
     return
 
 
 
 ###########################   JOBS
 
+# Pending jobs are fetched from the server a page at a time into the local queue in davra_jobs.
+# The next queued job starts as soon as a running job finishes, rather than waiting for the 
+# next check. Up to jobConcurrency jobs (default 2) run at once. 
+# A queued job is only started if the queue was confirmed with the server within 
+# jobRevalidateAge seconds (default 300), otherwise the queue is fetched again first, 
+# which drops any job cancelled on the server meanwhile.
+# jobFetchPageSize (default 10) is how many pending jobs to fetch at a time.
+jobQueueLock = threading.RLock()
+lastJobFetchTime = 0
+
+
 def checkForPendingJob():
-    headers = comDavra.getHeadersForRequests()
+    global lastJobFetchTime
+    pageSize = int(comDavra.conf.get('jobFetchPageSize', 10))
     dataToSend = { 
         "deviceUUID": comDavra.conf['UUID'], 
         "deviceStatus": "pending",
         "jobStatus": "active",
-        "oldest": True
+        "limit": pageSize
     }
     r = comDavra.httpPut(comDavra.conf['server'] + '/api/v1/jobs', dataToSend)
     if (r.status_code == 200):
         pendingJobs = json.loads(r.content) if comDavra.isJson(r.content) else []
-        if(pendingJobs != [] and len(pendingJobs) > 0):
-            comDavra.log('Pending job to run: ' + str(pendingJobs[0]))  
-            runDavraJob(pendingJobs[0])
-        else:
-            comDavra.log('No pending job to run.') 
+        with jobQueueLock:
+            pendingJobUuids = [job["UUID"] for job in pendingJobs]
+            # Forget queued jobs which are no longer pending on the server, eg. cancelled.
+            # Only possible to tell when the whole list fitted in one page
+            if(len(pendingJobs) < pageSize):
+                for jobObject in davra_jobs.getQueuedJobs():
+                    if(jobObject["UUID"] not in pendingJobUuids):
+                        comDavra.log('Queued job no longer pending on server: ' + jobObject["UUID"])
+                        davra_jobs.removeJob(jobObject["UUID"])
+            for jobObject in pendingJobs[:pageSize]:
+                if(davra_jobs.queueJob(jobObject)):
+                    comDavra.log('Pending job queued: ' + jobObject["UUID"])
+            lastJobFetchTime = time.time()
+            if(len(pendingJobs) == 0):
+                comDavra.log('No pending job to run.') 
+            startQueuedJobs()
         return
     else:
         comDavra.logError("Issue while checking for pending job. " + str(r.status_code))
         comDavra.logError(r.content)
         return(r.status_code)
-    
+
+
+# Start queued jobs while there is room
+def startQueuedJobs():
+    with jobQueueLock:
+        queuedJobs = davra_jobs.getQueuedJobs()
+        freeSlots = int(comDavra.conf.get('jobConcurrency', 2)) - davra_jobs.getRunningJobCount()
+        if(len(queuedJobs) == 0 or freeSlots <= 0):
+            return
+        if(time.time() - lastJobFetchTime > float(comDavra.conf.get('jobRevalidateAge', 300))):
+            # The queue may be stale. Fetching it again starts the jobs which are still pending
+            checkForPendingJob()
+            return
+        for jobObject in queuedJobs[:freeSlots]:
+            comDavra.log('Pending job to run: ' + str(jobObject))  
+            davra_jobs.recordJobStarted(jobObject)
+            runDavraJob(jobObject)
+    return
+
 
 # For any type of job, determine which type (eg script) and run it
+# Several jobs may run at once, each tracked separately in davra_jobs
 def runDavraJob(jobObject):
-    # Catch situation where a job is already running
-    if(os.path.isfile(currentJobJson) == True):
-        comDavra.logWarning('A job is already running. Will not start another job. ' + jobObject["UUID"])
+    # Catch situation where this job is already running
+    knownJob = davra_jobs.getJob(jobObject["UUID"])
+    if(knownJob is not None and davra_jobs.getJobStatus(knownJob) != 'pending'):
+        comDavra.logWarning('Job is already running. Will not start it again. ' + jobObject["UUID"])
         return
     comDavra.log('Start Run of job ' + jobObject["UUID"])
     try:
-        flagIsJobRunning = True
-        # Write this job to disk as the current job
+        # Record this job as running
         jobObject['devices'][0]['startTime'] = comDavra.getMilliSecondsSinceEpoch()
         jobObject['devices'][0]['status'] = 'running'
-        comDavra.provideFreshDirectory(currentJobDir)
-        with open(currentJobJson, 'w') as outfile:
-            json.dump(jobObject, outfile, indent=4)
+        davra_jobs.putJob(jobObject)
         if (jobObject.has_key('jobConfig') and jobObject['jobConfig']['type'].lower() == 'runfunction'):
             comDavra.logInfo('Job Run: type is runFunction. ' + jobObject['jobConfig']['functionName'])
-            runFunction(jobObject['jobConfig']['functionName'], jobObject['jobConfig']['functionParameterValues'])
+            runFunction(jobObject['jobConfig']['functionName'], jobObject['jobConfig']['functionParameterValues'], \
+                jobObject['UUID'])
             return
         # Reaching here means the job type was not recognised so that is a failed situation
-        updateJobWithResult('failed', 'Unknown job type')
-        checkCurrentJob()
+        finishJob(jobObject['UUID'], 'failed', 'Unknown job type')
         return
     except Exception as e:
         # Reaching here means the job type was not recognised so that is a failed situation
         comDavra.logError('Job Error ' + str(e))
-        updateJobWithResult('failed', 'Unknown job type')
-        checkCurrentJob()
+        finishJob(jobObject['UUID'], 'failed', 'Unknown job type')
         return
 
-        
 
-# Check if the current job is finished
+
+# Report any finished job which has not yet reached the server, eg. because the server 
+# was unreachable when the job finished
 def checkCurrentJob():        
-    if(os.path.isfile(currentJobJson) == True):
-        with open(currentJobJson) as data_file:
-            jobObject = json.load(data_file)    
-        if(jobObject['devices'][0]['status'] == 'completed' or jobObject['devices'][0]['status'] == 'failed'):
-            reportJobStatus()
+    for jobObject in davra_jobs.getJobs():
+        if(davra_jobs.isFinishedStatus(davra_jobs.getJobStatus(jobObject))):
+            reportJobStatus(jobObject['UUID'])
     return
 
 
-def updateJobWithResult(status, responseText):
-    # Update the currentJob file on disk with the result. That will be noticed upon next "checkCurrentJob".
-    jobObject = None
-    if(os.path.isfile(currentJobJson) == True):
-        with open(currentJobJson) as data_file:
-            jobObject = json.load(data_file)
-        jobObject['devices'][0]['endTime'] = comDavra.getMilliSecondsSinceEpoch()
-        jobObject['devices'][0]['status'] = status
-        jobObject['devices'][0]['response'] = responseText
-        with open(currentJobJson, 'w') as outfile:
-            json.dump(jobObject, outfile, indent=4)
-    # Finished writing the file to disk indicating job progress/completion
+# Record the result of a job then report it to the server straight away
+# resourceUsage is what the commands of the job cost the device (cpu seconds, peak memory)
+def finishJob(jobUuid, status, responseText, resourceUsage = None):
+    jobObject = davra_jobs.getJob(jobUuid)
+    if(jobObject is None):
+        comDavra.logWarning('Cannot finish job which is not running: ' + str(jobUuid))
+        return
+    jobObject['devices'][0]['endTime'] = comDavra.getMilliSecondsSinceEpoch()
+    jobObject['devices'][0]['status'] = status
+    jobObject['devices'][0]['response'] = responseText
+    if(resourceUsage is not None):
+        jobObject['devices'][0]['resourceUsage'] = resourceUsage
+    if(davra_jobs.putJob(jobObject)):
+        reportJobStatus(jobUuid)
+    # Room for the next queued job
+    startQueuedJobs()
     return
 
 
 # When a job has finished, send the result to the Davra server        
-def reportJobStatus():            
-    comDavra.log('Current job is finished so reporting it to server now')
-    jobObject = None
-    with open(currentJobJson) as data_file:
-        jobObject = json.load(data_file) 
+def reportJobStatus(jobUuid):            
+    comDavra.log('Job is finished so reporting it to server now ' + jobUuid)
+    jobObject = davra_jobs.getJob(jobUuid)
     deviceJobObject = jobObject['devices'][0]
-    headers = comDavra.getHeadersForRequests()
     apiEndPoint = comDavra.conf['server'] + '/api/v1/jobs/' + jobObject['UUID'] + '/' + deviceJobObject['UUID']
     comDavra.logInfo('Reporting job update to server: ' + apiEndPoint + ' : ' + json.dumps(deviceJobObject))
     r = comDavra.httpPut(apiEndPoint, deviceJobObject)
     if (r.status_code == 200):
         comDavra.log("Updated server after running job.")
-        # The job has completed and been reflected at the server so delete the currentJobJson file
-        os.remove(currentJobJson)
+        # The job has completed and been reflected at the server so it is no longer tracked
+        davra_jobs.removeJob(jobUuid)
     else:
         comDavra.log("Issue while updating server after running job. " + str(r.status_code))
         comDavra.log(r.content)
+        # Kept, so checkCurrentJob will try again later
+        return
     # Report job event to server as an iotdata event
     eventToSend = {
         "UUID": deviceJobObject['UUID'],
@@ -183,30 +279,33 @@ def reportJobStatus():
             "status": deviceJobObject["status"]
         }
     }
-    apiEndPoint = comDavra.conf['server'] + '/api/v1/iotdata'
-    r = comDavra.httpPut(apiEndPoint, eventToSend)
+    r = davra_uplink.sendIotDataNow(eventToSend)
     if (r.status_code == 200):
         comDavra.log("Sent event to server after running job.")
     else:
         comDavra.logError("Issue while sending event to server after running job. " + str(r.status_code))
         comDavra.logError(r.content)
-    comDavra.provideFreshDirectory(currentJobDir) # Remove the file and dir on disk 
-    flagIsJobRunning = False
     return
 
 
 
 # Report an event to the Davra server indicating the agent started
+# The event carries only the configuration items which changed since last reported, 
+# along with a hash of the whole configuration
 def reportAgentStarted():            
+    (changedItems, removedKeys, itemHashes) = comDavra.getConfigurationChanges(comDavra.conf)
+    eventValue = dict(changedItems)
+    eventValue["configHash"] = comDavra.hashContent(comDavra.conf)
     eventToSend = {
         "UUID": comDavra.conf['UUID'],
         "name": "davra.agent.started",
         "msg_type": "event",
-        "value": comDavra.conf
+        "value": eventValue
     }
     r = comDavra.sendDataToServer(eventToSend)
     if (r.status_code == 200):
         comDavra.logInfo("Sent event to server to indicate agent started")
+        comDavra.setConfigurationReported(itemHashes)
     # Update the device labels to reflect this agent version
     comDavra.logInfo("Running davraAgentVersion:" + comDavra.davraAgentVersion)
     comDavra.updateDeviceLabelOnServer("davraAgentVersion", comDavra.davraAgentVersion)
@@ -218,73 +317,94 @@ def reportAgentStarted():
 ###########################   RUN FUNCTIONS
 
 # Run a function which the agent knows what to do, or get the appropriate app to run it
-# This function just kicks it off. Another function will check in later to see if it is finished
-def runFunction(functionName, functionParameterValues):
+# This function just kicks it off. The function reports when it is finished through finishFunction.
+# Functions the agent enacts itself are run by the davra_workers pool, so several can run at once.
+# They are 'pending' until a worker starts them, then 'running'.
+# jobUuid is given when the function is run as part of a job
+def runFunction(functionName, functionParameterValues, jobUuid = None):
     # Always assign a uuid to a function if not already
     if(functionParameterValues.has_key("functionUuid") == False):
         functionParameterValues["functionUuid"] = comDavra.generateUuid()
-    # Put a file to indicate what is happening and start the function
-    comDavra.provideFreshDirectory(currentFunctionDir)
+    functionUuid = functionParameterValues["functionUuid"]
+    # Record what is happening and start the function
     functionInfo = { 'functionName': functionName, \
         'functionParameterValues': functionParameterValues, \
-        'status': 'running', \
-        'startTime': comDavra.getMilliSecondsSinceEpoch() }
-    with open(currentFunctionDir + '/currentFunction.json', 'w') as outfile:
-        json.dump(functionInfo, outfile, indent=4)
+        'status': 'pending' }
+    if(jobUuid is not None):
+        functionInfo['jobUuid'] = jobUuid
+    if(davra_jobs.putFunction(functionInfo) is False):
+        return
     # Only run functions which are within capabilities
     if(comDavra.conf["capabilities"].has_key(functionName) is False):
         comDavra.logError('Error: Attemping to to run a function which is not in capabilities: ' + functionName)
         comDavra.logError('Error: Capabilities: ' + str(comDavra.conf["capabilities"]))
-        comDavra.upsertJsonEntry(currentFunctionJson, 'status', 'failed')
+        finishFunction(functionUuid, 'failed', '')
         return
     #
     comDavra.log('Running a function:' + json.dumps(functionInfo))
-    flagIsFunctionRunning = True
     #
     # Is this capability something the agent knows how to do
     if(functionName in agentCapabilityFunctions):
         comDavra.log('Will run this function within the agent')
-        agentCapabilityFunctions[functionName](functionParameterValues)
+        davra_workers.submitWork(functionName, functionUuid, \
+            lambda: agentCapabilityFunctions[functionName](functionParameterValues), \
+            lambda: markFunctionRunning(functionUuid), \
+            lambda e: finishFunction(functionUuid, 'failed', str(e)))
     else:
-        # Send it onwards to the apps who may be able to do it
+        # Send it onwards to the apps who may be able to do it. They run alongside everything else
         comDavra.log('Will run this function within an app rather than the agent')
-        sendMessageFromAgentToApps(functionInfo)
+        markFunctionRunning(functionUuid)
+        sendMessageFromAgentToApps(davra_jobs.getFunction(functionUuid))
+    return
+
+
+# Record that a function has started. Its time allowed (scriptMaxTime) counts from now
+def markFunctionRunning(functionUuid):
+    functionInfo = davra_jobs.getFunction(functionUuid)
+    if(functionInfo is None):
+        return
+    functionInfo['status'] = 'running'
+    functionInfo['startTime'] = comDavra.getMilliSecondsSinceEpoch()
+    davra_jobs.putFunction(functionInfo)
+
+
+# Record that a function has finished, report it to the server and, 
+# if it was part of a job, finish the job too
+def finishFunction(functionUuid, status, response, resourceUsage = None):
+    functionInfo = davra_jobs.getFunction(functionUuid)
+    if(functionInfo is None):
+        comDavra.logWarning('Cannot finish function which is not running: ' + str(functionUuid))
+        return
+    functionInfo['status'] = status
+    functionInfo['response'] = response
+    if(resourceUsage is not None):
+        functionInfo['resourceUsage'] = resourceUsage
+    functionInfo['endTime'] = comDavra.getMilliSecondsSinceEpoch()
+    if(davra_jobs.putFunction(functionInfo) is False):
+        return
+    reportFunctionFinishedAsEventToServer(functionInfo)
+    if(functionInfo.has_key('jobUuid')):
+        finishJob(functionInfo['jobUuid'], status, response, resourceUsage)
+    davra_jobs.removeFunction(functionUuid)
+    comDavra.log('Function finished ' + json.dumps(functionInfo))
     return
 
 
-# Check if a function is finished running and if it was part of a job
+# Catch functions which have been running for too long and declare them failed.
+# Also finishes any function whose completion was recorded but not reported, eg. before a restart
 def checkFunctionFinished():
-    currentFunctionInfo = None
-    if(os.path.isfile(currentFunctionJson) == True):
-        with open(currentFunctionJson) as data_file:
-            currentFunctionInfo = json.load(data_file)
-        if(currentFunctionInfo.has_key("status")):
-            if(currentFunctionInfo["status"] == 'completed' or currentFunctionInfo["status"] == 'failed'):
-                # Function has finished, report back if part of a currently running job
-                functionResponse = currentFunctionInfo["response"] if currentFunctionInfo.has_key("response") else ""
-                reportFunctionFinishedAsEventToServer(currentFunctionInfo)
-                updateJobWithResult(currentFunctionInfo["status"], functionResponse)
-                comDavra.provideFreshDirectory(currentFunctionDir) # Wipe the currently running function files
-                flagIsFunctionRunning = False
-                comDavra.log('Function finished ' + json.dumps(currentFunctionInfo))
-            else:
-                # Has the function been running for too long. If so, declare it as failed
-                if(currentFunctionInfo.has_key("startTime") is True):
-                    if(comDavra.getMilliSecondsSinceEpoch() - int(currentFunctionInfo["startTime"]) \
-                    > int(comDavra.conf["scriptMaxTime"]) * 1000):
-                        comDavra.logWarning('Function has been running for too long - declare it failed')
-                        currentFunctionInfo["status"] = "failed"
-                        currentFunctionInfo["endTime"] = comDavra.getMilliSecondsSinceEpoch()
-                        with open(currentFunctionDir + '/currentFunction.json', 'w') as outfile:
-                            json.dump(currentFunctionInfo, outfile, indent=4)
-                        reportFunctionFinishedAsEventToServer(currentFunctionInfo)
-                        flagIsFunctionRunning = False
-                        comDavra.logWarning('Function finished due to timeout ' + json.dumps(currentFunctionInfo))
-            # If a function has finished, it may have been part of a job. Check if that is finished
-            checkCurrentJob()
-            return
-        else:
-            comDavra.logError('Error situation. Function has no status. Should not occur.');
+    for functionInfo in davra_jobs.getFunctions():
+        functionUuid = functionInfo["functionParameterValues"]["functionUuid"]
+        if(davra_jobs.isFinishedStatus(functionInfo["status"])):
+            reportFunctionFinishedAsEventToServer(functionInfo)
+            davra_jobs.removeFunction(functionUuid)
+            if(functionInfo.has_key('jobUuid')):
+                finishJob(functionInfo['jobUuid'], functionInfo["status"], functionInfo.get("response", ""))
+        elif(functionInfo["status"] == 'running' and functionInfo.has_key("startTime") is True):
+            if(comDavra.getMilliSecondsSinceEpoch() - int(functionInfo["startTime"]) \
+            > int(comDavra.conf["scriptMaxTime"]) * 1000):
+                comDavra.logWarning('Function has been running for too long - declare it failed')
+                finishFunction(functionUuid, 'failed', 'Function timed out')
     return
 
 
@@ -303,72 +423,100 @@ def reportFunctionFinishedAsEventToServer(currentFunctionInfo):
         }
     }
     #comDavra.log("Sending event to server to indicate function finished: " + str(eventToSend))
-    r = comDavra.sendDataToServer(eventToSend)
+    # Sent via the uplink so the event is spooled if the server cannot be reached
+    r = davra_uplink.sendIotDataNow(eventToSend)
     comDavra.log("Sent event to server to indicate function finished. Response " + str(r.status_code))
     
 
+# Returns a function which sends the output of a running function to the server as a
+# davra.function.progress event. Called every functionProgressInterval seconds (default 10)
+# with the output produced since the previous call. Events go via the uplink batch.
+def getFunctionProgressReporter(functionUuid):
+    def reportFunctionProgress(newOutput):
+        functionInfo = davra_jobs.getFunction(functionUuid) or {}
+        davra_uplink.queueIotData({
+            "UUID": comDavra.conf['UUID'],
+            "name": "davra.function.progress",
+            "msg_type": "event",
+            "value": {
+                "functionUuid": functionUuid,
+                "functionName": functionInfo.get("functionName"),
+                "jobUuid": functionInfo.get("jobUuid"),
+                "output": newOutput
+            },
+            "tags": {
+                "functionUuid": functionUuid
+            }
+        })
+    return reportFunctionProgress
+
+
 # When a function was enacted by a device app rather than the agent, it reports back the
 # finished function information via mqtt. This receives that message and updates the
 # agent's understanding of the function's progress
 def updateFunctionStatusAsReportedByDeviceApp(functionInfo):
     comDavra.log('App reported it finished a function ' + str(functionInfo))
-    comDavra.upsertJsonEntry(currentFunctionJson, 'response', functionInfo["response"])
-    comDavra.upsertJsonEntry(currentFunctionJson, 'status', functionInfo["status"])
-    checkFunctionFinished()
+    functionUuid = functionInfo.get("functionParameterValues", {}).get("functionUuid", functionInfo.get("functionUuid"))
+    if(functionUuid is None):
+        # Apps which do not echo the function uuid back are matched on the function name
+        runningFunction = davra_jobs.findRunningFunctionByName(functionInfo["finishedFunctionOnApp"])
+        functionUuid = runningFunction["functionParameterValues"]["functionUuid"] if runningFunction else None
+    finishFunction(functionUuid, functionInfo["status"], functionInfo.get("response", ""))
     return
 
-# Function: Reboot this device        
+# Function: Reboot this device. 
+# The function stays recorded as running until the agent starts again after the reboot
 def agentFunctionReboot(functionParameterValues):
-    # Put a file to indicate what is happening and start the reboot process
-    with open(currentFunctionDir + '/doingReboot.json', 'w') as outfile:
-        json.dump({ 'doingRebootAsPartOfFunction': True }, outfile, indent=4)
     comDavra.logInfo('Function: Reboot Device, starting')
     comDavra.runCommandWithTimeout('sudo reboot -h now', comDavra.conf["scriptMaxTime"])
 
 
 # Check if we are just back after a purposeful reboot as part of a job or function
+# Functions which were still waiting for a worker when the agent stopped never ran, so they failed
 def checkIfJustBackAfterRebootTask():
-    currentFunctionInfo = None
-    if(os.path.isfile(currentFunctionJson) == True):
-        with open(currentFunctionJson) as data_file:
-            currentFunctionInfo = json.load(data_file)
-        if(currentFunctionInfo["functionName"] == 'agent-action-rebootDevice'):
+    for functionInfo in davra_jobs.getFunctions():
+        if(functionInfo["status"] == 'pending'):
+            finishFunction(functionInfo["functionParameterValues"]["functionUuid"], 'failed', \
+                'Agent restarted before the function started')
+        if(functionInfo["functionName"] == 'agent-action-rebootDevice' and functionInfo["status"] == 'running'):
             comDavra.log('checkIfJustBackAfterRebootTask: True. Function completed')
-            comDavra.upsertJsonEntry(currentFunctionJson, 'response', str(comDavra.getUptime()))
-            comDavra.upsertJsonEntry(currentFunctionJson, 'status', 'completed')
-            checkFunctionFinished()             
+            finishFunction(functionInfo["functionParameterValues"]["functionUuid"], 'completed', str(comDavra.getUptime()))
 
 
 # Function: Push an Application which has an install.sh onto this device to run as a service
 # functionParameterValues should have "Installation File" which should be a tar.gz containing the service file,
-# an install.sh 
+# an install.sh. "Installation File SHA256" is optional. If given the archive is checked against it
+# and a copy already in the artifact cache is installed without downloading it again
 def agentFunctionPushAppWithInstaller(functionParameterValues):
     comDavra.logInfo('Function: Pushing Application onto device to run as a service ' + str(functionParameterValues))
     if(functionParameterValues["Installation File"]):
         installationFile = functionParameterValues["Installation File"]
-        # Download the app tarball
+        executionProfile = comDavra.getExecutionProfile('agent-action-pushAppWithInstaller')
         try:
-            tmpPath = '/tmp/' + str(comDavra.getMilliSecondsSinceEpoch())
-            comDavra.ensureDirectoryExists(tmpPath)
-            comDavra.runCommandWithTimeout('cd ' + tmpPath + ' && /usr/bin/curl -LO ' + installationFile, 300)
-            comDavra.runCommandWithTimeout('cd ' + tmpPath + ' && /bin/tar -xvf ./* ', 300)
-            comDavra.runCommandWithTimeout('cd ' + tmpPath + ' && chmod 777 ./* ', 300)
-            # Ensure the install.sh is unix format
-            comDavra.runCommandWithTimeout("cd " + tmpPath + " &&  sed -i $'s/\r$//' install.sh ", 30)
+            # Download and extract the app tarball, unless it is already cached
+            artifactPath = davra_artifacts.provideArtifact(installationFile, \
+                functionParameterValues.get("Installation File SHA256"))
+            # The app gets its own copy as install.sh may change the files alongside it
             installedAppPath = comDavra.installationDir + '/apps/' + str(comDavra.getMilliSecondsSinceEpoch())
-            comDavra.ensureDirectoryExists(installedAppPath)
-            comDavra.runCommandWithTimeout('cd ' + tmpPath + ' && cp -r * ' + installedAppPath, 300)
-            installResponse = comDavra.runCommandWithTimeout('cd ' + installedAppPath + ' && bash ./install.sh ', comDavra.conf["scriptMaxTime"])
+            comDavra.ensureDirectoryExists(os.path.dirname(installedAppPath))
+            shutil.copytree(artifactPath, installedAppPath, symlinks = True)
+            for fileName in os.listdir(installedAppPath):
+                os.chmod(os.path.join(installedAppPath, fileName), 0777)
+            # Ensure the install.sh is unix format
+            with open(installedAppPath + '/install.sh', 'rb') as installScript:
+                installScriptContent = installScript.read()
+            with open(installedAppPath + '/install.sh', 'wb') as installScript:
+                installScript.write(installScriptContent.replace('\r\n', '\n'))
+            installResponse = comDavra.runCommandStreaming('cd ' + installedAppPath + ' && bash ./install.sh ', \
+                comDavra.conf["scriptMaxTime"], getFunctionProgressReporter(functionParameterValues["functionUuid"]), \
+                comDavra.conf.get('functionProgressInterval', 10), executionProfile)
             comDavra.log('Installation response: ' + str(installResponse[1]))
             scriptStatus = 'completed'  if (installResponse[0] == 0) else 'failed'
-            comDavra.upsertJsonEntry(currentFunctionJson, 'response', str(installResponse[1]))
-            comDavra.upsertJsonEntry(currentFunctionJson, 'status', scriptStatus)
+            comDavra.log('Finished agentFunctionPushAppWithInstaller')
+            finishFunction(functionParameterValues["functionUuid"], scriptStatus, str(installResponse[1]), installResponse[2])
         except Exception as e:
             comDavra.logError('Failed to download application:' + installationFile + " : Error: " + str(e))
-            comDavra.upsertJsonEntry(currentFunctionJson, 'status', 'failed')
-            checkFunctionFinished() 
-        comDavra.log('Finished agentFunctionPushAppWithInstaller')
-        checkFunctionFinished()
+            finishFunction(functionParameterValues["functionUuid"], 'failed', str(e))
     else:
         comDavra.logWarning('Action parameters missing, nothing to do')
     # TODO
@@ -387,50 +535,45 @@ def agentFunctionPushAppSnap(functionParameterValues):
 # Function: Report the device configuration to the server
 def agentFunctionReportAgentConfig(functionParameterValues):
     comDavra.logInfo('Function: Reporting the agent config to server')
-    comDavra.reportDeviceConfigurationToServer()
-    comDavra.upsertJsonEntry(currentFunctionJson, 'response', comDavra.conf)
-    comDavra.upsertJsonEntry(currentFunctionJson, 'status', 'completed')
-    checkFunctionFinished()
+    comDavra.reportDeviceConfigurationToServer(fullReport = True)
+    finishFunction(functionParameterValues["functionUuid"], 'completed', comDavra.conf)
     return
 
 
 # Function: Report the device configuration to the server
 def agentFunctionUpdateAgentConfig(functionParameterValues):
     comDavra.logInfo('Function: Updating the agent config to server ' + str(functionParameterValues))
+    # The change is reported to the server by the configuration store
     comDavra.upsertConfigurationItem(functionParameterValues["key"], functionParameterValues["value"])
-    comDavra.reportDeviceConfigurationToServer()
-    comDavra.upsertJsonEntry(currentFunctionJson, 'response', comDavra.conf)
-    comDavra.upsertJsonEntry(currentFunctionJson, 'status', 'completed')
-    checkFunctionFinished()
+    finishFunction(functionParameterValues["functionUuid"], 'completed', comDavra.conf)
     return
 
 
 # Function: Run a bash script
 # Take a set of lines and write them to a shell script then execute that script
 def agentFunctionRunScriptBash(functionParameterValues):
+    functionUuid = functionParameterValues["functionUuid"]
     if "script" not in functionParameterValues:
-        comDavra.upsertJsonEntry(currentFunctionJson, 'response', 'script missing')
-        comDavra.upsertJsonEntry(currentFunctionJson, 'status', 'failed')
         comDavra.logError('Could not run script as function because no script to run')
-        checkFunctionFinished()
+        finishFunction(functionUuid, 'failed', 'script missing')
         return
     # Put the script into the function dir 
-    scriptFile = open(currentFunctionDir + "/script.sh", "a")
-    scriptFile.write(str(functionParameterValues["script"]))
-    scriptFile.close()
+    functionDir = davra_jobs.provideFunctionDir(functionUuid)
+    with open(functionDir + "/script.sh", "w") as scriptFile:
+        scriptFile.write(str(functionParameterValues["script"]))
     comDavra.logInfo('Running script ' + str(functionParameterValues["script"]))
-    os.system("chmod 777 " + currentFunctionDir + "/script.sh")
-    time.sleep(0.5) # Time for file flush to disk
+    os.chmod(functionDir + "/script.sh", 0777)
     # Run the script with -x flag so it prints each command before ruuning it. 
     # This allows the UI to show it formatted better for user on jobs page
-    scriptResponse = comDavra.runCommandWithTimeout('cd ' + currentFunctionDir + \
-    ' && sudo bash -x ' + currentFunctionDir + "/script.sh", comDavra.conf["scriptMaxTime"])
-    # scriptResponse is a tuple of (exitStatusCode, stdout) . For exitStatusCode: 0 = success, 1 = failed )
+    # Output is sent as progress events while the script runs
+    scriptResponse = comDavra.runCommandStreaming('cd ' + functionDir + \
+    ' && sudo bash -x ' + functionDir + "/script.sh", comDavra.conf["scriptMaxTime"], \
+    getFunctionProgressReporter(functionUuid), comDavra.conf.get('functionProgressInterval', 10), \
+    comDavra.getExecutionProfile('agent-action-runScriptBash'))
+    # scriptResponse is a tuple of (exitStatusCode, stdout, resourceUsage) . For exitStatusCode: 0 = success, 1 = failed )
     comDavra.log("Script response: " + str(scriptResponse[1]))
     scriptStatus = 'completed'  if (scriptResponse[0] == 0) else 'failed'
-    comDavra.upsertJsonEntry(currentFunctionJson, 'response', str(scriptResponse[1]))
-    comDavra.upsertJsonEntry(currentFunctionJson, 'status', scriptStatus)
-    checkFunctionFinished()
+    finishFunction(functionUuid, scriptStatus, str(scriptResponse[1]), scriptResponse[2])
 
 
 
@@ -439,11 +582,11 @@ def agentFunctionRunScriptBash(functionParameterValues):
 
 # Set which actions this agent can do and inform the server of these capabilities
 agentCapabilityFunctions = {} # Keep a pointer to the functions which enact each of capabilities
+agentCapabilityDetails = {} # The details of each capability, as reported to the server
 def registerAgentCapabilities(functionName, functionDetails, functionToCallToEnactCapability):
     global agentCapabilityFunctions
     agentCapabilityFunctions[functionName] = functionToCallToEnactCapability
-    # Inform the server that this device has these capabilities
-    comDavra.registerDeviceCapability(functionName, functionDetails)
+    agentCapabilityDetails[functionName] = functionDetails
 
 
 # Register the functions defined above as those which the agent can do
@@ -453,7 +596,7 @@ def registerAgentCapabilities(functionName, functionDetails, functionToCallToEna
 #
 def registerAllAgentCapabilities():
     registerAgentCapabilities('agent-action-pushAppWithInstaller', { \
-        "functionParameters": { "Installation File": "file" }, \
+        "functionParameters": { "Installation File": "file", "Installation File SHA256": "string" }, \
         "functionLabel": "Push Device App (with installer)", \
         "functionDescription": "To run a device Application alongside the Device Agent on a device. Supply a tar.gz file containing an install.sh script to install it." \
     }, agentFunctionPushAppWithInstaller)
@@ -487,6 +630,58 @@ def registerAllAgentCapabilities():
         "functionLabel": "Run bash script on Device", \
         "functionDescription": "Run a bash script once on the device, launched by the Device Agent" \
     }, agentFunctionRunScriptBash)
+    # Inform the server that this device has these capabilities, all in one go
+    comDavra.registerDeviceCapabilities(agentCapabilityDetails)
+
+###########################   MQTT clients
+
+# Both mqtt clients keep a persistent session: a stable client id, clean_session=False and
+# QoS 1 subscriptions, so messages sent while the device was briefly offline (eg. a job
+# announcement) are delivered by the broker when it reconnects rather than lost.
+# The client connects in the background and keeps reconnecting, with an exponential backoff
+# and jitter so a fleet does not reconnect all at once after a broker outage.
+# Tunable in config.json:
+#   linkType: "ethernet", "wifi", "cellular" or "satellite". Sets the keepalive (default "ethernet")
+#   mqttKeepalive: seconds between keepalives, overriding the one for the linkType
+#   mqttReconnectMinDelay, mqttReconnectMaxDelay: bounds of the reconnect backoff in seconds (default 1, 300)
+mqttKeepaliveForLinkType = {"ethernet": 60, "wifi": 60, "cellular": 240, "satellite": 600}
+
+
+class ReconnectingMqttClient(mqtt.Client):
+    # Replaces the wait of paho between reconnect attempts, which doubles up to the maximum,
+    # with one picked at random between half and all of that
+    def _reconnect_wait(self):
+        with self._reconnect_delay_mutex:
+            if self._reconnect_delay is None:
+                self._reconnect_delay = self._reconnect_min_delay
+            else:
+                self._reconnect_delay = min(self._reconnect_delay * 2, self._reconnect_max_delay)
+            targetTime = time.time() + random.uniform(self._reconnect_delay / 2.0, self._reconnect_delay)
+        # Checked every second so loop_stop is not held up
+        while(self._state != mqtt.mqtt_cs_disconnecting and not self._thread_terminate and time.time() < targetTime):
+            time.sleep(min(targetTime - time.time(), 1))
+
+
+def getMqttKeepalive():
+    if('mqttKeepalive' in comDavra.conf):
+        return int(comDavra.conf['mqttKeepalive'])
+    return mqttKeepaliveForLinkType.get(comDavra.conf.get('linkType', 'ethernet'), 60)
+
+
+# Create a client with a persistent session and start it connecting to host in the background
+def startMqttClient(clientId, host, onConnect, onMessage, onDisconnect = None):
+    client = ReconnectingMqttClient(client_id = clientId, clean_session = False)
+    client.on_connect = onConnect
+    client.on_message = onMessage
+    if(onDisconnect is not None):
+        client.on_disconnect = onDisconnect
+    client.username_pw_set(username = comDavra.conf["UUID"], password = comDavra.conf["apiToken"])
+    client.reconnect_delay_set(int(comDavra.conf.get('mqttReconnectMinDelay', 1)), \
+        int(comDavra.conf.get('mqttReconnectMaxDelay', 300)))
+    client.connect_async(host, keepalive = getMqttKeepalive())
+    client.loop_start() # Starts another thread which connects, then monitors incoming messages
+    return client
+
 
 ###########################   MQTT Broker running on device
 
@@ -495,31 +690,31 @@ def mqttOnConnectDevice(client, userdata, flags, resultCode):
     comDavra.log('Mqtt Device Broker: Connected with result code ' + str(resultCode))
     # Subscribing in on_connect() means that if we lose the connection and
     # reconnect then subscriptions will be renewed.
-    client.subscribe("/agent")
+    client.subscribe("/agent", qos = 1)
     return
 
 
 # The callback for when a message is received from the mqtt broker on the device.
+# Runs on the mqtt network thread, so the message is only parsed and queued for the dispatcher
 def mqttOnMessageDevice(client, userdata, msg):
     payload = str(msg.payload)
-    if(comDavra.isJson(payload)):
-        processMessageFromAppToAgent(json.loads(payload))
-    else:
+    # Parsed once. A high rate app may send many of these a second
+    try:
+        appMsg = json.loads(payload)
+    except ValueError:
         comDavra.logError('ERROR: Mqtt Device Broker: Received NON json Mqtt message: ' + payload)
+        return
+    processMessageFromAppToAgent(appMsg)
     return
     
 
 # Setup the MQTT client talking to the broker on the device    
 clientOfDevice = None
 if(comDavra.conf.has_key("mqttBrokerAgentHost") and len(comDavra.conf["mqttBrokerAgentHost"]) > 3):
-    clientOfDevice = mqtt.Client()
-    clientOfDevice.on_connect = mqttOnConnectDevice
-    clientOfDevice.on_message = mqttOnMessageDevice
-    clientOfDevice.username_pw_set(username = comDavra.conf["UUID"], password = comDavra.conf["apiToken"])
     comDavra.logInfo('Starting to connect to MQTT broker running on device ' + comDavra.conf["mqttBrokerAgentHost"])
     try:
-        clientOfDevice.connect(comDavra.conf["mqttBrokerAgentHost"])
-        clientOfDevice.loop_start() # Starts another thread to monitor incoming messages
+        clientOfDevice = startMqttClient('davra-agent-' + comDavra.conf["UUID"] + '-device', \
+            comDavra.conf["mqttBrokerAgentHost"], mqttOnConnectDevice, mqttOnMessageDevice)
     except Exception as e:
         comDavra.logError('Experienced error connecting to mqtt at ' + comDavra.conf["mqttBrokerServerHost"] + ":" + str(e))
 else:
@@ -531,35 +726,72 @@ else:
 ###########################   Process Messages from Device Application to Device Agent
 
 # These messages may arrive by mqtt from app to agent or api calls or flat file comms
-# msg should be a json object
+# msg should be a json object. The kinds of request in the message are queued for the dispatcher
+# together, so they are handled in order
 def processMessageFromAppToAgent(msg):
     # Ignore any messages this agent published
     if(msg.has_key("fromAgent")):
         return
     comDavra.log('processMessageFromAppToAgent: incoming msg: ' + str(msg))
-    if(msg.has_key("registerCapability")):
-        capabilityName = msg["registerCapability"]
-        capabilityDetails = msg["capabilityDetails"] if msg.has_key("capabilityDetails") else {}
-        comDavra.registerDeviceCapability(capabilityName, capabilityDetails)
-    if(msg.has_key("runFunctionOnAgent")):
-        functionName = msg["runFunctionOnAgent"]
-        functionParameterValues = msg["functionParameterValues"] if msg.has_key("functionParameterValues") else {}
-        runFunction(functionName, functionParameterValues)
-    if(msg.has_key("connectToAgent")):
-        applicationName = msg["connectToAgent"]
-        comDavra.log('From app to agent, app announcing it is running: ' + applicationName)
-        time.sleep(0.1)
-        sendHeartbeatToDeviceApps()
-    if(msg.has_key("retrieveConfigFromAgent")):
-        comDavra.log('From app to agent, app requesting config')
-        sendMessageFromAgentToApps({"agentConfig": comDavra.conf})
-    if(msg.has_key("finishedFunctionOnApp")):
-        functionName = msg["finishedFunctionOnApp"]
-        comDavra.log('From app to agent, app announcing it finished running a function: ' + functionName)
-        updateFunctionStatusAsReportedByDeviceApp(msg)
-    if(msg.has_key("sendIotData")):
-        comDavra.log('From app to agent, app announcing it has iotData to send ' + str(msg))
-        sendIotDataToServer(msg)
+    messageTypes = [messageType for messageType in appMessageTypes if msg.has_key(messageType)]
+    if(len(messageTypes) > 0 and davra_dispatcher.submitMessage(messageTypes, msg) is False):
+        comDavra.logWarning('Dispatcher queue full, dropped ' + ', '.join(messageTypes) + ' message from app')
+
+
+def handleAppRegisterCapability(msg):
+    capabilityName = msg["registerCapability"]
+    capabilityDetails = msg["capabilityDetails"] if msg.has_key("capabilityDetails") else {}
+    comDavra.registerDeviceCapability(capabilityName, capabilityDetails)
+
+
+# Several capabilities at once, as a dict of capability name to details
+def handleAppRegisterCapabilities(msg):
+    comDavra.registerDeviceCapabilities(msg["registerCapabilities"])
+
+
+def handleAppRunFunctionOnAgent(msg):
+    functionName = msg["runFunctionOnAgent"]
+    functionParameterValues = msg["functionParameterValues"] if msg.has_key("functionParameterValues") else {}
+    runFunction(functionName, functionParameterValues)
+
+
+def handleAppConnectToAgent(msg):
+    applicationName = msg["connectToAgent"]
+    comDavra.log('From app to agent, app announcing it is running: ' + applicationName)
+    time.sleep(0.1)
+    sendHeartbeatToDeviceApps()
+
+
+def handleAppRetrieveConfigFromAgent(msg):
+    comDavra.log('From app to agent, app requesting config')
+    sendMessageFromAgentToApps({"agentConfig": comDavra.conf})
+
+
+def handleAppFinishedFunctionOnApp(msg):
+    functionName = msg["finishedFunctionOnApp"]
+    comDavra.log('From app to agent, app announcing it finished running a function: ' + functionName)
+    updateFunctionStatusAsReportedByDeviceApp(msg)
+
+
+def handleAppSendIotData(msg):
+    comDavra.log('From app to agent, app announcing it has iotData to send ' + str(msg))
+    sendIotDataToServer(msg)
+
+
+# The kinds of request an app can make, in the order they are handled when one message has several.
+# Such a message is handled at the most urgent priority of its requests.
+# Jobs and functions are most urgent (0). Telemetry is least (2) so it is dropped first when the
+# dispatcher is overloaded. Separate messages of the same priority may be handled at the same time,
+# eg. two sendIotData messages may reach the uplink in either order, each keeping its timestamps
+appMessageTypes = ["registerCapability", "registerCapabilities", "runFunctionOnAgent", "connectToAgent", \
+    "retrieveConfigFromAgent", "finishedFunctionOnApp", "sendIotData"]
+davra_dispatcher.registerHandler("registerCapability", handleAppRegisterCapability, 1)
+davra_dispatcher.registerHandler("registerCapabilities", handleAppRegisterCapabilities, 1)
+davra_dispatcher.registerHandler("runFunctionOnAgent", handleAppRunFunctionOnAgent, 0)
+davra_dispatcher.registerHandler("connectToAgent", handleAppConnectToAgent, 1)
+davra_dispatcher.registerHandler("retrieveConfigFromAgent", handleAppRetrieveConfigFromAgent, 1)
+davra_dispatcher.registerHandler("finishedFunctionOnApp", handleAppFinishedFunctionOnApp, 0)
+davra_dispatcher.registerHandler("sendIotData", handleAppSendIotData, 2)
 
 
 # Send a message onto the mqtt topic which the Device Apps are lstening to
@@ -580,7 +812,11 @@ def sendHeartbeatToDeviceApps():
 def sendIotDataToServer(msgFromMqtt):
     comDavra.log('Sending iotdata to server ')
     print(str(msgFromMqtt))
-    dataFromAgent = json.loads(msgFromMqtt["sendIotData"])
+    dataFromAgent = msgFromMqtt["sendIotData"]
+    # Earlier versions of the sdk send the data as a json string inside the message,
+    # newer ones send it as a list of datums in the message itself
+    if(isinstance(dataFromAgent, basestring)):
+        dataFromAgent = json.loads(dataFromAgent)
     if (type (dataFromAgent) == type ({})):
         dataFromAgent = [dataFromAgent]
     dataForServer = []
@@ -596,9 +832,9 @@ def sendIotDataToServer(msgFromMqtt):
         else:
             comDavra.logError('Not sending data to server as it appears incomplete: ' + str(metric))
     if dataForServer:
-        comDavra.log('Sending data to Server: ' + str(dataForServer))
-        statusCode = comDavra.sendDataToServer(dataForServer).status_code
-        comDavra.log('Response after sending iotdata to server: ' + str(statusCode))
+        # Batched with data from other apps and sent by the uplink
+        comDavra.log('Queueing data for Server: ' + str(dataForServer))
+        davra_uplink.queueIotData(dataForServer)
     
     
         
@@ -615,14 +851,27 @@ def sendIotDataToServer(msgFromMqtt):
 
 # The callback for when the client (this agent) receives a CONNACK response from the broker
 def mqttOnConnectServer(client, userdata, flags, resultCode):
+    global mqttServerConnectCount
     comDavra.log("Mqtt Davra Server Broker: Connected with result code " + str(resultCode))
     # Subscribing in on_connect() means that if we lose the connection and
     # reconnect then subscriptions will be renewed.
-    client.subscribe("devices/" + comDavra.conf["UUID"])
+    client.subscribe("devices/" + comDavra.conf["UUID"], qos = 1)
+    davra_uplink.setMqttConnected(resultCode == 0)
+    # Without a session kept by the broker, announcements sent while disconnected are lost,
+    # so look for jobs now rather than at the next poll
+    mqttServerConnectCount += 1
+    if(resultCode == 0 and flags.get('session present') != 1 and mqttServerConnectCount > 1):
+        davra_scheduler.triggerTask('checkForPendingJob')
     return
 
 
+def mqttOnDisconnectServer(client, userdata, resultCode):
+    comDavra.log("Mqtt Davra Server Broker: Disconnected with result code " + str(resultCode))
+    davra_uplink.setMqttConnected(False)
+
+
 # The callback for when a message is received from the broker on platform server.
+# Runs on the mqtt network thread, so the message is only parsed and queued for the dispatcher
 def mqttOnMessageServer(client, userdata, msg):
     payload = str(msg.payload)
     comDavra.log('Mqtt Davra Server Broker: Received Mqtt message: ' + payload)
@@ -633,18 +882,17 @@ def mqttOnMessageServer(client, userdata, msg):
     
 # Setup the MQTT client talking to the broker on the Davra server    
 clientOfServer = None
+mqttServerConnectCount = 0
 def mqttConnectToServer():
+    global clientOfServer
     if(comDavra.conf.has_key("mqttBrokerServerHost") and len(comDavra.conf["mqttBrokerServerHost"]) > 3) \
     and comDavra.conf.has_key("apiToken"):
-        clientOfServer = mqtt.Client()
-        clientOfServer.on_connect = mqttOnConnectServer
-        clientOfServer.on_message = mqttOnMessageServer
         comDavra.log('Starting to connect to MQTT broker running on Davra server ' + comDavra.conf["mqttBrokerServerHost"])
-        apiTokenForDevice = comDavra.conf["apiToken"]
-        clientOfServer.username_pw_set(username = comDavra.conf["UUID"], password = apiTokenForDevice)
         try:
-            clientOfServer.connect(comDavra.conf["mqttBrokerServerHost"])
-            clientOfServer.loop_start() # Starts another thread to monitor incoming messages
+            clientOfServer = startMqttClient('davra-agent-' + comDavra.conf["UUID"], comDavra.conf["mqttBrokerServerHost"], \
+                mqttOnConnectServer, mqttOnMessageServer, mqttOnDisconnectServer)
+            # Telemetry can be sent over this connection, see davra_uplink
+            davra_uplink.setMqttClient(clientOfServer)
         except Exception as e:
             comDavra.logError('Experienced error connecting to mqtt at ' + comDavra.conf["mqttBrokerServerHost"] + ":" + str(e))
     else:
@@ -655,27 +903,102 @@ def mqttConnectToServer():
 ###########################   Process Messages from Davra Server to this Device Agent
 
 # These messages may arrive by mqtt from server to agent 
-# msg should be a json object
+# msg should be a json object. The kinds of request in the message are queued for the dispatcher
+# together, so they are handled in order
 def processMessageFromServerToAgent(msg):
     comDavra.log('processMessageFromServerToAgent: incoming msg: ' + str(msg))     
+    messageTypes = []
     if(msg.has_key("stringMsg") and msg["stringMsg"] == "davra.announcement:check-for-jobs"):
-        comDavra.log('From server to device, new jobs might be available')
-        checkForPendingJob()
+        messageTypes.append("server-check-for-jobs")
     if(msg.has_key("davra-announcement") and msg["davra-announcement"] == "check-for-jobs"):
-        comDavra.log('From server to device, new jobs might be available')
-        checkForPendingJob()
+        messageTypes.append("server-check-for-jobs")
     if(msg.has_key("davra-function")):
-        comDavra.log('From server to device, run a function: ' + str(msg["davra-function"]))
-        funcParamsToRun = {}
-        if("functionParameterValues" in msg):
-            funcParamsToRun = msg["functionParameterValues"]
-        runFunction(msg["davra-function"], funcParamsToRun)
-        
+        messageTypes.append("server-davra-function")
+    if(len(messageTypes) > 0 and davra_dispatcher.submitMessage(messageTypes, msg) is False):
+        comDavra.logWarning('Dispatcher queue full, dropped ' + ', '.join(messageTypes) + ' message from server')
+
+
+def handleServerCheckForJobs(msg):
+    comDavra.log('From server to device, new jobs might be available')
+    davra_scheduler.triggerTask('checkForPendingJob')
 
 
+def handleServerDavraFunction(msg):
+    comDavra.log('From server to device, run a function: ' + str(msg["davra-function"]))
+    funcParamsToRun = {}
+    if("functionParameterValues" in msg):
+        funcParamsToRun = msg["functionParameterValues"]
+    runFunction(msg["davra-function"], funcParamsToRun)
+
+
+davra_dispatcher.registerHandler("server-check-for-jobs", handleServerCheckForJobs, 0)
+davra_dispatcher.registerHandler("server-davra-function", handleServerDavraFunction, 0)
+
 
 ###########################   MAIN LOOP
 
+# Emit a heartbeat for any apps listening on mqtt and to the platform server
+def runHeartbeat():
+    # Pick up any edit made to config.json by hand since it was last read
+    if(comDavra.reloadConfigurationIfChanged()):
+        comDavra.log('Configuration file changed on disk, reloaded')
+    sendHeartbeatToDeviceApps()
+    davra_update.recordTrialRunning()
+    # A new release of the agent is kept once the server has accepted a heartbeat, and rolled back
+    # if it cannot. 500 is also what a request which got no response returns, so counts as the
+    # server unreachable
+    r = sendHeartbeatMetricsToServer()
+    if(davra_uplink.isAcceptedByServer(r)):
+        davra_update.confirmUpdate()
+    elif(davra_update.checkTrialExpired(r.status_code < 500)):
+        restartAgent()
+
+
+# Restart the agent service, eg. to run a new release. Anything queued is sent first
+def restartAgent():
+    comDavra.logInfo('Restarting the agent')
+    davra_uplink.flushUplink()
+    comDavra.shipQueuedLogs()
+    comDavra.runCommandWithTimeout('systemctl restart davra_agent.service', 30)
+
+
+# Install a new release of the agent if one is published. Not while jobs are running,
+# as the restart would interrupt them
+def checkForAgentUpdate():
+    if(davra_update.isAutoUpdateEnabled() is False or 'agentRepository' not in comDavra.conf):
+        return
+    workerStats = davra_workers.getWorkerStats()
+    if(workerStats['running'] > 0 or workerStats['queued'] > 0 or davra_jobs.getRunningJobCount() > 0):
+        comDavra.log('Update: check deferred while jobs are running')
+        return
+    try:
+        if(davra_update.checkForUpdate()):
+            restartAgent()
+    except davra_update.UpdateError as e:
+        comDavra.logWarning('Update: ' + str(e))
+
+
+# The periodic work of the agent. Intervals are in seconds. 
+# A little jitter spreads the calls home from a fleet of devices started at the same time.
+def registerScheduledTasks():
+    heartbeatInterval = int(comDavra.conf['heartbeatInterval'])
+    davra_scheduler.registerTask('heartbeat', runHeartbeat, heartbeatInterval, \
+        jitter = heartbeatInterval * 0.02, deadline = 60)
+    # Also triggered straight away when the server announces a job
+    davra_scheduler.registerTask('checkForPendingJob', checkForPendingJob, heartbeatInterval, \
+        jitter = heartbeatInterval * 0.02, deadline = 60)
+    # Functions and jobs report their own completion. This catches timeouts and anything missed
+    davra_scheduler.registerTask('checkFunctionFinished', checkFunctionFinished, 60)
+    davra_scheduler.registerTask('checkCurrentJob', checkCurrentJob, 60)
+    # Only occasionally, confirm the server still has the capabilities. They are uploaded only if not
+    # Not at start, as registerAllAgentCapabilities has just reported them
+    davra_scheduler.registerTask('checkDeviceCapabilitiesOnServer', comDavra.checkDeviceCapabilitiesOnServer, \
+        heartbeatInterval * 10, runNow = False)
+    updateCheckInterval = davra_update.getUpdateCheckInterval()
+    davra_scheduler.registerTask('checkForAgentUpdate', checkForAgentUpdate, updateCheckInterval, \
+        jitter = updateCheckInterval * 0.1, runNow = False)
+
+
 if __name__ == "__main__":
     mqttConnectToServer()
     reportAgentStarted()
@@ -683,32 +1006,13 @@ if __name__ == "__main__":
     # Run the reboot-finished check any time the program is started
     checkIfJustBackAfterRebootTask()  
     registerAllAgentCapabilities()
-    # Main loop to run forever. 
-    # Send heartbeat signal to server ocassionally, check for jobs and run them
-    countMainLoop = 0
+    startMetricsSampler()
+    registerScheduledTasks()
+    # Run forever. Sleeps until the next task is due or an event (eg. a job announcement) wakes it
     while True:
         try:
-            # Only every n seconds
-            if(countMainLoop % int(comDavra.conf['heartbeatInterval']) == 0):
-                # Emit a heartbeat for any apps listening on mqtt
-                sendHeartbeatToDeviceApps()
-                # Send a heartbeat to platform server
-                sendHeartbeatMetricsToServer()
-                # Check for any pending jobs
-                checkForPendingJob() 
-            # check if a currently running job or function is finished
-            # Only check if the flag indicates one is running but also every n iterations just in case
-            if(flagIsFunctionRunning is True or countMainLoop % 60 == 0):
-                checkFunctionFinished()
-            if(flagIsJobRunning is True or countMainLoop % 60 == 0):
-                checkCurrentJob()    
-            # Only occasionally, report all capabilities up to server just in case.
-            if(countMainLoop % (int(comDavra.conf['heartbeatInterval']) * 10) == 0):
-                comDavra.reportDeviceCapabilities()
+            davra_scheduler.runScheduler()
         except KeyboardInterrupt:
             print("Error: issue encountered")
             comDavra.logError("Error: issue encountered")
-            #
-        countMainLoop += 1
-        time.sleep(1)
-# End Main loop
\ No newline at end of file
+# End Main loop
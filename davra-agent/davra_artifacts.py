@@ -0,0 +1,360 @@
+# Davra Artifacts
+# Downloads the archives of device apps and keeps them, extracted, in a content-addressed cache
+# so pushing the same app again, or rolling back to an earlier version, needs no download.
+# The http body is streamed straight into the tar extractor while its SHA-256 is calculated,
+# so the archive is never copied to a temporary directory first. The bytes are also appended
+# to a partial file, so a download which is interrupted resumes with a Range request, both
+# part way through an extraction and when the app is pushed again after a failure.
+# Layout under artifactsDir:
+#   <sha256>/        - the extracted contents of an archive with that hash
+#   index.json       - per hash: size and last use, per url: its hash and ETag/Last-Modified
+#   partial/         - downloads in progress, named by the hash of their url
+# When the expected hash is given, a cached artifact is used with no request to the server at all.
+# Otherwise a conditional request (If-None-Match/If-Modified-Since) checks the cached copy of the url.
+# Tunable in config.json:
+#   artifactCacheMaxBytes: disk space the extracted artifacts may use. The least recently used
+#     are evicted beyond this, never the one just used (default 200MB)
+#   artifactDownloadAttempts: how many times a download is resumed before giving up (default 3)
+#
+import os
+import json
+import time
+import shutil
+import tarfile
+import hashlib
+import threading
+import davra_lib as comDavra
+
+
+artifactsDir = comDavra.installationDir + '/artifacts'
+indexFile = artifactsDir + '/index.json'
+partialDir = artifactsDir + '/partial'
+artifactsLock = threading.RLock()
+artifactStats = {"cacheHits": 0, "downloads": 0, "bytesDownloaded": 0, "resumes": 0, "evictions": 0}
+
+
+class ArtifactError(Exception):
+    pass
+
+
+# The server could not be reached or the connection dropped. The partial download is kept to resume
+class DownloadInterruptedError(ArtifactError):
+    pass
+
+
+def getCacheMaxBytes():
+    return int(comDavra.conf.get('artifactCacheMaxBytes', 200000000))
+
+def getDownloadAttempts():
+    return max(1, int(comDavra.conf.get('artifactDownloadAttempts', 3)))
+
+
+# Call with artifactsLock held
+def loadIndex():
+    try:
+        with open(indexFile) as data_file:
+            return json.load(data_file)
+    except (IOError, ValueError):
+        return {"artifacts": {}, "urls": {}}
+
+
+# Call with artifactsLock held
+def saveIndex(index):
+    comDavra.ensureDirectoryExists(artifactsDir)
+    tmpFile = indexFile + '.tmp'
+    with open(tmpFile, 'w') as outfile:
+        json.dump(index, outfile)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.rename(tmpFile, indexFile)
+
+
+def getArtifactPath(sha256):
+    return artifactsDir + '/' + sha256
+
+
+def getDirectorySize(path):
+    totalBytes = 0
+    for dirPath, dirNames, fileNames in os.walk(path):
+        for fileName in fileNames:
+            filePath = os.path.join(dirPath, fileName)
+            if(os.path.islink(filePath) is False):
+                totalBytes += os.path.getsize(filePath)
+    return totalBytes
+
+
+# The body of a download as a file-like object for tarfile. Bytes already in the partial file
+# are read first, then the rest comes from the server. Everything read is hashed and every
+# byte from the server is appended to the partial file. If the connection drops, the download
+# resumes with a Range request from where it got to.
+class DownloadStream(object):
+    def __init__(self, url, partialFile, validators):
+        self.url = url
+        self.partialFile = partialFile
+        self.validators = validators # ETag/Last-Modified of the partial file, if any
+        self.sha256 = hashlib.sha256()
+        self.position = 0
+        self.buffer = ''
+        self.notModified = False
+        self.existing = open(partialFile, 'rb') if os.path.isfile(partialFile) else None
+        self.existingBytes = os.path.getsize(partialFile) if self.existing is not None else 0
+        self.output = None
+        self.chunks = None
+        self.attempts = 0
+        self.totalBytes = None # Size of the whole file, when the server says
+
+    # Start, or resume, the request for the bytes after those already held
+    def openResponse(self, conditionalHeaders = None):
+        self.attempts += 1
+        headers = dict(conditionalHeaders or {})
+        if(self.existingBytes > 0):
+            headers['Range'] = 'bytes=' + str(self.existingBytes) + '-'
+            # Only resume if the file on the server has not changed since the partial download
+            if(self.validators.get('etag') or self.validators.get('lastModified')):
+                headers['If-Range'] = self.validators.get('etag') or self.validators.get('lastModified')
+        startTime = time.time()
+        try:
+            response = comDavra.getHttpSession().get(self.url, headers=headers, stream=True, \
+                timeout=comDavra.getTimeoutForDestination(self.url))
+        except Exception as e:
+            comDavra.recordHttpRequest(int((time.time() - startTime) * 1000), True)
+            raise DownloadInterruptedError('Could not reach ' + self.url + ': ' + str(e))
+        comDavra.recordHttpRequest(int((time.time() - startTime) * 1000), False)
+        if(response.status_code == 304):
+            self.notModified = True
+            response.close()
+            return
+        if(response.status_code == 206 and self.existingBytes > 0):
+            with artifactsLock:
+                artifactStats['resumes'] += 1
+            # Content-Range is "bytes <first>-<last>/<total>"
+            total = response.headers.get('Content-Range', '').rpartition('/')[2]
+            self.totalBytes = int(total) if total.isdigit() else None
+        elif(response.status_code == 200):
+            if(self.position > 0):
+                # Part of the body has already been extracted and the server will not send the rest
+                response.close()
+                raise ArtifactError('Server did not resume the download of ' + self.url)
+            # The server sends the whole file, so the partial download is not needed
+            self.existingBytes = 0
+            if(self.existing is not None):
+                self.existing.close()
+                self.existing = None
+            if(self.output is not None):
+                self.output.close()
+            self.output = open(self.partialFile, 'wb')
+            length = response.headers.get('Content-Length', '')
+            self.totalBytes = int(length) if length.isdigit() else None
+        else:
+            response.close()
+            raise ArtifactError('Download of ' + self.url + ' failed with status ' + str(response.status_code))
+        if(self.output is None):
+            self.output = open(self.partialFile, 'ab')
+        self.validators = {"etag": response.headers.get('ETag'), "lastModified": response.headers.get('Last-Modified')}
+        with open(self.partialFile + '.json', 'w') as outfile:
+            json.dump({"url": self.url, "validators": self.validators}, outfile)
+        self.chunks = response.iter_content(65536)
+
+    # The next chunk of the body, or '' at the end
+    def readChunk(self):
+        # The request is made before using a partial download, in case the server will not resume it
+        if(self.chunks is None and self.attempts == 0):
+            self.openResponse()
+        if(self.existing is not None):
+            chunk = self.existing.read(65536)
+            if(len(chunk) > 0):
+                return chunk
+            self.existing.close()
+            self.existing = None
+        while True:
+            if(self.chunks is None):
+                self.openResponse()
+            try:
+                chunk = next(self.chunks, '')
+                # The connection can close early without an error, so check the size is right
+                if(len(chunk) == 0 and self.totalBytes is not None and self.output.tell() < self.totalBytes):
+                    raise IOError('connection closed after ' + str(self.output.tell()) + ' of ' \
+                        + str(self.totalBytes) + ' bytes')
+                break
+            except Exception as e:
+                self.output.flush()
+                self.chunks = None
+                self.existingBytes = os.path.getsize(self.partialFile)
+                if(self.attempts >= getDownloadAttempts()):
+                    raise DownloadInterruptedError('Download of ' + self.url + ' interrupted: ' + str(e))
+                comDavra.logWarning('Download of ' + self.url + ' interrupted, resuming: ' + str(e))
+        if(len(chunk) > 0):
+            self.output.write(chunk)
+            with artifactsLock:
+                artifactStats['bytesDownloaded'] += len(chunk)
+        return chunk
+
+    def read(self, size = -1):
+        while(size < 0 or len(self.buffer) < size):
+            chunk = self.readChunk()
+            if(len(chunk) == 0):
+                break
+            self.sha256.update(chunk)
+            self.position += len(chunk)
+            self.buffer += chunk
+        if(size < 0):
+            size = len(self.buffer)
+        data = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return data
+
+    # Read to the end, eg. the padding after the last member of the tar
+    def drain(self):
+        while(len(self.read(65536)) > 0):
+            pass
+        return self.sha256.hexdigest()
+
+    def close(self):
+        for openFile in [self.existing, self.output]:
+            if(openFile is not None):
+                openFile.close()
+
+
+# Extract every member of the archive as it streams in, refusing any which would be
+# written outside destination.
+# This runs in the agent rather than as a tar command under the supervisor, so no execution
+# profile applies to it. A tar command would need the archive on disk first
+def extractStream(stream, destination):
+    destination = os.path.realpath(destination)
+    archive = tarfile.open(fileobj=stream, mode='r|*')
+    try:
+        for member in archive:
+            memberPath = os.path.realpath(os.path.join(destination, member.name))
+            if(memberPath != destination and memberPath.startswith(destination + os.sep) is False):
+                raise ArtifactError('Archive member outside the app directory: ' + member.name)
+            if(member.issym()):
+                # Relative to the directory of the link
+                if(os.path.isabs(member.linkname) or os.path.realpath(os.path.join(os.path.dirname(memberPath), \
+                member.linkname)).startswith(destination + os.sep) is False):
+                    raise ArtifactError('Archive link outside the app directory: ' + member.name)
+            elif(member.islnk()):
+                # Relative to the top of the archive
+                if(os.path.realpath(os.path.join(destination, member.linkname)).startswith(destination + os.sep) is False):
+                    raise ArtifactError('Archive link outside the app directory: ' + member.name)
+            if(member.isdev()):
+                continue
+            archive.extract(member, destination)
+    finally:
+        archive.close()
+
+
+# Call with artifactsLock held. Record that an artifact was used, so it is the last to be evicted
+def touchArtifact(index, sha256, sizeBytes = None):
+    entry = index['artifacts'].setdefault(sha256, {"sizeBytes": 0})
+    if(sizeBytes is not None):
+        entry['sizeBytes'] = sizeBytes
+    entry['lastUsed'] = time.time()
+
+
+# Call with artifactsLock held. Remove the least recently used artifacts until within the quota
+def evictArtifacts(index, keepSha256):
+    maxBytes = getCacheMaxBytes()
+    usedBytes = sum([entry['sizeBytes'] for entry in index['artifacts'].values()])
+    for sha256, entry in sorted(index['artifacts'].items(), key = lambda item: item[1].get('lastUsed', 0)):
+        if(usedBytes <= maxBytes):
+            break
+        if(sha256 == keepSha256):
+            continue
+        shutil.rmtree(getArtifactPath(sha256), True)
+        del index['artifacts'][sha256]
+        for url in [url for url, urlEntry in index['urls'].items() if urlEntry['sha256'] == sha256]:
+            del index['urls'][url]
+        usedBytes -= entry['sizeBytes']
+        artifactStats['evictions'] += 1
+        comDavra.log('Artifacts: evicted ' + sha256 + ' (' + str(entry['sizeBytes']) + ' bytes)')
+
+
+# Returns the directory holding the extracted archive at url, downloading it only if it is not
+# already cached. expectedSha256, if given, is checked against the archive and lets a cached
+# copy be used without contacting the server. Raises ArtifactError on failure.
+# The directory belongs to the cache, so copy it before changing anything in it
+def provideArtifact(url, expectedSha256 = None):
+    expectedSha256 = expectedSha256.strip().lower() if expectedSha256 else None
+    with artifactsLock:
+        index = loadIndex()
+        urlEntry = index['urls'].get(url)
+        cachedSha256 = expectedSha256 or (urlEntry['sha256'] if urlEntry else None)
+        if(cachedSha256 is not None and os.path.isdir(getArtifactPath(cachedSha256)) is False):
+            cachedSha256 = None
+        if(expectedSha256 is not None and cachedSha256 is not None):
+            artifactStats['cacheHits'] += 1
+            touchArtifact(index, cachedSha256)
+            saveIndex(index)
+            comDavra.log('Artifacts: using cached ' + cachedSha256 + ' for ' + url)
+            return getArtifactPath(cachedSha256)
+    comDavra.ensureDirectoryExists(partialDir)
+    partialFile = partialDir + '/' + hashlib.sha1(url).hexdigest() + '.part'
+    validators = {}
+    if(os.path.isfile(partialFile + '.json')):
+        try:
+            with open(partialFile + '.json') as data_file:
+                validators = json.load(data_file).get('validators', {})
+        except (IOError, ValueError):
+            pass
+    stagingPath = artifactsDir + '/staging-' + comDavra.generateUuid()
+    stream = DownloadStream(url, partialFile, validators)
+    try:
+        # Revalidate a cached copy of the url. A partial download would not be resumed as well
+        if(cachedSha256 is not None and stream.existingBytes == 0):
+            conditionalHeaders = {}
+            if(urlEntry.get('etag')):
+                conditionalHeaders['If-None-Match'] = urlEntry['etag']
+            if(urlEntry.get('lastModified')):
+                conditionalHeaders['If-Modified-Since'] = urlEntry['lastModified']
+            if(len(conditionalHeaders) > 0):
+                stream.openResponse(conditionalHeaders)
+            if(stream.notModified):
+                with artifactsLock:
+                    index = loadIndex()
+                    artifactStats['cacheHits'] += 1
+                    touchArtifact(index, cachedSha256)
+                    saveIndex(index)
+                comDavra.log('Artifacts: ' + url + ' not modified, using cached ' + cachedSha256)
+                return getArtifactPath(cachedSha256)
+        os.mkdir(stagingPath)
+        extractStream(stream, stagingPath)
+        sha256 = stream.drain()
+        stream.close()
+        if(expectedSha256 is not None and sha256 != expectedSha256):
+            raise ArtifactError('Checksum mismatch for ' + url + ': expected ' + expectedSha256 + ', got ' + sha256)
+        with artifactsLock:
+            index = loadIndex()
+            artifactPath = getArtifactPath(sha256)
+            if(os.path.isdir(artifactPath)):
+                shutil.rmtree(stagingPath, True)
+            else:
+                os.rename(stagingPath, artifactPath)
+            artifactStats['downloads'] += 1
+            touchArtifact(index, sha256, getDirectorySize(artifactPath))
+            index['urls'][url] = {"sha256": sha256, "etag": stream.validators.get('etag'), \
+                "lastModified": stream.validators.get('lastModified')}
+            evictArtifacts(index, sha256)
+            saveIndex(index)
+        comDavra.log('Artifacts: downloaded ' + url + ' as ' + sha256)
+        for leftover in [partialFile, partialFile + '.json']:
+            if(os.path.isfile(leftover)):
+                os.remove(leftover)
+        return artifactPath
+    except Exception as e:
+        stream.close()
+        shutil.rmtree(stagingPath, True)
+        # An interrupted download is resumed next time, anything else is started afresh
+        if(isinstance(e, DownloadInterruptedError) is False):
+            for leftover in [partialFile, partialFile + '.json']:
+                if(os.path.isfile(leftover)):
+                    os.remove(leftover)
+        if(isinstance(e, ArtifactError)):
+            raise
+        raise ArtifactError('Could not extract ' + url + ': ' + str(e))
+
+
+def getArtifactStats():
+    with artifactsLock:
+        stats = dict(artifactStats)
+        stats['cachedBytes'] = sum([entry['sizeBytes'] for entry in loadIndex()['artifacts'].values()])
+    return stats
@@ -0,0 +1,163 @@
+# Davra Dispatcher
+# Messages arriving over mqtt are handled here rather than on paho's network thread, which only
+# parses and queues them, so it is always free to read the socket and send keepalives however
+# long a handler takes (eg. making http calls to the server).
+# Handlers are registered per message type with a priority, 0 being the most urgent. Queued
+# messages are handled most urgent first, and in the order they arrived within a priority,
+# by a bounded pool of threads. So with more than one thread, messages of the same priority
+# may be handled at the same time and finish in any order.
+# A message holding several requests may be submitted once with a list of their types. Its
+# handlers are then called one after the other, in the order given, at the most urgent of
+# their priorities.
+# When the queue is full, the oldest message of the least urgent priority is dropped to make
+# room, unless the new message is no more urgent, in which case the new message is dropped.
+# So a flood of telemetry from device apps is shed before it can delay a job or a function.
+# Tunable in config.json:
+#   dispatcherThreads: how many messages are handled at once (default 2)
+#   dispatcherMaxQueue: most messages waiting to be handled (default 1000)
+#
+import collections
+import threading
+import time
+import davra_lib as comDavra
+
+
+defaultPriority = 1
+dispatcherCondition = threading.Condition(threading.Lock())
+messageHandlers = {} # messageType -> (handler, priority)
+queuedMessages = {} # priority -> deque of (messageTypes, msg, queuedTime), oldest first
+queuedCount = 0
+busyCount = 0 # Messages being handled now
+dispatcherThreads = []
+dispatcherStats = {} # messageType -> counters, see getTypeStats
+# The deepest queue and slowest message since the heartbeat last took them
+dispatcherWindow = {"maxQueued": 0, "maxLatencyMs": 0}
+
+
+def getThreadCount():
+    return max(1, int(comDavra.conf.get('dispatcherThreads', 2)))
+
+def getMaxQueue():
+    return max(1, int(comDavra.conf.get('dispatcherMaxQueue', 1000)))
+
+
+# handler(msg) is called on a dispatcher thread for each message of this type
+def registerHandler(messageType, handler, priority = defaultPriority):
+    with dispatcherCondition:
+        messageHandlers[messageType] = (handler, priority)
+
+
+# Call with dispatcherCondition held
+def getTypeStats(messageType):
+    if(messageType not in dispatcherStats):
+        dispatcherStats[messageType] = {"handled": 0, "dropped": 0, "failed": 0, \
+            "lastQueuedMs": 0, "maxQueuedMs": 0, "lastHandlerMs": 0, "maxHandlerMs": 0}
+    return dispatcherStats[messageType]
+
+
+# Call with dispatcherCondition held. Drop the oldest of the least urgent messages queued
+# if it is less urgent than priority. Returns True if there is now room
+def makeRoomFor(priority):
+    global queuedCount
+    leastUrgent = max([p for p, messages in queuedMessages.items() if len(messages) > 0])
+    if(leastUrgent <= priority):
+        return False
+    (messageTypes, msg, queuedTime) = queuedMessages[leastUrgent].popleft()
+    queuedCount -= 1
+    for messageType in messageTypes:
+        getTypeStats(messageType)['dropped'] += 1
+    return True
+
+
+# Queue a message to be handled. Safe to call from any thread and never blocks on a handler.
+# messageType may be a list of types, to be handled in that order as one.
+# Returns False if the message was dropped because the queue is full
+def submitMessage(messageType, msg):
+    global queuedCount
+    messageTypes = messageType if type(messageType) == type([]) else [messageType]
+    with dispatcherCondition:
+        priority = min([messageHandlers.get(eachType, (None, defaultPriority))[1] for eachType in messageTypes])
+        if(queuedCount >= getMaxQueue() and makeRoomFor(priority) is False):
+            for eachType in messageTypes:
+                getTypeStats(eachType)['dropped'] += 1
+            return False
+        queuedMessages.setdefault(priority, collections.deque()).append((messageTypes, msg, time.time()))
+        queuedCount += 1
+        dispatcherWindow['maxQueued'] = max(dispatcherWindow['maxQueued'], queuedCount)
+        # Start another thread if there are more messages than threads and the pool has room
+        if(len(dispatcherThreads) < getThreadCount() and len(dispatcherThreads) < busyCount + queuedCount):
+            dispatcherThread = threading.Thread(target=runDispatcher, name='davra-dispatcher-' + str(len(dispatcherThreads)))
+            dispatcherThread.daemon = True
+            dispatcherThreads.append(dispatcherThread)
+            dispatcherThread.start()
+        dispatcherCondition.notify()
+    return True
+
+
+# Call with dispatcherCondition held. The most urgent message queued, or None
+def takeMessage():
+    global queuedCount
+    for priority in sorted(queuedMessages.keys()):
+        if(len(queuedMessages[priority]) > 0):
+            queuedCount -= 1
+            return queuedMessages[priority].popleft()
+    return None
+
+
+def runDispatcher():
+    global busyCount
+    while True:
+        with dispatcherCondition:
+            queued = takeMessage()
+            while(queued is None):
+                # No timeout so the thread truly sleeps until a message arrives
+                dispatcherCondition.wait()
+                queued = takeMessage()
+            (messageTypes, msg, queuedTime) = queued
+            busyCount += 1
+            handlers = [messageHandlers.get(messageType, (None, defaultPriority))[0] for messageType in messageTypes]
+        for (messageType, handler) in zip(messageTypes, handlers):
+            startTime = time.time()
+            isFailed = False
+            try:
+                if(handler is None):
+                    comDavra.logWarning('Dispatcher: no handler for message type ' + str(messageType))
+                else:
+                    handler(msg)
+            except Exception as e:
+                isFailed = True
+                comDavra.logError('Dispatcher: handling ' + str(messageType) + ' failed: ' + str(e))
+            endTime = time.time()
+            queuedMs = int((startTime - queuedTime) * 1000)
+            handlerMs = int((endTime - startTime) * 1000)
+            with dispatcherCondition:
+                stats = getTypeStats(messageType)
+                stats['handled'] += 1
+                if(isFailed):
+                    stats['failed'] += 1
+                stats['lastQueuedMs'] = queuedMs
+                stats['maxQueuedMs'] = max(stats['maxQueuedMs'], queuedMs)
+                stats['lastHandlerMs'] = handlerMs
+                stats['maxHandlerMs'] = max(stats['maxHandlerMs'], handlerMs)
+                dispatcherWindow['maxLatencyMs'] = max(dispatcherWindow['maxLatencyMs'], queuedMs + handlerMs)
+        with dispatcherCondition:
+            busyCount -= 1
+
+
+# Per message type counters, and the queue now
+def getDispatcherStats():
+    with dispatcherCondition:
+        stats = {"queued": queuedCount, "threads": len(dispatcherThreads)}
+        stats['types'] = dict((messageType, dict(typeStats)) for messageType, typeStats in dispatcherStats.items())
+    return stats
+
+
+# Returns the deepest the queue was and the longest a message took from arriving to being handled,
+# since the previous call, then starts a new period
+def takeDispatcherWindow():
+    with dispatcherCondition:
+        window = dict(dispatcherWindow)
+        window['queued'] = queuedCount
+        dispatcherWindow['maxQueued'] = queuedCount
+        dispatcherWindow['maxLatencyMs'] = 0
+    return window
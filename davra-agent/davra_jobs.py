@@ -0,0 +1,270 @@
+# Davra Jobs
+# Keeps the state of the jobs and functions running on this device in memory.
+# Every state transition is appended to a journal file and fsync'd, so the state is
+# recovered when the agent starts again, including after a reboot.
+# The journal is one compact json record per line:
+#   {"kind": "job", "id": <job uuid>, "data": <job object>}  - job created or changed
+#   {"kind": "job", "id": <job uuid>, "data": null}          - job removed
+# and likewise with kind "function" keyed by functionUuid.
+# On start, the journal is replayed then rewritten holding only the live entries.
+# Callers get and put copies, so a change only takes effect (and is journalled) through putJob/putFunction.
+#
+import os
+import copy
+import json
+import shutil
+import threading
+import time
+import davra_lib as comDavra
+
+
+journalFile = comDavra.installationDir + '/jobs.journal'
+functionsDir = comDavra.installationDir + '/functions'
+# Files used by earlier versions of the agent to track the current job and function
+legacyJobJson = comDavra.installationDir + '/currentJob/job.json'
+legacyFunctionJson = comDavra.installationDir + '/currentFunction/currentFunction.json'
+
+jobsLock = threading.RLock()
+jobs = {} # Job uuid -> job object as received from the server
+functions = {} # Function uuid -> function info
+journalRecordCount = 0
+maxJournalRecords = 1000 # Compact the journal once it holds this many records
+
+# Allowed status changes. A job or function which is finished stays until it has been reported
+jobStatusTransitions = {
+    None: ['pending', 'running'],
+    'pending': ['running', 'failed'],
+    'running': ['completed', 'failed'],
+    'completed': [],
+    'failed': []
+}
+
+
+def isFinishedStatus(status):
+    return status == 'completed' or status == 'failed'
+
+
+# Call with jobsLock held. Append a record to the journal and make sure it is on disk
+def appendToJournal(kind, entryId, data):
+    global journalRecordCount
+    with open(journalFile, 'a') as outfile:
+        outfile.write(json.dumps({"kind": kind, "id": entryId, "data": data}, separators=(',', ':')) + '\n')
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    journalRecordCount += 1
+    if(journalRecordCount >= maxJournalRecords):
+        compactJournal()
+
+
+# Call with jobsLock held. Rewrite the journal with only the live entries
+def compactJournal():
+    global journalRecordCount
+    tmpFile = journalFile + '.tmp'
+    with open(tmpFile, 'w') as outfile:
+        for (kind, entries) in [('job', jobs), ('function', functions)]:
+            for entryId, data in entries.items():
+                outfile.write(json.dumps({"kind": kind, "id": entryId, "data": data}, separators=(',', ':')) + '\n')
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.rename(tmpFile, journalFile)
+    journalRecordCount = len(jobs) + len(functions)
+
+
+# Recover jobs and functions from the journal. Call once when the agent starts
+def loadJournal():
+    with jobsLock:
+        jobs.clear()
+        functions.clear()
+        if(os.path.isfile(journalFile)):
+            with open(journalFile) as data_file:
+                for line in data_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A record only partially written before a crash
+                        continue
+                    entries = jobs if record['kind'] == 'job' else functions
+                    if(record['data'] is None):
+                        entries.pop(record['id'], None)
+                    else:
+                        entries[record['id']] = record['data']
+        importLegacyFiles()
+        compactJournal()
+    comDavra.log('Recovered ' + str(len(jobs)) + ' jobs and ' + str(len(functions)) + ' functions from journal')
+    return
+
+
+# Call with jobsLock held. Bring in the job and function tracked by an earlier version of the agent
+def importLegacyFiles():
+    legacyJob = None
+    if(os.path.isfile(legacyJobJson)):
+        try:
+            with open(legacyJobJson) as data_file:
+                legacyJob = json.load(data_file)
+            jobs[legacyJob['UUID']] = legacyJob
+        except Exception as e:
+            comDavra.logWarning('Could not import ' + legacyJobJson + ': ' + str(e))
+    if(os.path.isfile(legacyFunctionJson)):
+        try:
+            with open(legacyFunctionJson) as data_file:
+                functionInfo = json.load(data_file)
+            parameters = functionInfo.setdefault('functionParameterValues', {})
+            if('functionUuid' not in parameters):
+                parameters['functionUuid'] = comDavra.generateUuid()
+            if(legacyJob is not None):
+                functionInfo['jobUuid'] = legacyJob['UUID']
+            functions[parameters['functionUuid']] = functionInfo
+        except Exception as e:
+            comDavra.logWarning('Could not import ' + legacyFunctionJson + ': ' + str(e))
+    for legacyFile in [legacyJobJson, legacyFunctionJson]:
+        if(os.path.isdir(os.path.dirname(legacyFile))):
+            shutil.rmtree(os.path.dirname(legacyFile), True)
+
+
+###########################   Jobs
+
+def getJob(jobUuid):
+    with jobsLock:
+        return copy.deepcopy(jobs.get(jobUuid))
+
+
+def getJobs():
+    with jobsLock:
+        return copy.deepcopy(list(jobs.values()))
+
+
+def getJobStatus(jobObject):
+    return jobObject['devices'][0].get('status')
+
+
+# Record a job, or a change to it. Returns False if the status change is not allowed
+def putJob(jobObject):
+    with jobsLock:
+        previous = jobs.get(jobObject['UUID'])
+        previousStatus = getJobStatus(previous) if previous is not None else None
+        newStatus = getJobStatus(jobObject)
+        if(newStatus != previousStatus and newStatus not in jobStatusTransitions.get(previousStatus, [])):
+            comDavra.logWarning('Job ' + jobObject['UUID'] + ' cannot change from ' + str(previousStatus) \
+                + ' to ' + str(newStatus))
+            return False
+        jobs[jobObject['UUID']] = copy.deepcopy(jobObject)
+        appendToJournal('job', jobObject['UUID'], jobObject)
+    return True
+
+
+def removeJob(jobUuid):
+    with jobsLock:
+        if(jobs.pop(jobUuid, None) is not None):
+            appendToJournal('job', jobUuid, None)
+
+
+###########################   Job queue
+
+# Pending jobs fetched from the server wait in a local queue, in the order they were queued,
+# until there is room to run them. They are journalled like any other job so the queue
+# survives a restart. agentQueuedTime records when each was queued, in seconds since epoch
+jobQueueStats = {"started": 0, "maxWaitSeconds": 0.0}
+
+
+# Add a job which is pending on the server to the queue. Returns False if it is already known
+def queueJob(jobObject):
+    with jobsLock:
+        if(jobObject['UUID'] in jobs):
+            return False
+        jobObject = copy.deepcopy(jobObject)
+        jobObject['devices'][0]['status'] = 'pending'
+        jobObject['agentQueuedTime'] = time.time()
+        return putJob(jobObject)
+
+
+# The queued jobs, oldest first
+def getQueuedJobs():
+    with jobsLock:
+        queuedJobs = [job for job in jobs.values() if getJobStatus(job) == 'pending']
+        queuedJobs.sort(key = lambda job: job.get('agentQueuedTime', 0))
+        return copy.deepcopy(queuedJobs)
+
+
+def getRunningJobCount():
+    with jobsLock:
+        return len([job for job in jobs.values() if getJobStatus(job) == 'running'])
+
+
+# Record how long a job waited in the queue before it started
+def recordJobStarted(jobObject):
+    waitSeconds = max(0.0, time.time() - jobObject.get('agentQueuedTime', time.time()))
+    with jobsLock:
+        jobQueueStats['started'] += 1
+        jobQueueStats['maxWaitSeconds'] = max(jobQueueStats['maxWaitSeconds'], waitSeconds)
+
+
+# Returns the depth of the queue and the longest wait of any job since the previous call,
+# counting jobs still waiting, then starts a new period
+def takeJobQueueStats():
+    now = time.time()
+    with jobsLock:
+        queuedJobs = [job for job in jobs.values() if getJobStatus(job) == 'pending']
+        stats = dict(jobQueueStats)
+        stats['queued'] = len(queuedJobs)
+        for job in queuedJobs:
+            stats['maxWaitSeconds'] = max(stats['maxWaitSeconds'], now - job.get('agentQueuedTime', now))
+        stats['maxWaitSeconds'] = round(stats['maxWaitSeconds'], 1)
+        jobQueueStats['started'] = 0
+        jobQueueStats['maxWaitSeconds'] = 0.0
+    return stats
+
+
+###########################   Functions
+
+def getFunction(functionUuid):
+    with jobsLock:
+        return copy.deepcopy(functions.get(functionUuid))
+
+
+def getFunctions():
+    with jobsLock:
+        return copy.deepcopy(list(functions.values()))
+
+
+# Find a running function by name, for apps which report a finished function without its uuid
+def findRunningFunctionByName(functionName):
+    with jobsLock:
+        for functionInfo in functions.values():
+            if(functionInfo['functionName'] == functionName and functionInfo['status'] == 'running'):
+                return copy.deepcopy(functionInfo)
+    return None
+
+
+# Record a function, or a change to it. Returns False if the status change is not allowed
+def putFunction(functionInfo):
+    functionUuid = functionInfo['functionParameterValues']['functionUuid']
+    with jobsLock:
+        previous = functions.get(functionUuid)
+        previousStatus = previous['status'] if previous is not None else None
+        if(functionInfo['status'] != previousStatus \
+        and functionInfo['status'] not in jobStatusTransitions.get(previousStatus, [])):
+            comDavra.logWarning('Function ' + functionUuid + ' cannot change from ' + str(previousStatus) \
+                + ' to ' + str(functionInfo['status']))
+            return False
+        functions[functionUuid] = copy.deepcopy(functionInfo)
+        appendToJournal('function', functionUuid, functionInfo)
+    return True
+
+
+def removeFunction(functionUuid):
+    with jobsLock:
+        if(functions.pop(functionUuid, None) is not None):
+            appendToJournal('function', functionUuid, None)
+    shutil.rmtree(getFunctionDir(functionUuid), True)
+
+
+# A working directory for a function, eg. for the script it runs. Removed when the function is removed
+def getFunctionDir(functionUuid):
+    return functionsDir + '/' + comDavra.safeChars(functionUuid)
+
+
+def provideFunctionDir(functionUuid):
+    functionDir = getFunctionDir(functionUuid)
+    if(os.path.isdir(functionDir) is False):
+        os.makedirs(functionDir)
+    return functionDir
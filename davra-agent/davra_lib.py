@@ -3,12 +3,27 @@
 import subprocess
 import os, string
 import time, requests, os.path
+import requests.adapters
+import threading
+import collections
+import contextlib
+import copy
+import hashlib
+import atexit
+import fcntl
+import errno
+import select
+import gzip
+import zlib
+import shutil
 from requests.auth import HTTPBasicAuth
 import json 
 from pprint import pprint
 import sys
 import uuid
 from datetime import datetime
+import davra_metrics
+import davra_supervisor
 
 # Update this when anything changes in the agent
 davraAgentVersion = "1_7_3" 
@@ -22,76 +37,437 @@ logDir = "/var/log"
 flagNewCapabilityReadyToReport = False
 
 
-# Load configuration if it exists
+###########################   BACKGROUND THREADS
+
+# Lets a background thread sleep until a timeout or until another thread wakes it.
+# Used instead of threading.Event because python 2 implements Event.wait(timeout) as a loop
+# of short sleeps, which would wake an idle device many times a second.
+# This blocks in select() on a pipe so the thread truly sleeps.
+class WakeupSignal(object):
+    def __init__(self):
+        self.readFd, self.writeFd = os.pipe()
+        for fd in [self.readFd, self.writeFd]:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    # Wake the waiting thread. If nobody is waiting, the next wait returns straight away
+    def set(self):
+        try:
+            os.write(self.writeFd, 'x')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    # Forget any wakeup which has not been waited on yet
+    def clear(self):
+        try:
+            while len(os.read(self.readFd, 512)) > 0:
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    # Sleep for up to timeout seconds (forever if None). Returns True if woken by set()
+    def wait(self, timeout = None):
+        while True:
+            try:
+                readable = select.select([self.readFd], [], [], timeout)[0]
+                break
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+        self.clear()
+        return len(readable) > 0
+
+
+# Runs a function once, a short delay after it was first asked for, however many times it is
+# asked for in the meantime. Used so a burst of changes results in one report to the server.
+# Asking again while the function runs schedules another run, so no change is missed
+class DebouncedCall(object):
+    def __init__(self, name, functionToRun, getDelaySeconds):
+        self.name = name
+        self.functionToRun = functionToRun
+        self.getDelaySeconds = getDelaySeconds
+        self.lock = threading.Lock()
+        self.pending = False
+
+    def schedule(self):
+        with self.lock:
+            if(self.pending):
+                return
+            self.pending = True
+        thread = threading.Thread(target=self.runAfterDelay, name=self.name)
+        thread.daemon = True
+        thread.start()
+
+    def runAfterDelay(self):
+        time.sleep(self.getDelaySeconds())
+        self.flush()
+
+    # Run now if a run is pending. Also called when the program exits so nothing is lost
+    def flush(self):
+        with self.lock:
+            if(self.pending is False):
+                return
+            self.pending = False
+        try:
+            self.functionToRun()
+        except Exception as e:
+            logError(self.name + ' failed: ' + str(e))
+
+
+# The configuration is held in memory in conf. The file is only read again if it has been
+# modified since it was last read or written (eg. edited by hand), which is detected from its
+# modification time and size.
+# Changes are made inside a transaction so a group of changes is written to disk once,
+# atomically (write to a temporary file then rename), and reported to the server once:
+#   with comDavra.configTransaction():
+#       comDavra.upsertConfigurationItem('a', 1)
+#       comDavra.upsertConfigurationItem('b', 2)
+# The report to the server is debounced so a burst of transactions is covered by one event
+# sent configReportDelay seconds (default 2) after the first change of the burst.
 conf = {}
-def loadConfiguration():
-    global conf
+confFileSignature = None # (mtime, size) of the config file when last read or written
+confLock = threading.RLock()
+confTransactionDepth = 0
+confChangedInTransaction = False
+
+
+def getConfigFileSignature():
     try:
-        if(os.path.isfile(agentConfigFile) is True):
-            with open(agentConfigFile) as data_file:
-                conf = json.load(data_file)
-    except:
-        print('ERROR: Cannot read config file ' + agentConfigFile)
+        fileStat = os.stat(agentConfigFile)
+        return (fileStat.st_mtime, fileStat.st_size)
+    except OSError:
+        return None
+
+
+# Load configuration if it exists
+def loadConfiguration():
+    global conf, confFileSignature
+    with confLock:
+        try:
+            if(os.path.isfile(agentConfigFile) is True):
+                confFileSignature = getConfigFileSignature()
+                with open(agentConfigFile) as data_file:
+                    conf = json.load(data_file)
+        except:
+            print('ERROR: Cannot read config file ' + agentConfigFile)
 loadConfiguration()
 
 
+# Read the config file again only if it has been modified since it was last read or written
+# Returns True if it was reloaded
+def reloadConfigurationIfChanged():
+    with confLock:
+        if(getConfigFileSignature() == confFileSignature):
+            return False
+        loadConfiguration()
+        return True
+
+
 def getConfiguration():
     return conf
 
 
+# Write the configuration to disk. The file is replaced in one step so a reader (or a crash)
+# never sees it half written
+def saveConfiguration():
+    global confFileSignature
+    with confLock:
+        tmpFile = agentConfigFile + '.tmp'
+        with open(tmpFile, 'w') as outfile:
+            json.dump(conf, outfile, indent=4)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.rename(tmpFile, agentConfigFile)
+        confFileSignature = getConfigFileSignature()
+
+
+# Group configuration changes so they are saved and reported once, when the outermost
+# transaction ends. Transactions may be nested
+@contextlib.contextmanager
+def configTransaction():
+    global confTransactionDepth, confChangedInTransaction
+    with confLock:
+        if(confTransactionDepth == 0):
+            reloadConfigurationIfChanged()
+            confChangedInTransaction = False
+        confTransactionDepth += 1
+        try:
+            yield conf
+        finally:
+            confTransactionDepth -= 1
+            if(confTransactionDepth == 0 and confChangedInTransaction):
+                confChangedInTransaction = False
+                saveConfiguration()
+                configReport.schedule()
+
+
+# Record that conf was changed directly within a transaction, so it is saved when the transaction ends
+def markConfigurationChanged():
+    global confChangedInTransaction
+    confChangedInTransaction = True
+
+
 # Update (or insert) a configuration item with a value
 def upsertConfigurationItem(itemKey, itemValue):
-    global conf
-    loadConfiguration()
-    if(os.path.isfile(agentConfigFile) is True):
-        # If this a new key or an alteration of the current config
-        if(conf.has_key(itemKey) == False or conf[itemKey] != itemValue):
-            # Update the item
-            conf[itemKey] = itemValue
-            # Write the full config file to disk
-            with open(agentConfigFile, 'w') as outfile:
-                json.dump(conf, outfile, indent=4)
-            time.sleep(0.2)
-            # Update local cached version of configs
-            loadConfiguration()
-            # Report the new configuration to the server as an event
-            reportDeviceConfigurationToServer()
+    with configTransaction():
+        if(os.path.isfile(agentConfigFile) is True):
+            # If this a new key or an alteration of the current config
+            if(conf.has_key(itemKey) == False or conf[itemKey] != itemValue):
+                conf[itemKey] = itemValue
+                markConfigurationChanged()
     return
 
 
-# Send all of the configuration file to the server as an event
-def reportDeviceConfigurationToServer():
+# The configuration is reported to the server once changes have settled.
+# Further changes before the report is sent are covered by the same report
+configReport = DebouncedCall('davra-config-report', lambda: reportDeviceConfigurationToServer(), \
+    lambda: float(conf.get('configReportDelay', 2)))
+atexit.register(configReport.flush)
+
+
+# What was last reported successfully to the server is remembered as content hashes in
+# reported.json, so the capabilities and configuration are only uploaded when they change,
+# and then only the configuration items which changed
+reportedStateFile = installationDir + '/reported.json'
+reportedState = None
+reportedStateLock = threading.Lock()
+
+
+# A short fingerprint of any json content, independent of key order
+def hashContent(content):
+    return hashlib.sha1(json.dumps(content, sort_keys=True, separators=(',', ':'))).hexdigest()
+
+
+# Call with reportedStateLock held
+def getReportedState():
+    global reportedState
+    if(reportedState is None):
+        reportedState = {"capabilities": None, "config": {}}
+        try:
+            if(os.path.isfile(reportedStateFile)):
+                with open(reportedStateFile) as data_file:
+                    reportedState.update(json.load(data_file))
+        except Exception as e:
+            logWarning('Could not read ' + reportedStateFile + ': ' + str(e))
+    return reportedState
+
+
+# Call with reportedStateLock held
+def saveReportedState():
+    try:
+        tmpFile = reportedStateFile + '.tmp'
+        with open(tmpFile, 'w') as outfile:
+            json.dump(getReportedState(), outfile)
+        os.rename(tmpFile, reportedStateFile)
+    except (IOError, OSError) as e:
+        logWarning('Could not save ' + reportedStateFile + ': ' + str(e))
+
+
+# Compare the configuration with what was last reported.
+# Returns a tuple (changed items as a dict, names of items removed, hash of each item)
+def getConfigurationChanges(configToReport):
+    itemHashes = dict((key, hashContent(value)) for key, value in configToReport.items())
+    with reportedStateLock:
+        reportedHashes = getReportedState()["config"]
+        changedItems = dict((key, value) for key, value in configToReport.items() \
+            if reportedHashes.get(key) != itemHashes[key])
+        removedKeys = [key for key in reportedHashes if key not in itemHashes]
+    return (changedItems, removedKeys, itemHashes)
+
+
+# Record the configuration as reported, after the server accepted it
+def setConfigurationReported(itemHashes):
+    with reportedStateLock:
+        getReportedState()["config"] = itemHashes
+        saveReportedState()
+
+
+# Send the configuration items which changed since the last report to the server as an event.
+# fullReport sends all of the configuration whether it changed or not
+def reportDeviceConfigurationToServer(configToReport = None, fullReport = False):
+    if(configToReport is None):
+        with confLock:
+            configToReport = copy.deepcopy(conf)
+    (changedItems, removedKeys, itemHashes) = getConfigurationChanges(configToReport)
+    if(fullReport is False and len(changedItems) == 0 and len(removedKeys) == 0):
+        log('Configuration unchanged since last reported to server')
+        return
     dataToSend = { 
-        "UUID": conf['UUID'],
+        "UUID": configToReport['UUID'],
         "name": "davra.agent.configured",
         "value": {
-            'deviceConfig': conf
+            'deviceConfig': configToReport if fullReport else changedItems,
+            'removedKeys': removedKeys,
+            'isFullConfig': fullReport,
+            'configHash': hashContent(configToReport)
         },
         "msg_type": "event"
     }
     # Inform user of the overall data being sent for a single metric
-    logInfo('Sending configuration file to server: ' + conf['server'])
+    logInfo('Sending configuration to server: ' + configToReport['server'])
     logInfo(json.dumps(dataToSend, indent=4))
-    sendDataToServer(dataToSend)
+    r = sendDataToServer(dataToSend)
+    if(r.status_code == 200):
+        setConfigurationReported(itemHashes)
     log("reportDeviceConfigurationToServer finished.")
     return
 
-# Send a log message to the server
-def logToServer(severity, message):
-    # Do not send log to server if severity not in the required set
-    if(severity not in "ERROR,WARN,INFO"):
-        return
-    dataToSend = { 
+###########################   LOG SHIPPING
+
+# Log lines for the server are queued in memory and uploaded to /api/v1/logs in batches
+# by a background thread, so logging never waits on the network.
+# Tunable in config.json:
+#   logShipMaxQueue: how many log lines to hold. The oldest are dropped beyond this (default 500)
+#   logShipBatchItems: how many log lines to send per request (default 50)
+#   logShipInterval: seconds between uploads (default 10)
+#   logShipRateLimit: log lines per minute allowed for each severity,
+#       eg. {"INFO": 60, "WARN": 60, "ERROR": 120}. Lines beyond this are counted then dropped
+logShipQueue = collections.deque()
+logShipLock = threading.Lock()
+logShipWakeup = WakeupSignal()
+logShipThread = None
+logShipRateWindows = {} # severity -> [windowStartTime, linesInWindow, linesDropped]
+lastShippedLog = {"severity": None, "message": None, "repeats": 0}
+logShipStats = {"linesShipped": 0, "linesDropped": 0, "linesRateLimited": 0, "linesRejected": 0, "failedUploads": 0}
+defaultLogShipRateLimit = {"INFO": 60, "WARN": 60, "ERROR": 120}
+
+
+def makeLogEntry(severity, message):
+    return { 
         "UUID": conf['UUID'],
         "name": "davra.log",
+        "timestamp": getMilliSecondsSinceEpoch(),
         "value": {
             "severity": severity,
             "message": message
         }
     }
-    sendLogToServer(dataToSend)
+
+
+# Call with logShipLock held
+def appendToLogShipQueue(logEntry):
+    if(len(logShipQueue) >= int(conf.get('logShipMaxQueue', 500))):
+        logShipQueue.popleft()
+        logShipStats['linesDropped'] += 1
+    logShipQueue.append(logEntry)
+
+
+# Call with logShipLock held. Is this severity still within its allowance for the current minute
+def isWithinLogRateLimit(severity):
+    limit = conf.get('logShipRateLimit', defaultLogShipRateLimit).get(severity)
+    if(limit is None):
+        return True
+    now = time.time()
+    window = logShipRateWindows.setdefault(severity, [now, 0, 0])
+    if(now - window[0] >= 60):
+        if(window[2] > 0):
+            appendToLogShipQueue(makeLogEntry(severity, 'Rate limit dropped ' + str(window[2]) + ' ' + severity + ' messages'))
+        window[0] = now
+        window[1] = 0
+        window[2] = 0
+    if(window[1] >= int(limit)):
+        window[2] += 1
+        logShipStats['linesRateLimited'] += 1
+        return False
+    window[1] += 1
+    return True
+
+
+# Call with logShipLock held. Emit the summary of a message which was repeated
+def flushRepeatedLog():
+    if(lastShippedLog['repeats'] > 0):
+        appendToLogShipQueue(makeLogEntry(lastShippedLog['severity'], \
+            'last message repeated ' + str(lastShippedLog['repeats']) + ' times'))
+        lastShippedLog['repeats'] = 0
+
+
+# Queue a log message to be sent to the server
+def logToServer(severity, message):
+    # Do not send log to server if severity not in the required set
+    if(severity not in "ERROR,WARN,INFO"):
+        return
+    # Anything logged while shipping logs (eg. the upload failing) stays local, 
+    # otherwise an outage would generate ever more logs to ship
+    if(logShipThread is not None and threading.current_thread() is logShipThread):
+        return
+    if('UUID' not in conf or 'server' not in conf):
+        return
+    with logShipLock:
+        if(severity == lastShippedLog['severity'] and message == lastShippedLog['message']):
+            lastShippedLog['repeats'] += 1
+            return
+        flushRepeatedLog()
+        lastShippedLog['severity'] = severity
+        lastShippedLog['message'] = message
+        if(isWithinLogRateLimit(severity)):
+            appendToLogShipQueue(makeLogEntry(severity, message))
+        isBatchFull = len(logShipQueue) >= int(conf.get('logShipBatchItems', 50))
+    startLogShipper()
+    if(isBatchFull):
+        logShipWakeup.set()
     return
 
+
+# Upload everything queued, in batches. Returns False if the server could not be reached
+def shipQueuedLogs():
+    with logShipLock:
+        flushRepeatedLog()
+        lastShippedLog['message'] = None
+    while True:
+        with logShipLock:
+            batchItems = int(conf.get('logShipBatchItems', 50))
+            batch = [logShipQueue.popleft() for i in range(min(batchItems, len(logShipQueue)))]
+        if(len(batch) == 0):
+            return True
+        r = sendLogToServer(batch)
+        if(r.status_code >= 400 and r.status_code < 500):
+            # A 4xx will never succeed so the batch is dropped rather than blocking those after it
+            with logShipLock:
+                logShipStats['failedUploads'] += 1
+                logShipStats['linesRejected'] += len(batch)
+            log("Server rejected " + str(len(batch)) + " log lines: " + str(r.status_code))
+            continue
+        if(r.status_code != 200):
+            with logShipLock:
+                logShipStats['failedUploads'] += 1
+                # Put the batch back at the front, while there is room, to retry next time
+                for logEntry in reversed(batch):
+                    if(len(logShipQueue) >= int(conf.get('logShipMaxQueue', 500))):
+                        logShipStats['linesDropped'] += 1
+                        continue
+                    logShipQueue.appendleft(logEntry)
+            return False
+        with logShipLock:
+            logShipStats['linesShipped'] += len(batch)
+
+
+def runLogShipper():
+    while True:
+        logShipWakeup.wait(float(conf.get('logShipInterval', 10)))
+        try:
+            shipQueuedLogs()
+        except Exception as e:
+            print "Error: Shipping logs to server failed " + str(e)
+
+
+def startLogShipper():
+    global logShipThread
+    with logShipLock:
+        if(logShipThread is None):
+            logShipThread = threading.Thread(target=runLogShipper, name='davra-log-shipper')
+            logShipThread.daemon = True
+            logShipThread.start()
+    return
+
+
+def getLogShipStats():
+    with logShipLock:
+        stats = dict(logShipStats)
+        stats['linesQueued'] = len(logShipQueue)
+    return stats
+
+
 # Send various severities of log messages with easy function names
 def logDebug(log_msg):
     log(log_msg, "DEBUG")
@@ -105,32 +481,307 @@ def logWarning(log_msg):
 def logError(log_msg):
     log(log_msg, "ERROR")
 
+###########################   LOG FILE
+
+# Log lines are buffered in memory and written through one open file handle.
+# The file is rotated in-process when it gets too big or too old, keeping a number of
+# gzip compressed generations (davra_agent.log.1.gz is the most recent). The rotated log is
+# renamed to davra_agent.log.rotated.<millis> and compressed by a background thread.
+# Both the agent and setup may write to the log, so writes and rotation are done under
+# an flock and a writer re-opens the file if another process has rotated it.
+# Tunable in config.json:
+#   logMaxBytes: size at which the log is rotated (default 10000000)
+#   logMaxGenerations: how many rotated logs to keep (default 3)
+#   logRotateInterval: seconds after which the log is rotated regardless of size, 0 to disable (default 0)
+#   logFlushInterval: seconds buffered lines may wait before being written (default 1)
+#   logFlushSeverity: lines of this severity or above are written immediately (default "WARN")
+logFileName = "davra_agent.log"
+logSeverityOrder = {"DEBUG": 0, "INFO": 1, "WARN": 2, "ERROR": 3}
+logWriterLock = threading.Lock()
+logWriterThread = None
+logWriterWakeup = WakeupSignal() # Set when lines are buffered for the writer thread
+logFile = None
+logFileOpenedTime = 0
+logBuffer = []
+maxBufferedLogLines = 10000
+lastLogFlushTime = 0
+
+
+def getLogFilePath():
+    return logDir + "/" + logFileName
+
+
+# Call with logWriterLock held. Open the log if needed, or again if it was rotated by another process
+def openLogFile():
+    global logFile, logFileOpenedTime
+    logFilePath = getLogFilePath()
+    if(logFile is not None):
+        try:
+            if(os.fstat(logFile.fileno()).st_ino == os.stat(logFilePath).st_ino):
+                return
+        except OSError:
+            pass
+        logFile.close()
+    logFile = open(logFilePath, "a")
+    logFileOpenedTime = time.time()
+
+
+# Call with logWriterLock and the flock held. Move the current log aside so writers open a fresh one.
+# It is compressed on a background thread, so logging does not wait for the gzip
+def rotateLogFile():
+    logFilePath = getLogFilePath()
+    if(int(conf.get('logMaxGenerations', 3)) > 0):
+        os.rename(logFilePath, logFilePath + ".rotated." + str(int(time.time() * 1000)))
+        compressThread = threading.Thread(target=compressRotatedLogs, name='davra-log-compress')
+        compressThread.daemon = True
+        compressThread.start()
+    else:
+        os.remove(logFilePath)
+
+
+# Shift the generations along and compress each log moved aside by rotateLogFile, oldest first.
+# Also picks up any left by a process which stopped before compressing them.
+# One process at a time, under an flock of its own so writers are not held up
+def compressRotatedLogs():
+    logFilePath = getLogFilePath()
+    maxGenerations = int(conf.get('logMaxGenerations', 3))
+    try:
+        with open(logFilePath + ".rotate.lock", "a") as rotateLockFile:
+            fcntl.flock(rotateLockFile, fcntl.LOCK_EX)
+            rotatedPrefix = os.path.basename(logFilePath) + ".rotated."
+            for rotatedName in sorted([name for name in os.listdir(logDir) if name.startswith(rotatedPrefix)]):
+                for generation in range(maxGenerations, 0, -1):
+                    generationFile = logFilePath + "." + str(generation) + ".gz"
+                    if(os.path.isfile(generationFile)):
+                        if(generation == maxGenerations):
+                            os.remove(generationFile)
+                        else:
+                            os.rename(generationFile, logFilePath + "." + str(generation + 1) + ".gz")
+                with open(logDir + "/" + rotatedName, "rb") as rawFile:
+                    compressedFile = gzip.open(logFilePath + ".1.gz.tmp", "wb")
+                    try:
+                        shutil.copyfileobj(rawFile, compressedFile)
+                    finally:
+                        compressedFile.close()
+                os.rename(logFilePath + ".1.gz.tmp", logFilePath + ".1.gz")
+                os.remove(logDir + "/" + rotatedName)
+    except Exception as e:
+        print "Error: Compressing rotated log failed " + str(e)
+
+
+# Write all buffered lines to the log file
+def flushLogFile():
+    with logWriterLock:
+        flushLogFileLocked()
+
+
+# Call with logWriterLock held
+def flushLogFileLocked():
+    global logBuffer, lastLogFlushTime
+    lastLogFlushTime = time.time()
+    if(len(logBuffer) == 0):
+        return
+    lines = ''.join(logBuffer)
+    try:
+        while True:
+            openLogFile()
+            fcntl.flock(logFile, fcntl.LOCK_EX)
+            # Another process may have rotated the log while waiting for the lock
+            if(os.fstat(logFile.fileno()).st_ino == os.stat(getLogFilePath()).st_ino):
+                break
+            fcntl.flock(logFile, fcntl.LOCK_UN)
+        lockedFile = logFile
+        try:
+            logFile.write(lines)
+            logFile.flush()
+            # Only now, so the lines are written next time if this write failed
+            logBuffer = []
+            rotateInterval = float(conf.get('logRotateInterval', 0))
+            if(os.fstat(logFile.fileno()).st_size > int(conf.get('logMaxBytes', 10000000)) \
+            or (rotateInterval > 0 and time.time() - logFileOpenedTime > rotateInterval)):
+                # The next flush notices the log has moved and opens a fresh one
+                rotateLogFile()
+        finally:
+            fcntl.flock(lockedFile, fcntl.LOCK_UN)
+    except Exception as e:
+        print "Error: Logging to file failed " + str(e)
+        # Keep the most recent lines while the log cannot be written, eg. the disk is full
+        del logBuffer[:-maxBufferedLogLines]
+
+
+# Buffer a line for the log file. It is written straight away if it is important enough
+# or the buffer has waited long enough, otherwise the writer thread writes it shortly
+def writeToLogFile(line, severity):
+    with logWriterLock:
+        logBuffer.append(line)
+        flushSeverity = conf.get('logFlushSeverity', 'WARN')
+        if(logSeverityOrder.get(severity, 0) >= logSeverityOrder.get(flushSeverity, 2) \
+        or time.time() - lastLogFlushTime >= float(conf.get('logFlushInterval', 1))):
+            flushLogFileLocked()
+            return
+        isFirstBuffered = len(logBuffer) == 1
+    if(logWriterThread is None):
+        startLogWriter()
+    if(isFirstBuffered):
+        logWriterWakeup.set()
+
+
+# Sleeps until lines are buffered, then writes them once they have waited logFlushInterval,
+# so an idle agent does not wake to write nothing
+def runLogWriter():
+    while True:
+        with logWriterLock:
+            waitTime = None
+            if(len(logBuffer) > 0):
+                waitTime = lastLogFlushTime + float(conf.get('logFlushInterval', 1)) - time.time()
+        if(waitTime is not None and waitTime <= 0):
+            flushLogFile()
+        else:
+            logWriterWakeup.wait(waitTime)
+
+
+def startLogWriter():
+    global logWriterThread
+    with logWriterLock:
+        if(logWriterThread is None):
+            logWriterThread = threading.Thread(target=runLogWriter, name='davra-log-writer')
+            logWriterThread.daemon = True
+            logWriterThread.start()
+    return
+
+
 # Log a message to disk and console
 def log(log_msg, severity = "DEBUG"):
     log_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     log_msg = str(log_msg)
-    try:
-        file_size = os.path.getsize(logDir + "/davra_agent.log")
-    except:
-        os.system("touch " + logDir + "/davra_agent.log")
     try:
         print(log_time + ": " + log_msg) # Echo to stdout as well as the file
-        if file_size > 10000000:
-            os.system("mv " + logDir + "/davra_agent.log " + logDir + "/davra_agent.log.old")
-        logfile = open(logDir + "/davra_agent.log", "a")
-        logfile.write(log_time + ": " + log_msg + "\n")
-        logfile.close()
+        writeToLogFile(log_time + ": " + log_msg + "\n", severity)
         # Only send log to server if above the log level required
         logToServer(severity, log_msg)
     except Exception as e:
         print "Error: Logging to file failed " + str(e)
 
 
+# Buffered log lines are written when the program exits
+atexit.register(flushLogFile)
+
+
+###########################   HTTP CLIENT
+
+# All http calls to the server share one pooled session so the TCP/TLS connection
+# is kept alive and reused between calls rather than a new handshake for each request.
+# Tunable in config.json:
+#   httpPoolSize: how many connections to keep open per host (default 4)
+#   httpTimeout: seconds before a request is abandoned (default 20)
+#   httpTimeouts: per-endpoint overrides, eg. {"/api/v1/logs": 5}
+#   httpCompression: Content-Encoding for request bodies, "gzip" (default), "deflate" or "none".
+#     If the server refuses a compressed body (415 Unsupported Media Type), it is sent again
+#     uncompressed and bodies to that server are not compressed again until the agent restarts
+#   httpCompressMinBytes: bodies smaller than this are sent uncompressed (default 1024)
+httpSession = None
+httpSessionLock = threading.Lock()
+httpStats = {"requests": 0, "failures": 0, "totalLatencyMs": 0, "maxLatencyMs": 0, \
+    "bodyBytes": 0, "wireBytes": 0, "compressedBodies": 0}
+cachedHeaders = None
+compressionRefusedBy = set() # Servers which did not accept a compressed body
+
+
+def getHttpSession():
+    global httpSession
+    with httpSessionLock:
+        if(httpSession is None):
+            poolSize = int(conf.get('httpPoolSize', 4))
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            httpSession = session
+    return httpSession
+
+
+# Drop the pooled session (eg. after the server location changes). It is recreated on next use.
+def resetHttpSession():
+    global httpSession
+    with httpSessionLock:
+        if(httpSession is not None):
+            httpSession.close()
+        httpSession = None
+
+
+# How long to wait for a particular endpoint. The longest matching entry in httpTimeouts wins
+def getTimeoutForDestination(destination):
+    timeout = conf.get('httpTimeout', 20)
+    matchedLength = 0
+    for endpoint, endpointTimeout in conf.get('httpTimeouts', {}).items():
+        if(endpoint in destination and len(endpoint) > matchedLength):
+            timeout = endpointTimeout
+            matchedLength = len(endpoint)
+    return float(timeout)
+
+
+# Returns counters for the http client. 
+# connectionsOpened vs requests shows how often a kept-alive connection was reused.
+def getHttpStats():
+    stats = dict(httpStats)
+    connectionsOpened = 0
+    if(httpSession is not None):
+        for adapter in httpSession.adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if(pool is not None):
+                    connectionsOpened += pool.num_connections
+    stats['connectionsOpened'] = connectionsOpened
+    stats['connectionsReused'] = max(0, stats['requests'] - stats['failures'] - connectionsOpened)
+    stats['avgLatencyMs'] = (stats['totalLatencyMs'] / stats['requests']) if stats['requests'] > 0 else 0
+    # Bytes of request bodies before and after compression
+    stats['compressionRatio'] = round(float(stats['wireBytes']) / stats['bodyBytes'], 3) if stats['bodyBytes'] > 0 else 1.0
+    return stats
+
+
+def recordHttpRequest(latencyMs, failed):
+    with httpSessionLock:
+        httpStats['requests'] += 1
+        httpStats['totalLatencyMs'] += latencyMs
+        httpStats['maxLatencyMs'] = max(httpStats['maxLatencyMs'], latencyMs)
+        if(failed):
+            httpStats['failures'] += 1
+
+
+def recordHttpBody(bodyBytes, wireBytes):
+    with httpSessionLock:
+        httpStats['bodyBytes'] += bodyBytes
+        httpStats['wireBytes'] += wireBytes
+        if(wireBytes != bodyBytes):
+            httpStats['compressedBodies'] += 1
+
+
+# The host part of a url, eg. "https://api.davra.com"
+def getServerOfDestination(destination):
+    return '/'.join(destination.split('/')[:3])
+
+
+# Returns the body to send and its Content-Encoding, or None if it is not worth compressing
+def compressRequestBody(body, destination):
+    encoding = conf.get('httpCompression', 'gzip')
+    if(encoding not in ['gzip', 'deflate'] or len(body) < int(conf.get('httpCompressMinBytes', 1024)) \
+    or getServerOfDestination(destination) in compressionRefusedBy):
+        return (body, None)
+    if(encoding == 'gzip'):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return (compressor.compress(body) + compressor.flush(), 'gzip')
+    return (zlib.compress(body, 6), 'deflate')
+
+
+# The headers only change if the api token changes so build them once
 def getHeadersForRequests():
-    headersTmp = {'Accept' : 'application/json', \
-        'Content-Type' : 'application/json', \
-        'Authorization': 'Bearer ' + conf['apiToken']}
-    return headersTmp
+    global cachedHeaders
+    if(cachedHeaders is None or cachedHeaders['Authorization'] != 'Bearer ' + conf['apiToken']):
+        cachedHeaders = {'Accept' : 'application/json', \
+            'Content-Type' : 'application/json', \
+            'Authorization': 'Bearer ' + conf['apiToken']}
+    return cachedHeaders
 
 
 def createMetricOnServer(metricName, metricUnits, metricDescription):
@@ -157,73 +808,85 @@ def sendLogToServer(dataToSend):
     responseFromServer = httpPut(conf['server'] + '/api/v1/logs', dataToSend)
     return(responseFromServer)
 
+# Logs still queued are sent when the program exits
+atexit.register(shipQueuedLogs)
+
 
 # For when a http request fails, use this to return a similar object
 class emptyRequestsObject(object):
     status_code = 500
     content = ""
 
-# Make a http request of type PUT
-# Supply the destination API endpoint as string and the dataToSend as JSON object
-def httpPut(destination, dataToSend):
+# Make a http request through the pooled session
+# Supply the method (eg. "PUT"), destination API endpoint as string and optionally the dataToSend as JSON object
+def httpRequest(method, destination, dataToSend = None):
     headers = getHeadersForRequests()
+    body = json.dumps(dataToSend, separators=(',', ':')) if dataToSend is not None else None
+    wireBody = body
+    if(body is not None):
+        (wireBody, encoding) = compressRequestBody(body, destination)
+        if(encoding is not None):
+            headers = dict(headers, **{'Content-Encoding': encoding})
+    startTime = time.time()
     try:
-        r = requests.put(destination, data=json.dumps(dataToSend), headers=headers, timeout=20)
+        r = getHttpSession().request(method, destination, data=wireBody, headers=headers, \
+            timeout=getTimeoutForDestination(destination))
+        recordHttpRequest(int((time.time() - startTime) * 1000), False)
+        if(wireBody is not body and r.status_code == 415):
+            # The server does not take compressed bodies. Send this one again as it is
+            logWarning('Server refused a compressed body, sending uncompressed from now on: ' + str(r.status_code))
+            compressionRefusedBy.add(getServerOfDestination(destination))
+            return httpRequest(method, destination, dataToSend)
+        if(body is not None):
+            recordHttpBody(len(body), len(wireBody))
         if (r.status_code == 200):
-            #print('Sent data to server ' + r.content)
             return(r)
         else:
-            log("Issue while sending data to server. " + str(r))
+            log("Issue while making http " + method + " to server. " + str(r))
             return(r)
     except Exception as e:
-        log('Failed to make http PUT:' + str(destination) + " : " \
-        + json.dumps(dataToSend) + " \n Error: " + str(e))
+        recordHttpRequest(int((time.time() - startTime) * 1000), True)
+        log('Failed to make http ' + method + ':' + str(destination) + " : " \
+        + (body if body is not None else "") + " \n Error: " + str(e))
         return(emptyRequestsObject())
 
 
+# Make a http request of type PUT
+# Supply the destination API endpoint as string and the dataToSend as JSON object
+def httpPut(destination, dataToSend):
+    return httpRequest('PUT', destination, dataToSend)
+
 
 # Make a http request of type POST
 # Supply the destination API endpoint as string and the dataToSend as JSON object
 def httpPost(destination, dataToSend):
-    headers = getHeadersForRequests()
-    try:
-        r = requests.post(destination, data=json.dumps(dataToSend), headers=headers, timeout=20)
-        if (r.status_code == 200):
-            #print('Sent data to server ' + r.content)
-            return(r)
-        else:
-            log("Issue while sending data to server. " + str(r))
-            return(r)
-    except Exception as e:
-        log('Failed to make http PUT:' + str(destination) + " : " \
-        + json.dumps(dataToSend) + " \n Error: " + str(e))
-        return(emptyRequestsObject())
+    return httpRequest('POST', destination, dataToSend)
 
 
 # Make a http request of type GET
 # Supply the destination API endpoint as string
 def httpGet(destination):
-    headers = getHeadersForRequests()
-    try:
-        r = requests.get(destination, headers=headers, timeout=20)
-        if (r.status_code == 200):
-            return(r)
-        else:
-            log("Issue while making http GET. " + str(r))
-            return(r)
-    except Exception as e:
-        log('Failed to make http GET:' + str(destination) + " : \n Error: " + str(e))
-        return(emptyRequestsObject())
+    return httpRequest('GET', destination)
 
 
 # Send the device capabilities from config file up to server at /api/v1/devices
-def reportDeviceCapabilities():
-    headers = getHeadersForRequests()
-    dataToSend = { "capabilities": conf["capabilities"] }
+# Skipped if they are unchanged since last reported, unless force is True
+def reportDeviceCapabilities(force = False):
+    capabilities = conf["capabilities"] if conf.has_key("capabilities") else {}
+    capabilitiesHash = hashContent(capabilities)
+    with reportedStateLock:
+        isReported = getReportedState()["capabilities"] == capabilitiesHash
+    if(isReported and force is False):
+        log('Device capabilities unchanged since last reported to server')
+        return(200)
+    dataToSend = { "capabilities": capabilities }
     log('Reporting device capabilities to server ' + str(dataToSend))
     r = httpPut(conf['server'] + '/api/v1/devices/' + conf["UUID"], dataToSend)
     if (r.status_code == 200):
         log('Reported device capabilities to server ' + r.content)
+        with reportedStateLock:
+            getReportedState()["capabilities"] = capabilitiesHash
+            saveReportedState()
         return(r.status_code)
     else:
         log("Issue while reporting capabilities to server. " + str(r.status_code))
@@ -231,28 +894,83 @@ def reportDeviceCapabilities():
         return(r.status_code) 
 
 
+# Confirm the server still holds the capabilities last reported, eg. in case the device was
+# edited on the server, by comparing hashes. They are only uploaded again if they differ
+def checkDeviceCapabilitiesOnServer():
+    r = httpGet(conf['server'] + '/api/v1/devices/' + conf['UUID'])
+    if (r.status_code != 200 or json.loads(r.content)['totalRecords'] != 1):
+        log("Issue while getting device capabilities from server: " + str(r.status_code))
+        return(r.status_code)
+    serverCapabilities = json.loads(r.content)['records'][0].get('capabilities') or {}
+    capabilities = conf["capabilities"] if conf.has_key("capabilities") else {}
+    if(hashContent(serverCapabilities) == hashContent(capabilities)):
+        with reportedStateLock:
+            getReportedState()["capabilities"] = hashContent(capabilities)
+            saveReportedState()
+        return(200)
+    log('Device capabilities on server differ from this device')
+    return reportDeviceCapabilities(force = True)
+
+
+# The capabilities are reported to the server once registrations have settled, so an app
+# (or the agent) registering several capabilities in a row costs one request.
+# Tunable in config.json:
+#   capabilityReportDelay: seconds to wait for further registrations before reporting (default 1)
+capabilitiesReport = DebouncedCall('davra-capabilities-report', reportDeviceCapabilities, \
+    lambda: float(conf.get('capabilityReportDelay', 1)))
+atexit.register(capabilitiesReport.flush)
+
+
+# Update (or insert) several capabilities for this device. capabilities is a dict of name to details.
+# Capabilities which are unchanged are skipped. Returns the names of those which changed
+def registerDeviceCapabilities(capabilities):
+    changedNames = []
+    with configTransaction():
+        listCapabilities = dict(conf["capabilities"]) if conf.has_key("capabilities") else {}
+        for itemKey, itemValue in capabilities.items():
+            # An execution profile set on the device is kept when the capability is registered again
+            previousValue = listCapabilities.get(itemKey)
+            if(type(previousValue) == type({}) and 'executionProfile' in previousValue \
+            and type(itemValue) == type({}) and 'executionProfile' not in itemValue):
+                itemValue = dict(itemValue, executionProfile = previousValue['executionProfile'])
+            # If the capability was already known (and in the config.info)
+            if(listCapabilities.has_key(itemKey) == False or listCapabilities[itemKey] != itemValue):
+                listCapabilities[itemKey] = itemValue
+                changedNames.append(itemKey)
+        if(len(changedNames) > 0):
+            log('registerDeviceCapabilities : new or changed capabilities ' + str(changedNames))
+            upsertConfigurationItem("capabilities", listCapabilities)
+            capabilitiesReport.schedule()
+    return changedNames
+
+
 # Update (or insert) a configuration item with a capability for this device
 def registerDeviceCapability(itemKey, itemValue):
     logInfo('registerDeviceCapability ' + str(itemKey) + ': ' + str(itemValue));
-    listCapabilities = conf["capabilities"] if conf.has_key("capabilities") else {}
-    # If the capability was already known (and in the config.info)
-    if(listCapabilities.has_key(itemKey) == False or listCapabilities[itemKey] != itemValue):
-        log('registerDeviceCapability : this is a new capability')
-        listCapabilities[itemKey] = itemValue
-        upsertConfigurationItem("capabilities", listCapabilities)
-        reportDeviceCapabilities()
+    registerDeviceCapabilities({itemKey: itemValue})
     return;
 
 
+# Delete configuration items of capabilities for this device. Returns the names which were removed
+def unregisterDeviceCapabilities(capabilityNames):
+    removedNames = []
+    with configTransaction():
+        listCapabilities = dict(conf["capabilities"]) if conf.has_key("capabilities") else {}
+        for itemKey in capabilityNames:
+            # If the capability was already known (and in the config.info)
+            if(listCapabilities.has_key(itemKey) == True):
+                listCapabilities.pop(itemKey)
+                removedNames.append(itemKey)
+        if(len(removedNames) > 0):
+            upsertConfigurationItem("capabilities", listCapabilities)
+            capabilitiesReport.schedule()
+    return removedNames
+
+
 # Delete a configuration item of a capability for this device
 def unregisterDeviceCapability(itemKey):
     logInfo('unregisterDeviceCapability ' + str(itemKey));
-    listCapabilities = conf["capabilities"] 
-    # If the capability was already known (and in the config.info)
-    if(listCapabilities.has_key(itemKey) == True):
-        listCapabilities.pop(itemKey)
-        upsertConfigurationItem("capabilities", listCapabilities)
-        reportDeviceCapabilities()
+    unregisterDeviceCapabilities([itemKey])
     return;
 
 
@@ -299,28 +1017,160 @@ def runNativeCommandLine(strCommandLine):
     return runNativeCommand(strCommandLine.split())
 
 
-# Execute command line and return the exit code and stdout
-# scriptResponse is a tuple of (exitStatusCode, stdout)
-def runCommandWithTimeout(command, timeout):
-    timeout = int(timeout)
+###########################   COMMAND EXECUTION
+
+# Commands are run with their output (stdout and stderr together, in the order written) read as
+# it is produced, so a command writing more than a pipe buffer never blocks on a full pipe.
+# Memory is bounded however much is written: the start and the end of the output are kept and
+# the middle is replaced by a marker saying how much was left out.
+# Tunable in config.json:
+#   commandOutputHeadBytes: bytes kept from the start of the output (default 16384)
+#   commandOutputTailBytes: bytes kept from the end of the output (default 49152)
+#   executionProfile: how work launched for jobs is run so it cannot starve the agent, see
+#     davra_supervisor for the settings. Merged over defaultExecutionProfile
+#   executionProfiles: dict of capability name to the settings which override executionProfile
+#     for work launched for that capability, eg. {"agent-action-runScriptBash": {"nice": 19}}.
+#     "executionProfile" in the capability details is also honoured, and kept when the agent
+#     registers its capabilities again
+
+class CommandOutput(object):
+    def __init__(self, headBytes, tailBytes):
+        self.headBytes = headBytes
+        self.tailBytes = tailBytes
+        self.head = ''
+        self.tail = collections.deque()
+        self.tailSize = 0
+        self.progress = collections.deque() # Output since takeProgress was last called, bounded like the tail
+        self.progressSize = 0
+        self.totalBytes = 0
+
+    def add(self, chunk):
+        self.totalBytes += len(chunk)
+        self.progressSize = self.addBounded(self.progress, self.progressSize, chunk)
+        if(len(self.head) < self.headBytes):
+            headPart = chunk[:self.headBytes - len(self.head)]
+            self.head += headPart
+            chunk = chunk[len(headPart):]
+        if(len(chunk) > 0):
+            self.tailSize = self.addBounded(self.tail, self.tailSize, chunk)
+
+    # Append a chunk to a deque of chunks, dropping the oldest bytes beyond tailBytes. Returns the new size
+    def addBounded(self, chunks, size, chunk):
+        chunks.append(chunk)
+        size += len(chunk)
+        while(size > self.tailBytes):
+            excess = size - self.tailBytes
+            if(len(chunks[0]) <= excess):
+                size -= len(chunks.popleft())
+            else:
+                chunks[0] = chunks[0][excess:]
+                size -= excess
+        return size
+
+    # The output since the previous call, or '' if none
+    def takeProgress(self):
+        progress = ''.join(self.progress)
+        self.progress.clear()
+        self.progressSize = 0
+        return progress
+
+    def getText(self):
+        tail = ''.join(self.tail)
+        omittedBytes = self.totalBytes - len(self.head) - len(tail)
+        if(omittedBytes > 0):
+            return self.head + '\n... [' + str(omittedBytes) + ' bytes of output omitted] ...\n' + tail
+        return self.head + tail
+
+
+defaultExecutionProfile = {"nice": 10, "ioClass": "best-effort", "ioLevel": 7}
+
+
+# The execution profile for work launched for a capability, or the general profile if None
+def getExecutionProfile(capabilityName = None):
+    profile = dict(defaultExecutionProfile)
+    profile.update(conf.get('executionProfile', {}))
+    capabilityDetails = conf.get('capabilities', {}).get(capabilityName) if capabilityName else None
+    if(type(capabilityDetails) == type({})):
+        profile.update(capabilityDetails.get('executionProfile', {}))
+    if(capabilityName):
+        profile.update(conf.get('executionProfiles', {}).get(capabilityName, {}))
+    return profile
+
+
+# Run a command, reading its output as it is produced. Returns as soon as the command exits.
+# The command runs under davra_supervisor in its own process group. On timeout the whole group
+# is sent SIGTERM, then SIGKILL after commandKillGraceSeconds (default 5).
+# If given, onProgress(newOutput) is called at most every progressInterval seconds while
+# the command runs with the output produced since the previous call.
+# executionProfile (eg. from getExecutionProfile) limits the priority and resources of the command.
+# Returns a tuple of (exitStatusCode, output, resourceUsage). exitStatusCode is -1 if the 
+# command timed out. resourceUsage is a dict of the cpu seconds, peak memory and elapsed time
+def runCommandStreaming(command, timeout, onProgress = None, progressInterval = 10, executionProfile = None):
+    timeout = float(timeout)
     log("Running command with timeout " + command + " timeout:" + str(timeout))
-    p = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    while timeout > 0:
-        exitStatusCode = p.poll()
-        if exitStatusCode is not None:
-            # Command finished running (exitStatusCode is 0 when ok)
-            log("command finished. Exit code: " + str(exitStatusCode))
-            return (exitStatusCode, p.communicate()[0])
-        time.sleep(0.1)
-        timeout -= 0.1
-    else:
-        # Script has timed out so kill it
+    output = CommandOutput(int(conf.get('commandOutputHeadBytes', 16384)), \
+        int(conf.get('commandOutputTailBytes', 49152)))
+    process = davra_supervisor.startProcess(command, executionProfile)
+    outputFd = process.popen.stdout.fileno()
+    fcntl.fcntl(outputFd, fcntl.F_SETFL, fcntl.fcntl(outputFd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    deadline = process.startTime + timeout
+    nextProgressTime = process.startTime + float(progressInterval) if onProgress is not None else None
+    isOutputOpen = True
+    isTimedOut = False
+    while True:
+        now = time.time()
+        if(now >= deadline):
+            log("command timed out, stopping it")
+            isTimedOut = True
+            if(process.stop(float(conf.get('commandKillGraceSeconds', 5))) is False):
+                # Left for the reaper to collect whenever it does exit
+                break
+        if(nextProgressTime is not None and now >= nextProgressTime):
+            nextProgressTime = now + float(progressInterval)
+            progress = output.takeProgress()
+            if(len(progress) > 0):
+                onProgress(progress)
+        if(process.hasExited()):
+            break
+        # Sleep until there is output or the command exits
+        waitTime = min(deadline, nextProgressTime or deadline) - now
         try:
-            p.kill()
-        except OSError as e:
-            if e.errno != 3:
+            readable = select.select([process.exitFd] + ([outputFd] if isOutputOpen else []), [], [], \
+                max(0, waitTime))[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
                 raise
-    return (-1, None)
+            continue
+        if(outputFd in readable):
+            isOutputOpen = readCommandOutput(outputFd, output)
+    # Pick up anything written just before the command exited
+    if(isOutputOpen and process.hasExited()):
+        readCommandOutput(outputFd, output)
+    process.close()
+    # Output after the last progress call is in the returned output, so it is not sent as progress
+    exitStatusCode = -1 if isTimedOut else process.exitStatusCode
+    log("command finished. Exit code: " + str(exitStatusCode) + ". Usage: " + json.dumps(process.resourceUsage))
+    return (exitStatusCode, output.getText(), process.resourceUsage)
+
+
+# Read what output is available without blocking. Returns False once the output has closed
+def readCommandOutput(outputFd, output):
+    try:
+        while True:
+            chunk = os.read(outputFd, 65536)
+            if(chunk == ''):
+                return False
+            output.add(chunk)
+    except OSError as e:
+        if e.errno != errno.EAGAIN:
+            raise
+    return True
+
+
+# Execute command line and return the exit code and stdout
+# scriptResponse is a tuple of (exitStatusCode, stdout)
+def runCommandWithTimeout(command, timeout, executionProfile = None):
+    return runCommandStreaming(command, timeout, executionProfile = executionProfile)[:2]
 
 
 # Returns operating system detail
@@ -333,41 +1183,40 @@ def getOperatingSystem():
 
 
 
+# System metrics are read from /proc by davra_metrics rather than running free, ps and uptime
+
 def getRam():
     #Returns a tuple (total ram, available ram) in megabytes.
     try:
-        s = subprocess.check_output(["free", "-m"])
-        lines = s.split("\n")
-        return ( int(lines[1].split()[1]), int(lines[2].split()[3]) )
+        return davra_metrics.getRam()
     except:
-        return 0
+        return (0, 0)
 
 def getProcessCount():
     #Returns the number of processes.
     try:
-        s = subprocess.check_output(["ps","-e"])
-        return len(s.split("\n"))
+        return davra_metrics.getProcessCount()
     except:
         return 0
 
 def getUptime():
     #Returns a tuple (uptime, 1 min load average).
     try:
-        s = subprocess.check_output(["uptime"])
-        load_split = s.split("load average: ")
-        load_one = float(load_split[1].split(",")[0])
-        up = load_split[0]
-        up_pos = up.rfind(",", 0, len(up)-4)
-        up = up[:up_pos].split("up ")[1]
-        return (up, load_one)
+        return (davra_metrics.getUptimeText(), davra_metrics.getLoadAverage()[0])
     except:
         return ("", 0)
 
 def getUptimeProcess():
     # Returns uptime in seconds
     try:
-        s = subprocess.check_output(["cat", "/proc/uptime"])
-        return int(float(s.split(" ")[0]))
+        return int(davra_metrics.getUptimeSeconds())
+    except:
+        return 0
+
+def getCpuPercent():
+    # Returns cpu usage percentage since the previous call
+    try:
+        return davra_metrics.getCpuPercent()
     except:
         return 0
 
@@ -0,0 +1,260 @@
+# Davra Metrics
+# Reads system metrics straight from /proc rather than running programs like free, ps and uptime.
+# The system wide /proc files are kept open and re-read from the start on each call,
+# so taking a reading costs a seek and a read, with no process spawned.
+#
+import os
+import time
+import array
+import threading
+
+
+procFiles = {} # Open file handles of /proc files, by path
+procFilesLock = threading.Lock()
+lastCpuTimes = None # (busy, total) jiffies at the previous getCpuPercent call
+clockTicksPerSecond = os.sysconf('SC_CLK_TCK') if 'SC_CLK_TCK' in os.sysconf_names else 100
+pageSizeBytes = os.sysconf('SC_PAGE_SIZE') if 'SC_PAGE_SIZE' in os.sysconf_names else 4096
+
+
+# Read the current content of a system wide /proc file, reusing the open handle
+def readProcFile(path):
+    with procFilesLock:
+        procFile = procFiles.get(path)
+        try:
+            if(procFile is None):
+                procFile = open(path)
+                procFiles[path] = procFile
+            procFile.seek(0)
+            return procFile.read()
+        except (IOError, OSError):
+            if(procFile is not None):
+                procFile.close()
+            procFiles.pop(path, None)
+            raise
+
+
+# Returns /proc/meminfo as a dict of name to value in kB
+def getMemInfo():
+    memInfo = {}
+    for line in readProcFile('/proc/meminfo').splitlines():
+        parts = line.split()
+        if(len(parts) >= 2):
+            memInfo[parts[0].rstrip(':')] = int(parts[1])
+    return memInfo
+
+
+# Returns a tuple (total ram, available ram) in megabytes
+def getRam():
+    memInfo = getMemInfo()
+    if('MemAvailable' in memInfo):
+        available = memInfo['MemAvailable']
+    else:
+        # Older kernels do not estimate available memory, so approximate it
+        available = memInfo.get('MemFree', 0) + memInfo.get('Buffers', 0) + memInfo.get('Cached', 0)
+    return (memInfo.get('MemTotal', 0) / 1024, available / 1024)
+
+
+# Returns a tuple of the 1, 5 and 15 minute load averages
+def getLoadAverage():
+    parts = readProcFile('/proc/loadavg').split()
+    return (float(parts[0]), float(parts[1]), float(parts[2]))
+
+
+# Returns seconds since boot as a float
+def getUptimeSeconds():
+    return float(readProcFile('/proc/uptime').split()[0])
+
+
+# Returns the uptime formatted like the uptime command, eg. "3 days, 4:05"
+def getUptimeText():
+    seconds = int(getUptimeSeconds())
+    days = seconds / 86400
+    hoursAndMinutes = '%d:%02d' % ((seconds % 86400) / 3600, (seconds % 3600) / 60)
+    if(days > 0):
+        return str(days) + (' day, ' if days == 1 else ' days, ') + hoursAndMinutes
+    return hoursAndMinutes
+
+
+# Returns a tuple (busy, total) of cpu time in jiffies since boot, summed over all cpus
+def readCpuTimes():
+    for line in readProcFile('/proc/stat').splitlines():
+        if(line.startswith('cpu ')):
+            times = [int(t) for t in line.split()[1:]]
+            # idle and iowait are the 4th and 5th columns
+            idle = times[3] + (times[4] if len(times) > 4 else 0)
+            # guest time is already counted within user time
+            total = sum(times[:8])
+            return (total - idle, total)
+    return (0, 0)
+
+
+# Percentage of cpu time which was busy between two readings from readCpuTimes
+def calculateCpuPercent(previousCpuTimes, currentCpuTimes):
+    totalDelta = currentCpuTimes[1] - previousCpuTimes[1]
+    if(totalDelta <= 0):
+        return 0.0
+    return round(100.0 * (currentCpuTimes[0] - previousCpuTimes[0]) / totalDelta, 1)
+
+
+# Returns the cpu usage percentage since the previous call (or since boot on the first call)
+def getCpuPercent():
+    global lastCpuTimes
+    currentCpuTimes = readCpuTimes()
+    previousCpuTimes = lastCpuTimes if lastCpuTimes is not None else (0, 0)
+    lastCpuTimes = currentCpuTimes
+    return calculateCpuPercent(previousCpuTimes, currentCpuTimes)
+
+
+# Returns the number of processes running
+def getProcessCount():
+    return len([entry for entry in os.listdir('/proc') if entry.isdigit()])
+
+
+# Returns details of one process from /proc/[pid]:
+# cpu seconds used (user and system), resident memory in kB and number of threads.
+# These files are not kept open as the process may come and go. Returns None if the process is gone
+def getProcessStats(pid):
+    try:
+        with open('/proc/' + str(pid) + '/stat') as statFile:
+            stat = statFile.read()
+        with open('/proc/' + str(pid) + '/statm') as statmFile:
+            statm = statmFile.read().split()
+    except (IOError, OSError):
+        return None
+    # The process name is in brackets and may contain spaces so split after it
+    fields = stat[stat.rfind(')') + 2:].split()
+    return {
+        "userCpuSeconds": float(fields[11]) / clockTicksPerSecond,
+        "systemCpuSeconds": float(fields[12]) / clockTicksPerSecond,
+        "threads": int(fields[17]),
+        "rssKb": int(statm[1]) * pageSizeBytes / 1024
+    }
+
+
+###########################   SAMPLER
+
+# Samples are taken far more often than the heartbeat so short spikes are not missed.
+# Each metric keeps its samples in a fixed size ring, which is summarised (min/max/mean/p95/last)
+# and cleared each time the heartbeat takes the window.
+# The sampler times itself and slows down if sampling costs more than its allowance of cpu.
+# It also records loopLatency: how many ms after it was due the sampler woke, which shows
+# how starved the agent is of cpu, eg. by a script it is running.
+
+class MetricWindow(object):
+    def __init__(self, size):
+        self.samples = array.array('d', [0.0] * size)
+        self.count = 0 # Samples held, up to the size of the ring
+        self.nextIndex = 0
+        self.last = None
+
+    def add(self, value):
+        self.samples[self.nextIndex] = value
+        self.nextIndex = (self.nextIndex + 1) % len(self.samples)
+        self.count = min(self.count + 1, len(self.samples))
+        self.last = value
+
+    # Returns the summary of the samples since the last call, or None if there were none
+    def summarise(self):
+        if(self.count == 0):
+            return None
+        values = sorted(self.samples[:self.count] if self.count < len(self.samples) else self.samples)
+        summary = {
+            "min": values[0],
+            "max": values[-1],
+            "mean": round(sum(values) / len(values), 2),
+            "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+            "last": self.last,
+            "count": self.count
+        }
+        self.count = 0
+        self.nextIndex = 0
+        return summary
+
+
+samplerLock = threading.Lock()
+samplerThread = None
+samplerWindows = {}
+samplerSettings = {"interval": 1.0, "maxCostPercent": 1.0}
+samplerStats = {"samples": 0, "secondsSampling": 0.0, "startTime": 0, "interval": 1.0}
+
+
+# Take one sample of each metric. samplerCpuTimes is kept apart from getCpuPercent
+# so the sampler and other callers do not disturb each other's deltas
+samplerCpuTimes = None
+def takeSample():
+    global samplerCpuTimes
+    currentCpuTimes = readCpuTimes()
+    sample = {"ram": float(getRam()[1])}
+    if(samplerCpuTimes is not None):
+        sample["cpu"] = calculateCpuPercent(samplerCpuTimes, currentCpuTimes)
+    samplerCpuTimes = currentCpuTimes
+    return sample
+
+
+def runSampler():
+    dueTime = time.time()
+    while True:
+        startTime = time.time()
+        try:
+            sample = takeSample()
+            sample["loopLatency"] = round(max(0, startTime - dueTime) * 1000, 1)
+            with samplerLock:
+                for metricName, value in sample.items():
+                    samplerWindows[metricName].add(value)
+        except Exception as e:
+            print "Error: Metric sampling failed " + str(e)
+        with samplerLock:
+            cost = time.time() - startTime
+            samplerStats['samples'] += 1
+            samplerStats['secondsSampling'] += cost
+            # Slow down if a sample costs more than its allowance of the interval
+            interval = samplerStats['interval']
+            if(cost * 100.0 / interval > samplerSettings['maxCostPercent']):
+                samplerStats['interval'] = min(interval * 2, samplerSettings['interval'] * 60)
+            elif(interval > samplerSettings['interval']):
+                samplerStats['interval'] = max(interval / 2, samplerSettings['interval'])
+            interval = samplerStats['interval']
+        dueTime = startTime + interval
+        time.sleep(max(0, dueTime - time.time()))
+
+
+# Start sampling every interval seconds. windowSize is the most samples kept per metric
+# between heartbeats, the oldest are overwritten beyond this
+def startSampler(interval, windowSize, maxCostPercent = 1.0):
+    global samplerThread
+    with samplerLock:
+        if(samplerThread is not None):
+            return
+        samplerSettings['interval'] = float(interval)
+        samplerSettings['maxCostPercent'] = float(maxCostPercent)
+        samplerStats['interval'] = float(interval)
+        samplerStats['startTime'] = time.time()
+        for metricName in ["cpu", "ram", "loopLatency"]:
+            samplerWindows[metricName] = MetricWindow(max(1, int(windowSize)))
+        samplerThread = threading.Thread(target=runSampler, name='davra-metrics-sampler')
+        samplerThread.daemon = True
+        samplerThread.start()
+
+
+def isSamplerRunning():
+    return samplerThread is not None
+
+
+# Returns the summary of each metric since the previous call and starts a new window
+def takeSamplerWindow():
+    with samplerLock:
+        summaries = {}
+        for metricName, window in samplerWindows.items():
+            summary = window.summarise()
+            if(summary is not None):
+                summaries[metricName] = summary
+        return summaries
+
+
+# How much the sampler itself costs, as a percentage of one cpu
+def getSamplerStats():
+    with samplerLock:
+        stats = dict(samplerStats)
+    elapsed = time.time() - stats['startTime']
+    stats['costPercent'] = round(stats['secondsSampling'] * 100.0 / elapsed, 3) if elapsed > 0 else 0
+    return stats
@@ -0,0 +1,23 @@
+#!/bin/bash
+# Run by the service before each start of the agent.
+# After a self-update (see davra_update.py) the new release is on trial until it sends a heartbeat.
+# The agent resets the count of starts once it is up and running its heartbeat.
+# If it is started more than maxStarts times without getting that far, eg. because it crashes on start,
+# the current link is put back to the previous release and the version is not installed again.
+
+installationDir="/usr/bin/davra"
+updateDir="${installationDir}/update"
+maxStarts=3
+
+if [[ -f "${updateDir}/trial" ]]; then
+    starts=$(( $(cat "${updateDir}/trial") + 1 ))
+    echo "${starts}" > "${updateDir}/trial"
+    if [[ ${starts} -gt ${maxStarts} && -L "${updateDir}/previous" ]]; then
+        echo "Agent version $(cat "${updateDir}/trialVersion") failed to start ${maxStarts} times. Rolling back."
+        cat "${updateDir}/trialVersion" >> "${updateDir}/badVersions"
+        ln -sfn "$(readlink "${updateDir}/previous")" "${installationDir}/current.new"
+        mv -T "${installationDir}/current.new" "${installationDir}/current"
+        rm -f "${updateDir}/trial"
+    fi
+fi
+exit 0
@@ -0,0 +1,135 @@
+# Davra Scheduler
+# Runs the agent's periodic work (heartbeats, job checks etc.) from a heap of tasks ordered by
+# when they are next due. The scheduler sleeps until the next task is due rather than waking
+# every second, and can be woken straight away when an event makes a task due now
+# (eg. the server announcing a new job over mqtt).
+# Tasks are scheduled from when they were due rather than when they finished, so intervals do
+# not drift by the time each run takes. Jitter is added afresh to each due time, to an unjittered
+# base, so it does not accumulate either. A trigger runs a task early without moving its regular
+# schedule, and one which arrives while the task is running runs it again straight after. Lateness (how long after being due a task started) is
+# recorded per task.
+#
+import heapq
+import itertools
+import random
+import threading
+import time
+import davra_lib as comDavra
+
+
+schedulerLock = threading.Lock()
+schedulerWakeup = comDavra.WakeupSignal()
+taskQueue = [] # Heap of (dueTime, sequence, taskName)
+taskSequence = itertools.count() # Keeps heap order stable for tasks due at the same time
+tasks = {}
+
+
+# Register a function to be run every interval seconds.
+# jitter: up to this many seconds are randomly added to each interval, to spread load from a fleet of devices
+# deadline: if the task starts more than this many seconds late, it is logged as missing its deadline
+# runNow: run the task as soon as the scheduler starts rather than after the first interval
+def registerTask(taskName, functionToRun, interval, jitter = 0, deadline = None, runNow = True):
+    with schedulerLock:
+        dueTime = time.time() if runNow else time.time() + float(interval)
+        tasks[taskName] = {
+            "function": functionToRun,
+            "interval": float(interval),
+            "jitter": float(jitter),
+            "deadline": float(deadline) if deadline is not None else None,
+            "dueTime": dueTime,
+            "baseTime": dueTime, # dueTime without jitter
+            "isRunning": False,
+            "isRetriggered": False, # Triggered while running
+            "stats": {"runs": 0, "lastLatenessMs": 0, "maxLatenessMs": 0, "missedDeadlines": 0, \
+                "lastDurationMs": 0, "maxDurationMs": 0, "failures": 0}
+        }
+        heapq.heappush(taskQueue, (dueTime, next(taskSequence), taskName))
+    schedulerWakeup.set()
+
+
+# Make a task due now, eg. because an event means waiting for its interval would be too slow.
+# Safe to call from any thread
+def triggerTask(taskName):
+    with schedulerLock:
+        if(taskName not in tasks):
+            comDavra.logWarning('Scheduler: cannot trigger unknown task ' + taskName)
+            return
+        task = tasks[taskName]
+        now = time.time()
+        if(task["isRunning"]):
+            task["isRetriggered"] = True
+        elif(task["dueTime"] > now):
+            task["dueTime"] = now
+            heapq.heappush(taskQueue, (now, next(taskSequence), taskName))
+    schedulerWakeup.set()
+
+
+# Call with schedulerLock held. Returns the name of the next task which is due, or None
+def popDueTask(now):
+    while(len(taskQueue) > 0 and taskQueue[0][0] <= now):
+        (dueTime, sequence, taskName) = heapq.heappop(taskQueue)
+        # Entries superseded by a trigger or a reschedule are skipped
+        if(taskName in tasks and tasks[taskName]["dueTime"] == dueTime):
+            return taskName
+    return None
+
+
+def runTask(taskName):
+    with schedulerLock:
+        task = tasks[taskName]
+        dueTime = task["dueTime"]
+        task["isRunning"] = True
+        task["isRetriggered"] = False
+    startTime = time.time()
+    latenessMs = int((startTime - dueTime) * 1000)
+    try:
+        task["function"]()
+    except (Exception, KeyboardInterrupt) as e:
+        # An interrupt fails the task but it is still rescheduled, as the agent keeps running
+        task["stats"]["failures"] += 1
+        comDavra.logError('Scheduler: task ' + taskName + ' failed: ' + repr(e))
+    durationMs = int((time.time() - startTime) * 1000)
+    with schedulerLock:
+        stats = task["stats"]
+        stats["runs"] += 1
+        stats["lastLatenessMs"] = latenessMs
+        stats["maxLatenessMs"] = max(stats["maxLatenessMs"], latenessMs)
+        stats["lastDurationMs"] = durationMs
+        stats["maxDurationMs"] = max(stats["maxDurationMs"], durationMs)
+        if(task["deadline"] is not None and latenessMs > task["deadline"] * 1000):
+            stats["missedDeadlines"] += 1
+            comDavra.logWarning('Scheduler: task ' + taskName + ' started ' + str(latenessMs) + 'ms late')
+        # Schedule from when it was due so the interval does not drift, but skip runs which were
+        # missed entirely rather than running them back to back. A run which was triggered
+        # before the regular one was due leaves the schedule as it was
+        now = time.time()
+        baseTime = task["baseTime"]
+        if(baseTime <= startTime):
+            baseTime += task["interval"]
+            if(baseTime < now):
+                baseTime = now + task["interval"]
+        task["baseTime"] = baseTime
+        nextDueTime = baseTime + random.uniform(0, task["jitter"])
+        if(task["isRetriggered"]):
+            nextDueTime = now
+        task["isRunning"] = False
+        task["dueTime"] = nextDueTime
+        heapq.heappush(taskQueue, (nextDueTime, next(taskSequence), taskName))
+
+
+# Run the due tasks, then sleep until the next is due or the scheduler is woken. Never returns
+def runScheduler():
+    while True:
+        with schedulerLock:
+            taskName = popDueTask(time.time())
+            if(taskName is None):
+                waitTime = (taskQueue[0][0] - time.time()) if len(taskQueue) > 0 else None
+        if(taskName is not None):
+            runTask(taskName)
+        elif(waitTime is None or waitTime > 0):
+            schedulerWakeup.wait(waitTime)
+
+
+def getSchedulerStats():
+    with schedulerLock:
+        return dict((taskName, dict(task["stats"])) for taskName, task in tasks.items())
@@ -8,6 +8,9 @@ import requests
 import json 
 from pprint import pprint
 import sys, subprocess
+import atexit
+import random
+import threading
 from datetime import datetime
 # Use MQTT to communicate with the davra device agent
 import paho.mqtt.client as mqtt
@@ -19,6 +22,14 @@ import paho.mqtt.client as mqtt
 mqttBrokerAgentHost = '127.0.0.1' 
 # Is the device uuid and api token required for Mqtt. If so, config file must be available
 useAdvancedMqttAuthorisation = False 
+# Metric readings are buffered and sent to the agent together, in one mqtt message,
+# when this many are waiting or when the oldest has waited metricFlushIntervalSeconds
+metricBufferMaxItems = 100
+metricFlushIntervalSeconds = 5
+# Counters, gauges and histograms are summarised and sent this often
+metricAggregationIntervalSeconds = 60
+# How many observations a histogram keeps per interval to estimate its percentiles
+histogramReservoirSize = 1000
 
 # END CONFIG
 
@@ -89,8 +100,11 @@ def mqttOnMessageDevice(client, userdata, msg):
     global lastSeenAgent
     global agentConfig
     payload = str(msg.payload)
-    if(isJson(payload)):
+    try:
         msg = json.loads(payload)
+    except ValueError:
+        msg = None
+    if(msg is not None):
         # Is this message one which this application issued (ie heard itself)
         if("fromApp" in msg and msg["fromApp"] == deviceApplicationName):
             return
@@ -164,13 +178,13 @@ def sendMessageFromAppToAgent(msg):
     global mqttClientOfDevice
     msg['fromApp'] = deviceApplicationName 
     log('sendMessageFromAppToAgent: sending msg: ' + str(msg))
-    mqttClientOfDevice.publish('/agent', json.dumps(msg))
+    return mqttClientOfDevice.publish('/agent', json.dumps(msg))
 
 
 # Send a simple metric reading to agent to forward to /api/v1/iotdata
+# The reading is buffered and sent with others, see flush
 def sendMetricValue(metricName, metricValue):
-    dataToSend = {"name": metricName, "value": metricValue, "msg_type": "datum"}
-    sendIotData(dataToSend)
+    bufferIotData([{"name": metricName, "value": metricValue, "msg_type": "datum"}])
 
 
 # Send multiple metric items
@@ -179,9 +193,100 @@ def sendMultiMetricValues(metrics):
     for metric in metrics:
         for metricName, metricValue in metric.items():
             dataToSend.append({"name": metricName, "value": metricValue, "msg_type": "datum"})
+    bufferIotData(dataToSend)
+
+
+# Metric readings waiting to be sent to the agent. Each is timestamped when it is buffered
+# so the time it was read is kept, however long it waits
+metricBuffer = []
+metricBufferLock = threading.Lock()
+metricBufferOldestTime = 0
+metricFlushThread = None
+
+def bufferIotData(dataToBuffer):
+    global metricBufferOldestTime
+    timestamp = getMilliSecondsSinceEpoch()
+    with metricBufferLock:
+        if(len(metricBuffer) == 0):
+            metricBufferOldestTime = time.time()
+        for datum in dataToBuffer:
+            datum.setdefault("timestamp", timestamp)
+            metricBuffer.append(datum)
+        # Until the app connects to the agent, only the most recent readings are kept
+        del metricBuffer[:-metricBufferMaxItems * 10]
+        isFull = len(metricBuffer) >= metricBufferMaxItems
+        startMetricFlushThread()
+    if(isFull):
+        flush()
+
+
+# Call with metricBufferLock held
+def startMetricFlushThread():
+    global metricFlushThread
+    if(metricFlushThread is None):
+        metricFlushThread = threading.Thread(target=runMetricFlush, name='davra-sdk-flush')
+        metricFlushThread.daemon = True
+        metricFlushThread.start()
+
+
+# Send the buffered readings once the oldest has waited metricFlushIntervalSeconds
+def runMetricFlush():
+    while True:
+        with metricBufferLock:
+            if(len(metricBuffer) > 0):
+                waitTime = metricBufferOldestTime + metricFlushIntervalSeconds - time.time()
+            else:
+                waitTime = metricFlushIntervalSeconds
+        if(waitTime > 0):
+            time.sleep(waitTime)
+            continue
+        try:
+            isSent = flush() is not None
+        except Exception as e:
+            log('Could not send buffered metrics to agent: ' + str(e))
+            isSent = False
+        if(isSent is False):
+            # Eg. not connected to the agent yet, so the readings are still buffered
+            time.sleep(metricFlushIntervalSeconds)
+
+
+# Take everything in the buffer, with dataToSend added at the end, to go in one message
+def takeIotData(dataToSend = None):
+    global metricBuffer
+    with metricBufferLock:
+        dataToTake = metricBuffer
+        metricBuffer = []
+    if(type(dataToSend) == type({})):
+        dataToTake.append(dataToSend)
+    elif(dataToSend is not None):
+        dataToTake.extend(dataToSend)
+    return dataToTake
+
+
+# Send the buffered metric readings to the agent now, as one message.
+# Returns the MQTTMessageInfo of the publish, or None if there was nothing to send
+def flush():
+    if(mqttClientOfDevice is None):
+        return None
+    dataToSend = takeIotData()
+    if(len(dataToSend) == 0):
+        return None
+    return sendMessageFromAppToAgent({"sendIotData": dataToSend})
+
+
+# Readings still buffered when the app exits are sent, waiting briefly for them to reach the broker
+def flushAtExit():
+    if(mqttClientOfDevice is None):
+        return
+    messageInfo = flush()
+    if(messageInfo is None):
+        return
+    deadline = time.time() + 2
+    while(messageInfo.is_published() is False and messageInfo.rc == mqtt.MQTT_ERR_SUCCESS and time.time() < deadline):
+        time.sleep(0.05)
+
+atexit.register(flushAtExit)
 
-    sendIotData(dataToSend)
-    
 
 # Send a datum to agent to forward to /api/v1/iotdata
 # For a metric:
@@ -190,8 +295,165 @@ def sendMultiMetricValues(metrics):
 # Supply dataToSend like: {"name": "davranetworks.alarm", "msg_type": "event"
 # "value": {"UUID": "ABCD", "message": "door open", "severity": "WARN"}, 
 # "tags": {"os": "linux"}}
+# dataToSend may also be a list of these. It is sent straight away, along with any buffered
+# metric readings so they reach the agent in the order they were made.
+# The data goes in the message as it is, rather than as a json string as earlier versions of
+# this sdk did, so it is only encoded once
 def sendIotData(dataToSend):
-    sendMessageFromAppToAgent({"sendIotData": json.dumps(dataToSend)})
+    sendMessageFromAppToAgent({"sendIotData": takeIotData(dataToSend)})
+
+
+
+###########################   Aggregated metrics
+
+# Rather than send every reading, an app can count, set or observe values here. They are
+# summarised in the app and only the summary is sent, once per metricAggregationIntervalSeconds.
+# Eg.
+#   requests = davra_sdk.counter("myapp.requests")
+#   requests.inc()
+#   davra_sdk.gauge("myapp.queue.depth").set(12)
+#   davra_sdk.histogram("myapp.request.ms").observe(34.5)
+# Asking for the same name and tags again returns the same metric.
+# A counter sends the total counted in the interval, as its name.
+# A gauge sends the last value set, as its name, every interval once it has been set.
+# A histogram sends <name>.count, .sum, .min, .max, .p50, .p90 and .p99 for the observations in
+# the interval, if there were any. count, sum, min and max are exact. The percentiles are estimated
+# from a random sample of histogramReservoirSize observations, so memory stays the same at any rate.
+
+aggregationLock = threading.Lock()
+aggregatedMetrics = {} # (kind, name, tags as json) -> Counter, Gauge or Histogram
+aggregationThread = None
+
+
+def makeDatum(name, value, tags):
+    datum = {"name": name, "value": value, "msg_type": "datum"}
+    if(tags):
+        datum["tags"] = dict(tags)
+    return datum
+
+
+class Counter(object):
+    def __init__(self, name, tags = None):
+        self.name = name
+        self.tags = tags
+        self.total = 0
+
+    def inc(self, amount = 1):
+        with aggregationLock:
+            self.total += amount
+
+    # Call with aggregationLock held. The datums for the interval, which then starts again
+    def takeDatums(self):
+        datums = [makeDatum(self.name, self.total, self.tags)]
+        self.total = 0
+        return datums
+
+
+class Gauge(object):
+    def __init__(self, name, tags = None):
+        self.name = name
+        self.tags = tags
+        self.value = None
+
+    def set(self, value):
+        with aggregationLock:
+            self.value = value
+
+    def takeDatums(self):
+        if(self.value is None):
+            return []
+        return [makeDatum(self.name, self.value, self.tags)]
+
+
+class Histogram(object):
+    def __init__(self, name, tags = None):
+        self.name = name
+        self.tags = tags
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.reservoir = []
+
+    def observe(self, value):
+        with aggregationLock:
+            self.count += 1
+            self.sum += value
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+            # Reservoir sampling: every observation has the same chance of being in the sample
+            if(len(self.reservoir) < histogramReservoirSize):
+                self.reservoir.append(value)
+            else:
+                slot = random.randint(0, self.count - 1)
+                if(slot < histogramReservoirSize):
+                    self.reservoir[slot] = value
+
+    def takeDatums(self):
+        if(self.count == 0):
+            return []
+        sample = sorted(self.reservoir)
+        datums = [makeDatum(self.name + "." + key, value, self.tags) for (key, value) in \
+            [("count", self.count), ("sum", self.sum), ("min", self.min), ("max", self.max)]]
+        for percentile in [50, 90, 99]:
+            # Nearest rank
+            rank = max(0, int(round(percentile / 100.0 * len(sample))) - 1)
+            datums.append(makeDatum(self.name + ".p" + str(percentile), sample[rank], self.tags))
+        self.reset()
+        return datums
+
+
+def getAggregatedMetric(metricClass, name, tags):
+    key = (metricClass.__name__, name, json.dumps(tags, sort_keys=True))
+    with aggregationLock:
+        if(key not in aggregatedMetrics):
+            aggregatedMetrics[key] = metricClass(name, tags)
+        startAggregationThread()
+        return aggregatedMetrics[key]
+
+
+def counter(name, tags = None):
+    return getAggregatedMetric(Counter, name, tags)
+
+def gauge(name, tags = None):
+    return getAggregatedMetric(Gauge, name, tags)
+
+def histogram(name, tags = None):
+    return getAggregatedMetric(Histogram, name, tags)
+
+
+# Call with aggregationLock held
+def startAggregationThread():
+    global aggregationThread
+    if(aggregationThread is None):
+        aggregationThread = threading.Thread(target=runAggregation, name='davra-sdk-aggregation')
+        aggregationThread.daemon = True
+        aggregationThread.start()
+
+
+def runAggregation():
+    while True:
+        time.sleep(metricAggregationIntervalSeconds)
+        try:
+            sendAggregatedMetrics()
+        except Exception as e:
+            log('Could not send aggregated metrics to agent: ' + str(e))
+
+
+# Summarise every metric for the interval so far and buffer the datums to send to the agent
+def sendAggregatedMetrics():
+    datums = []
+    with aggregationLock:
+        for metric in aggregatedMetrics.values():
+            datums.extend(metric.takeDatums())
+    if(len(datums) > 0):
+        bufferIotData(datums)
+
+# Registered after flushAtExit so it runs first, and the last summaries are sent with the buffer
+atexit.register(sendAggregatedMetrics)
 
 
 
@@ -206,6 +468,19 @@ def registerCapability(capabilityName, capabilityDetails, capabilityFunctionToRu
     # when a message is received from the agent, via mqtt
     appCapabilityFunctions[capabilityName] = capabilityFunctionToRun
 
+
+# Announce several capabilities in one message, so the agent can update the server in one request.
+# capabilities is a list of tuples of (capabilityName, capabilityDetails, capabilityFunctionToRun)
+# Eg. registerCapabilities([("app-action-restart", {"functionParameters": {}}, restartApp)])
+def registerCapabilities(capabilities):
+    global appCapabilityFunctions
+    log('registerCapabilities: announce application capabilities to agent: ' + str([c[0] for c in capabilities]))
+    capabilityDetails = {}
+    for (capabilityName, details, capabilityFunctionToRun) in capabilities:
+        capabilityDetails[capabilityName] = details
+        appCapabilityFunctions[capabilityName] = capabilityFunctionToRun
+    sendMessageFromAppToAgent({"registerCapabilities": capabilityDetails})
+
 # If the app wiches to receive a copy of all messages which are seen on the mqtt topic, 
 # it can nominate a callback function which will be called whenever any message is seen
 def listenToAllMessagesFromAgent(functionToCallForEachMessage):
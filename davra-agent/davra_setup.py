@@ -54,8 +54,7 @@ def configGetServer():
         for index, arg in enumerate(sys.argv):
             if arg in ['--server'] and len(sys.argv) > index + 1:
                 comDavra.conf['server'] = sys.argv[index + 1]
-                with open(configFilename, 'w') as outfile:
-                    json.dump(comDavra.conf, outfile, indent=4)
+                comDavra.saveConfiguration()
                 break
         # No configuration info exists so get it from user and save
         userInput = raw_input("Server location? (eg http://myName.davra.com) : ")
@@ -64,12 +63,11 @@ def configGetServer():
             configGetServer()
             return
         comDavra.conf['server'] = userInput
-        with open(configFilename, 'w') as outfile:
-            json.dump(comDavra.conf, outfile, indent=4)
+        comDavra.saveConfiguration()
     # Confirm can reach server    
     print("Establishing connection to Davra server... ")
     # Confirm can reach the server
-    r = requests.get(comDavra.conf['server'])
+    r = comDavra.getHttpSession().get(comDavra.conf['server'], timeout=comDavra.getTimeoutForDestination(comDavra.conf['server']))
     if(r.status_code == 200):
         #print(r.content)
         print("Ok, can reach " + comDavra.conf['server'])
@@ -123,7 +121,8 @@ def configGetApiTokenOfDevice():
     # Find the UUID of this device
     headers = {'Accept': 'application/json', 'Authorization': 'Bearer ' + userInput}
     print('Confirming device on server')
-    r = requests.get(comDavra.conf['server'] + '/user', headers = headers)
+    r = comDavra.getHttpSession().get(comDavra.conf['server'] + '/user', headers = headers, \
+        timeout=comDavra.getTimeoutForDestination('/user'))
     if(r.status_code == 200):
         print(r.content)
         responseContent = json.loads(r.content)
@@ -132,8 +131,7 @@ def configGetApiTokenOfDevice():
             print("Device confirmed on server")
             # Save device info to config file
             comDavra.conf['apiToken'] = userInput
-            with open(configFilename, 'w') as outfile:
-                json.dump(comDavra.conf, outfile, indent=4)
+            comDavra.saveConfiguration()
         else:
             print("ERROR: Issue with API token. It does not appear to be a valid token for a device.")
             configGetApiTokenOfDevice()
@@ -145,44 +143,54 @@ def configGetApiTokenOfDevice():
 
 configGetApiTokenOfDevice()
 
-# heartbeatInterval is how many seconds between calling home
-if('heartbeatInterval' not in comDavra.conf):
-    comDavra.upsertConfigurationItem('heartbeatInterval', 600)
+# Defaults for anything not configured yet. Saved and reported to the server once
+with comDavra.configTransaction():
+    # heartbeatInterval is how many seconds between calling home
+    if('heartbeatInterval' not in comDavra.conf):
+        comDavra.upsertConfigurationItem('heartbeatInterval', 600)
 
 
-# scriptMaxTime is how many seconds between a script can run for before timing out
-if('scriptMaxTime' not in comDavra.conf):
-    comDavra.upsertConfigurationItem('scriptMaxTime', 600)
+    # scriptMaxTime is how many seconds between a script can run for before timing out
+    if('scriptMaxTime' not in comDavra.conf):
+        comDavra.upsertConfigurationItem('scriptMaxTime', 600)
 
 
-# agentRepository is where the artifacts for the agent are published
-# should also have /build_version.txt to indicate the latest release version
-if('agentRepository' not in comDavra.conf):
-    comDavra.upsertConfigurationItem('agentRepository', 'downloads.davra.com/agents/davra-agent-python2-master')
+    # agentRepository is where the artifacts for the agent are published
+    # should also have /build_version.txt to indicate the latest release version
+    if('agentRepository' not in comDavra.conf):
+        comDavra.upsertConfigurationItem('agentRepository', 'downloads.davra.com/agents/davra-agent-python2-master')
 
-# What is the host of the MQTT Broker on Davra Server
-if('mqttBrokerServerHost' not in comDavra.conf):
-    # No configuration exists for mqtt
-    # Make assumptions for the cloud based scenarios
-    if ('davra.com' in comDavra.conf['server']):
-        comDavra.upsertConfigurationItem('mqttBrokerServerHost', 'mqtt.davra.com')
-    elif ('eemlive.com' in comDavra.conf['server']):
-        comDavra.upsertConfigurationItem('mqttBrokerServerHost', 'mqtt.eemlive.com')
-    else:
-        # Assume the same IP as the Davra server but ignore http or port definition
-        mqttBroker = comDavra.conf['server'].replace("http://", "").replace("https://", "").split(":")[0]
-        print('Setting mqttBroker ' + str(mqttBroker))
-        comDavra.upsertConfigurationItem('mqttBrokerServerHost', mqttBroker)
-
-
-# Reload configuration inside library
-comDavra.loadConfiguration()
+    # What is the host of the MQTT Broker on Davra Server
+    if('mqttBrokerServerHost' not in comDavra.conf):
+        # No configuration exists for mqtt
+        # Make assumptions for the cloud based scenarios
+        if ('davra.com' in comDavra.conf['server']):
+            comDavra.upsertConfigurationItem('mqttBrokerServerHost', 'mqtt.davra.com')
+        elif ('eemlive.com' in comDavra.conf['server']):
+            comDavra.upsertConfigurationItem('mqttBrokerServerHost', 'mqtt.eemlive.com')
+        else:
+            # Assume the same IP as the Davra server but ignore http or port definition
+            mqttBroker = comDavra.conf['server'].replace("http://", "").replace("https://", "").split(":")[0]
+            print('Setting mqttBroker ' + str(mqttBroker))
+            comDavra.upsertConfigurationItem('mqttBrokerServerHost', mqttBroker)
 
 
 # Create necessary metrics on server    
 comDavra.createMetricOnServer('cpu', '%', 'CPU usage')
 comDavra.createMetricOnServer('uptime', 's', 'Time since reboot')
 comDavra.createMetricOnServer('ram', '%', 'RAM usage')
+comDavra.createMetricOnServer('jobs.queued', '', 'Jobs waiting to run on the device')
+comDavra.createMetricOnServer('jobs.wait.max', 's', 'Longest wait of a job before it started')
+comDavra.createMetricOnServer('loopLatency', 'ms', 'How late the agent woke to take a sample')
+comDavra.createMetricOnServer('mqtt.queue.max', '', 'Most mqtt messages waiting to be handled')
+comDavra.createMetricOnServer('mqtt.latency.max', 'ms', 'Longest time from an mqtt message arriving to it being handled')
+# The heartbeat also sends a summary of the samples taken since the previous heartbeat
+aggregateDescriptions = {"min": "lowest", "max": "highest", "mean": "mean", "p95": "95th percentile"}
+for (metricName, unit, description) in [('cpu', '%', 'CPU usage'), ('ram', '%', 'RAM usage'), \
+('loopLatency', 'ms', 'How late the agent woke to take a sample')]:
+    for aggregate in ["min", "max", "mean", "p95"]:
+        comDavra.createMetricOnServer(metricName + '.' + aggregate, unit, \
+            description + ', ' + aggregateDescriptions[aggregate] + ' since the previous heartbeat')
 
 
 def getWanIpAddress():
@@ -218,11 +226,12 @@ if(comDavra.checkIsAgentMqttBrokerInstalled() == False):
     comDavra.upsertConfigurationItem("mqttBrokerAgentHost", '')
 else:
     comDavra.log('MQTT Broker installed and running')
-    comDavra.upsertConfigurationItem("mqttBrokerAgentHost", '127.0.0.1')
-    # To enable advanced security on mqtt requiring usernames for connections
-    #comDavra.upsertConfigurationItem("mqttRestrictions", 'localhost,username')
-    # To enable basic security which is only localhost connections to mqtt
-    comDavra.upsertConfigurationItem("mqttRestrictions", 'localhost')
+    with comDavra.configTransaction():
+        comDavra.upsertConfigurationItem("mqttBrokerAgentHost", '127.0.0.1')
+        # To enable advanced security on mqtt requiring usernames for connections
+        #comDavra.upsertConfigurationItem("mqttRestrictions", 'localhost,username')
+        # To enable basic security which is only localhost connections to mqtt
+        comDavra.upsertConfigurationItem("mqttRestrictions", 'localhost')
     setDeviceMqttBrokerSecurity()
     
     
@@ -255,8 +264,7 @@ if('service' not in comDavra.conf):
     comDavra.runCommandWithTimeout('systemctl enable davra_agent.service', 10)
     comDavra.runCommandWithTimeout('systemctl start davra_agent.service', 10)
     comDavra.runCommandWithTimeout('systemctl restart davra_agent.service', 10)
-    with open(configFilename, 'w') as outfile:
-        json.dump(comDavra.conf, outfile, indent=4)
+    comDavra.saveConfiguration()
 else:
     if(comDavra.conf['service'] == 'y' or comDavra.conf['service'] =='Y'):
         if("--no-service-restart" not in sys.argv):
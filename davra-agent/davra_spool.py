@@ -0,0 +1,215 @@
+# Davra Spool
+# Store-and-forward for outbound telemetry. When data cannot be sent because the server
+# is unreachable, it is appended to segment files on disk and replayed, oldest first,
+# once the server can be reached again.
+# Each record is one json line holding a sequence id, the api endpoint and the data item.
+# The highest sequence id which the server has accepted is kept in replayed.json so records
+# are never replayed twice, even if the agent restarts part way through a replay.
+# Tunable in config.json:
+#   spoolMaxBytes: disk space the spool may use. Oldest segments are evicted beyond this (default 20MB)
+#   spoolSegmentBytes: size at which a new segment file is started (default 1MB)
+#   spoolReplayBatchItems: how many records to send per request when replaying (default 100)
+#   spoolReplayInterval: seconds to wait between replay requests so the link is not swamped (default 1)
+#
+import os
+import json
+import time
+import threading
+import davra_lib as comDavra
+
+
+spoolDir = comDavra.installationDir + '/spool'
+replayedFile = spoolDir + '/replayed.json'
+spoolLock = threading.RLock()
+nextSeq = None # Sequence id for the next record. Loaded from disk on first use
+replayedSeq = 0 # Highest sequence id known to be accepted by the server
+replayThread = None
+spoolStats = {"recordsSpooled": 0, "recordsReplayed": 0, "recordsEvicted": 0}
+
+
+def getSpoolMaxBytes():
+    return int(comDavra.conf.get('spoolMaxBytes', 20000000))
+
+def getSpoolSegmentBytes():
+    return int(comDavra.conf.get('spoolSegmentBytes', 1000000))
+
+def getReplayBatchItems():
+    return int(comDavra.conf.get('spoolReplayBatchItems', 100))
+
+def getReplayInterval():
+    return float(comDavra.conf.get('spoolReplayInterval', 1))
+
+
+# Segment files are named by the first sequence id they hold, so sorting the names sorts by age
+def listSegments():
+    if(os.path.isdir(spoolDir) is False):
+        return []
+    segments = [f for f in os.listdir(spoolDir) if f.startswith('segment-') and f.endswith('.log')]
+    return [spoolDir + '/' + f for f in sorted(segments)]
+
+
+# Read the records of a segment, ignoring any partially written last line
+def readSegment(segmentFile):
+    records = []
+    try:
+        with open(segmentFile) as data_file:
+            for line in data_file:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except IOError:
+        pass
+    return records
+
+
+# Recover the sequence ids from disk the first time the spool is used
+def loadSpoolState():
+    global nextSeq, replayedSeq
+    if(nextSeq is not None):
+        return
+    replayedSeq = 0
+    try:
+        if(os.path.isfile(replayedFile)):
+            with open(replayedFile) as data_file:
+                replayedSeq = int(json.load(data_file)['seq'])
+    except Exception as e:
+        comDavra.logWarning('Spool: could not read ' + replayedFile + ': ' + str(e))
+    nextSeq = replayedSeq + 1
+    segments = listSegments()
+    if(len(segments) > 0):
+        records = readSegment(segments[-1])
+        if(len(records) > 0):
+            nextSeq = max(nextSeq, int(records[-1]['seq']) + 1)
+        else:
+            nextSeq = max(nextSeq, int(os.path.basename(segments[-1])[8:-4]))
+
+
+def saveReplayedSeq(seq):
+    global replayedSeq
+    # Never backwards, eg. a replayed batch older than records evicted while it was being sent
+    seq = max(replayedSeq, seq)
+    replayedSeq = seq
+    tmpFile = replayedFile + '.tmp'
+    with open(tmpFile, 'w') as outfile:
+        json.dump({"seq": seq}, outfile)
+    os.rename(tmpFile, replayedFile)
+
+
+# Append data which could not be sent. dataToSend may be a single item or a list of items
+def spoolData(endpoint, dataToSend):
+    global nextSeq
+    items = dataToSend if type(dataToSend) == type([]) else [dataToSend]
+    with spoolLock:
+        loadSpoolState()
+        if(os.path.isdir(spoolDir) is False):
+            comDavra.ensureDirectoryExists(spoolDir)
+        segments = listSegments()
+        if(len(segments) == 0 or os.path.getsize(segments[-1]) >= getSpoolSegmentBytes()):
+            segments.append(spoolDir + '/segment-' + ('%012d' % nextSeq) + '.log')
+        lines = []
+        for item in items:
+            # Keep the time the data was produced rather than the time it is eventually replayed
+            if(type(item) == type({}) and "timestamp" not in item):
+                item["timestamp"] = comDavra.getMilliSecondsSinceEpoch()
+            lines.append(json.dumps({"seq": nextSeq, "endpoint": endpoint, "data": item}))
+            nextSeq += 1
+        with open(segments[-1], 'a') as outfile:
+            outfile.write('\n'.join(lines) + '\n')
+        spoolStats['recordsSpooled'] += len(lines)
+        evictOldestSegments(segments)
+    comDavra.log('Spool: stored ' + str(len(items)) + ' records for ' + endpoint)
+    return
+
+
+# Keep the spool within its disk quota by dropping the oldest segments
+def evictOldestSegments(segments):
+    totalBytes = sum([os.path.getsize(s) for s in segments if os.path.isfile(s)])
+    while(totalBytes > getSpoolMaxBytes() and len(segments) > 1):
+        oldestSegment = segments.pop(0)
+        segmentBytes = os.path.getsize(oldestSegment)
+        droppedRecords = [int(r['seq']) for r in readSegment(oldestSegment) if int(r['seq']) > replayedSeq]
+        os.remove(oldestSegment)
+        totalBytes -= segmentBytes
+        # The evicted records count as done so replay continues from the next segment
+        if(len(droppedRecords) > 0):
+            saveReplayedSeq(max(droppedRecords))
+        droppedRecords = len(droppedRecords)
+        spoolStats['recordsEvicted'] += droppedRecords
+        comDavra.logWarning('Spool: over quota, dropped ' + str(droppedRecords) + ' oldest records')
+
+
+# Is there anything waiting to be replayed
+def hasSpooledData():
+    with spoolLock:
+        loadSpoolState()
+        return nextSeq - 1 > replayedSeq and len(listSegments()) > 0
+
+
+# Get the next batch of records to replay, all for the same endpoint and in sequence order.
+# Segments which have been fully replayed are deleted along the way.
+def takeReplayBatch():
+    with spoolLock:
+        loadSpoolState()
+        segments = listSegments()
+        for segmentFile in segments:
+            records = [r for r in readSegment(segmentFile) if int(r['seq']) > replayedSeq]
+            if(len(records) == 0):
+                os.remove(segmentFile)
+                continue
+            batch = []
+            for record in records:
+                if(len(batch) >= getReplayBatchItems() or record['endpoint'] != records[0]['endpoint']):
+                    break
+                batch.append(record)
+            return batch
+    return []
+
+
+# Send the spooled records to the server in bounded batches until the spool is empty
+# or the server cannot be reached again
+def replaySpool():
+    global replayThread
+    try:
+        while True:
+            batch = takeReplayBatch()
+            if(len(batch) == 0):
+                comDavra.logInfo('Spool: replay finished')
+                return
+            endpoint = batch[0]['endpoint']
+            r = comDavra.httpPut(comDavra.conf['server'] + endpoint, [record['data'] for record in batch])
+            if(r.status_code == 200 or (r.status_code >= 400 and r.status_code < 500)):
+                # A 4xx will never succeed so it is not retried
+                with spoolLock:
+                    saveReplayedSeq(int(batch[-1]['seq']))
+                    spoolStats['recordsReplayed'] += len(batch)
+                comDavra.log('Spool: replayed ' + str(len(batch)) + ' records. Response ' + str(r.status_code))
+            else:
+                comDavra.logWarning('Spool: replay paused, server responded ' + str(r.status_code))
+                return
+            time.sleep(getReplayInterval())
+    finally:
+        with spoolLock:
+            replayThread = None
+
+
+# Begin replaying in the background. Call this when the server is known to be reachable
+def startReplay():
+    global replayThread
+    with spoolLock:
+        if(replayThread is not None or hasSpooledData() is False):
+            return
+        comDavra.logInfo('Spool: server reachable, replaying stored records')
+        replayThread = threading.Thread(target=replaySpool, name='davra-spool-replay')
+        replayThread.daemon = True
+        replayThread.start()
+    return
+
+
+def getSpoolStats():
+    with spoolLock:
+        loadSpoolState()
+        stats = dict(spoolStats)
+        stats['recordsPending'] = max(0, nextSeq - 1 - replayedSeq)
+        stats['bytesOnDisk'] = sum([os.path.getsize(s) for s in listSegments()])
+    return stats
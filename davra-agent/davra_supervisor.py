@@ -0,0 +1,326 @@
+# Davra Supervisor
+# Runs the commands launched by the agent (scripts, installers etc.) as supervised processes.
+# Each command runs in its own process group, so stopping it stops everything it started:
+# the group is sent SIGTERM, then SIGKILL if it has not exited after a grace period.
+# A single reaper thread collects every supervised process when it exits, using wait4 so the
+# cpu time and peak memory of the command (including the children it waited for) are recorded.
+# The reaper sleeps until a process exits: on Linux 5.3+ it waits on a pidfd per process.
+# On older kernels it checks each process with a backoff, starting at 10ms and capped at 1s.
+# Whoever runs a command can wait for it to exit by selecting on its exitFd, which becomes
+# readable as soon as the process has been reaped.
+# A command may be given an execution profile so it cannot starve the agent of cpu or disk,
+# which matters most on single core devices. A profile is a dict, all keys optional:
+#   nice: niceness added to the command's priority, 1 to 19 (19 is the lowest priority)
+#   ioClass: disk io scheduling class, "idle", "best-effort" or "realtime"
+#   ioLevel: disk io priority within the class, 0 (highest) to 7
+#   rlimits: dict of resource limit name to value, eg. {"as": 268435456, "nofile": 256}.
+#     Names are those of the RLIMIT_ constants in the resource module, in lower case
+#   cpuPercent: cap on cpu use, as a percentage of one cpu. Needs cgroup v2
+#   memoryMaxBytes: cap on memory use of the command and its children. Needs cgroup v2
+# Settings which cannot be applied on the device (eg. no cgroup v2, or an unknown
+# architecture for ioprio_set) are skipped and the command runs anyway.
+# This module does not use davra_lib so that davra_lib can use it.
+#
+import os
+import resource
+import errno
+import fcntl
+import select
+import signal
+import subprocess
+import threading
+import time
+import ctypes
+
+
+supervisorLock = threading.Lock()
+supervisedProcesses = {} # pid -> SupervisedProcess not yet reaped
+reaperThread = None
+reaperWakeupRead, reaperWakeupWrite = os.pipe()
+for fd in [reaperWakeupRead, reaperWakeupWrite]:
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+supervisorStats = {"started": 0, "reaped": 0, "terminated": 0, "killed": 0, "cgroupsCreated": 0}
+
+cgroupRoot = '/sys/fs/cgroup'
+cgroupParent = cgroupRoot + '/davra-agent-jobs'
+ioPriorityClasses = {"realtime": 1, "best-effort": 2, "idle": 3}
+# ioprio_set has no wrapper in python 2 and its number differs between architectures
+ioprioSetSyscalls = {"x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30, "armv6l": 314, "armv7l": 314}
+
+pidfdOpenSyscall = 434 # The same number on all the architectures the agent runs on
+try:
+    libc = ctypes.CDLL(None, use_errno = True)
+except OSError:
+    libc = None
+
+
+# Returns a file descriptor which becomes readable when the process exits, or None if the
+# kernel does not support pidfd_open
+def openPidFd(pid):
+    if(libc is None):
+        return None
+    try:
+        pidFd = libc.syscall(pidfdOpenSyscall, ctypes.c_int(pid), ctypes.c_uint(0))
+    except Exception:
+        return None
+    return pidFd if pidFd >= 0 else None
+
+
+# Is cgroup v2 mounted with the cpu and memory controllers available to us
+def isCgroupV2Available():
+    try:
+        with open(cgroupRoot + '/cgroup.controllers') as controllersFile:
+            controllers = controllersFile.read().split()
+        return 'cpu' in controllers and 'memory' in controllers and os.access(cgroupRoot, os.W_OK)
+    except (IOError, OSError):
+        return False
+
+
+def writeCgroupFile(path, value):
+    with open(path, 'w') as cgroupFile:
+        cgroupFile.write(value)
+
+
+# Create a cgroup for one command with the caps of the profile. Returns its path or None.
+# The cgroups sit under their own parent with no processes of its own, as cgroup v2 requires
+# of a cgroup which enables controllers for its children
+def createCgroup(name, profile):
+    if(profile.get('cpuPercent') is None and profile.get('memoryMaxBytes') is None):
+        return None
+    if(isCgroupV2Available() is False):
+        print "Warning: cgroup v2 not available, running command without cpu/memory caps"
+        return None
+    try:
+        if(os.path.isdir(cgroupParent) is False):
+            os.mkdir(cgroupParent)
+        writeCgroupFile(cgroupParent + '/cgroup.subtree_control', '+cpu +memory')
+        cgroupPath = cgroupParent + '/' + name
+        os.mkdir(cgroupPath)
+        if(profile.get('cpuPercent') is not None):
+            period = 100000
+            writeCgroupFile(cgroupPath + '/cpu.max', str(int(float(profile['cpuPercent']) * period / 100)) + ' ' + str(period))
+        if(profile.get('memoryMaxBytes') is not None):
+            writeCgroupFile(cgroupPath + '/memory.max', str(int(profile['memoryMaxBytes'])))
+        with supervisorLock:
+            supervisorStats['cgroupsCreated'] += 1
+        return cgroupPath
+    except (IOError, OSError) as e:
+        print "Warning: Could not create cgroup for command: " + str(e)
+        return None
+
+
+# Returns the function run in the child process, between fork and exec, to apply the profile.
+# Failures here cannot be reported, so each setting is applied independently and skipped on error
+def getProcessSetup(profile, cgroupPath):
+    ioprioSetSyscall = ioprioSetSyscalls.get(os.uname()[4])
+    def setupProcess():
+        # The command leads a new process group, so the group id is its pid
+        os.setpgrp()
+        if(cgroupPath is not None):
+            try:
+                writeCgroupFile(cgroupPath + '/cgroup.procs', '0')
+            except (IOError, OSError):
+                pass
+        if(profile.get('nice')):
+            try:
+                os.nice(int(profile['nice']))
+            except OSError:
+                pass
+        if(profile.get('ioClass') in ioPriorityClasses and ioprioSetSyscall is not None and libc is not None):
+            ioPriority = (ioPriorityClasses[profile['ioClass']] << 13) | int(profile.get('ioLevel', 4))
+            # IOPRIO_WHO_PROCESS, and 0 for this process
+            libc.syscall(ioprioSetSyscall, 1, 0, ioPriority)
+        for limitName, limitValue in profile.get('rlimits', {}).items():
+            try:
+                limit = getattr(resource, 'RLIMIT_' + limitName.upper())
+                resource.setrlimit(limit, (int(limitValue), int(limitValue)))
+            except (AttributeError, ValueError, resource.error):
+                pass
+    return setupProcess
+
+
+class SupervisedProcess(object):
+    def __init__(self, command, profile = None):
+        self.command = command
+        self.profile = profile or {}
+        self.startTime = time.time()
+        self.exitStatusCode = None # As subprocess does, negative for a command ended by a signal
+        self.resourceUsage = None
+        self.exitFd, self.exitNotifyFd = os.pipe()
+        self.cgroupPath = createCgroup('command-' + str(os.getpid()) + '-' + str(id(self)), self.profile)
+        self.popen = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, \
+            close_fds=True, preexec_fn=getProcessSetup(self.profile, self.cgroupPath))
+        self.pid = self.popen.pid
+        self.pidFd = openPidFd(self.pid)
+        self.nextCheckTime = time.time() + 0.01
+        self.checkInterval = 0.01
+        self.isReaped = False # Set once the reaper has finished with the process
+        self.isClosePending = False
+
+    def hasExited(self):
+        return self.exitStatusCode is not None
+
+    # Wait up to timeout seconds (forever if None) for the process to exit. Returns True if it has
+    def waitForExit(self, timeout = None):
+        if(self.hasExited()):
+            return True
+        try:
+            select.select([self.exitFd], [], [], timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+        return self.hasExited()
+
+    # Send a signal to every process in the group. Returns False if the group is gone
+    def signalGroup(self, signalNumber):
+        try:
+            os.killpg(self.pid, signalNumber)
+            return True
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+            return False
+
+    # Stop the whole process group: SIGTERM, then SIGKILL once the command has exited
+    # or after graceSeconds, whichever is first. Returns True if the command has exited
+    def stop(self, graceSeconds = 5):
+        if(self.signalGroup(signal.SIGTERM)):
+            with supervisorLock:
+                supervisorStats['terminated'] += 1
+        self.waitForExit(graceSeconds)
+        # Anything left in the group, eg. a child which ignored SIGTERM, is killed
+        if(self.signalGroup(signal.SIGKILL)):
+            with supervisorLock:
+                supervisorStats['killed'] += 1
+        # Bounded, as a process in uninterruptible sleep (eg. on a hung mount) ignores even SIGKILL
+        if(self.waitForExit(graceSeconds) is False):
+            print "Warning: Process " + str(self.pid) + " did not exit after SIGKILL"
+        return self.hasExited()
+
+    # Called by the reaper thread
+    def setExited(self, status, rusage):
+        if(os.WIFSIGNALED(status)):
+            self.exitStatusCode = -os.WTERMSIG(status)
+        else:
+            self.exitStatusCode = os.WEXITSTATUS(status)
+        self.popen.returncode = self.exitStatusCode
+        self.resourceUsage = {
+            "userCpuSeconds": round(rusage.ru_utime, 3),
+            "systemCpuSeconds": round(rusage.ru_stime, 3),
+            "maxRssKb": rusage.ru_maxrss,
+            "elapsedSeconds": round(time.time() - self.startTime, 3)
+        }
+        if(self.pidFd is not None):
+            os.close(self.pidFd)
+            self.pidFd = None
+        os.write(self.exitNotifyFd, 'x')
+
+    # Release the file descriptors and cgroup once the caller is finished with the process.
+    # If it has not exited (eg. it survived SIGKILL) this is left to the reaper, which still
+    # writes to exitNotifyFd when it collects the process
+    def close(self):
+        with supervisorLock:
+            if(self.isReaped is False):
+                self.isClosePending = True
+                return
+        for fd in [self.exitFd, self.exitNotifyFd]:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self.popen.stdout.close()
+        if(self.cgroupPath is not None):
+            try:
+                os.rmdir(self.cgroupPath)
+            except OSError as e:
+                # Still holds a process the command left running in the background
+                print "Warning: Could not remove cgroup " + self.cgroupPath + ": " + str(e)
+
+
+# Start a command under supervision, with an optional execution profile
+def startProcess(command, profile = None):
+    process = SupervisedProcess(command, profile)
+    with supervisorLock:
+        supervisedProcesses[process.pid] = process
+        supervisorStats['started'] += 1
+        startReaper()
+    os.write(reaperWakeupWrite, 'x')
+    return process
+
+
+# Call with supervisorLock held
+def startReaper():
+    global reaperThread
+    if(reaperThread is None):
+        reaperThread = threading.Thread(target=runReaper, name='davra-supervisor-reaper')
+        reaperThread.daemon = True
+        reaperThread.start()
+
+
+# Collect a process if it has exited. Returns True if it was reaped
+def reapProcess(process):
+    try:
+        (pid, status, rusage) = os.wait4(process.pid, os.WNOHANG)
+    except OSError as e:
+        if e.errno != errno.ECHILD:
+            raise
+        # Already collected elsewhere so the exit status is unknown
+        (pid, status, rusage) = (process.pid, 0, None)
+    if(pid == 0):
+        return False
+    with supervisorLock:
+        supervisedProcesses.pop(process.pid, None)
+        supervisorStats['reaped'] += 1
+    if(rusage is None):
+        # Not known to have succeeded, so reported as failed
+        process.exitStatusCode = -1
+        process.popen.returncode = -1
+        process.resourceUsage = {}
+        os.write(process.exitNotifyFd, 'x')
+    else:
+        process.setExited(status, rusage)
+    with supervisorLock:
+        process.isReaped = True
+        isClosePending = process.isClosePending
+    if(isClosePending):
+        process.close()
+    return True
+
+
+def runReaper():
+    while True:
+        with supervisorLock:
+            processes = supervisedProcesses.values()
+        pidFds = dict((process.pidFd, process) for process in processes if process.pidFd is not None)
+        polledProcesses = [process for process in processes if process.pidFd is None]
+        waitTime = None
+        if(len(polledProcesses) > 0):
+            waitTime = max(0, min([process.nextCheckTime for process in polledProcesses]) - time.time())
+        try:
+            readable = select.select([reaperWakeupRead] + pidFds.keys(), [], [], waitTime)[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            continue
+        if(reaperWakeupRead in readable):
+            try:
+                while len(os.read(reaperWakeupRead, 512)) > 0:
+                    pass
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+        for fd in readable:
+            if(fd in pidFds):
+                reapProcess(pidFds[fd])
+        now = time.time()
+        for process in polledProcesses:
+            if(process.nextCheckTime <= now and reapProcess(process) is False):
+                process.checkInterval = min(1.0, process.checkInterval * 2)
+                process.nextCheckTime = now + process.checkInterval
+
+
+def getSupervisorStats():
+    with supervisorLock:
+        stats = dict(supervisorStats)
+        stats['running'] = len(supervisedProcesses)
+    return stats
@@ -0,0 +1,298 @@
+# Davra Update
+# Keeps the agent up to date with the release published at agentRepository (see build.sh).
+# build_version.txt is fetched with a conditional GET, so checking costs a 304 when nothing changed.
+# When the version differs, manifest.json gives the sha256 of every file of the release and only
+# the files whose hash differs from the running agent are downloaded, from files/<sha256>.
+# The others are copied from the running release.
+# Each release is staged side by side under releases/<version>, verified, then switched to by
+# atomically replacing the "current" symlink which the service runs the agent from.
+# The new agent is on trial until the server accepts one of its heartbeats. It is rolled back to
+# the previous release if it fails to start several times in a row (counted by davra_rollback.sh
+# before each start, and reset once the agent is up and running its heartbeat), and such a version
+# is not installed again. It is also rolled back if the server has not accepted a heartbeat within
+# updateTrialSeconds. Time when the server cannot be reached does not count, so a device which is
+# offline keeps a good release, and a version rolled back this way may be installed again later.
+# The files in updateDir are shared with davra_rollback.sh:
+#   trial         - how many times the release on trial has been started
+#   trialVersion  - the version on trial
+#   previous      - symlink to the release to roll back to
+#   badVersions   - versions which were rolled back, one per line
+#   state.json    - validators of build_version.txt for the conditional GET, saved once the
+#                   version it describes is installed (or not needed) so a failed update is retried
+# Tunable in config.json:
+#   autoUpdate: check for and install new releases of the agent (default True)
+#   updateCheckInterval: seconds between checks (default 3600)
+#   updateTrialSeconds: how long a new release has to send a heartbeat (default 1800)
+#
+import os
+import json
+import time
+import shutil
+import hashlib
+import davra_lib as comDavra
+
+
+updateDir = comDavra.installationDir + '/update'
+releasesDir = comDavra.installationDir + '/releases'
+currentLink = comDavra.installationDir + '/current'
+trialFile = updateDir + '/trial'
+trialVersionFile = updateDir + '/trialVersion'
+previousLink = updateDir + '/previous'
+badVersionsFile = updateDir + '/badVersions'
+stateFile = updateDir + '/state.json'
+serviceFile = '/lib/systemd/system/davra_agent.service'
+# Where the code of the running agent is
+runningReleaseDir = os.path.dirname(os.path.realpath(__file__))
+trialStartTime = time.time()
+trialPausedSeconds = 0 # Time on trial when the server could not be reached
+lastTrialCheckTime = time.time()
+isTrialRunningRecorded = False
+updateStats = {"checks": 0, "updates": 0, "filesDownloaded": 0, "filesReused": 0, "bytesDownloaded": 0}
+
+
+class UpdateError(Exception):
+    pass
+
+
+def isAutoUpdateEnabled():
+    return comDavra.conf.get('autoUpdate', True) is True
+
+def getUpdateCheckInterval():
+    return int(comDavra.conf.get('updateCheckInterval', 3600))
+
+
+def getRepositoryUrl():
+    repository = comDavra.conf['agentRepository'].rstrip('/')
+    return repository if '://' in repository else 'https://' + repository
+
+
+def readTextFile(path, default = ''):
+    try:
+        with open(path) as data_file:
+            return data_file.read().strip()
+    except IOError:
+        return default
+
+
+def writeTextFile(path, content):
+    comDavra.ensureDirectoryExists(os.path.dirname(path))
+    tmpFile = path + '.tmp'
+    with open(tmpFile, 'w') as outfile:
+        outfile.write(content)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.rename(tmpFile, path)
+
+
+def getBadVersions():
+    return readTextFile(badVersionsFile).split()
+
+
+def hashFile(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as data_file:
+        for chunk in iter(lambda: data_file.read(65536), ''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+# Make a symlink at linkPath pointing to target, replacing any link there in one step.
+# Targets are absolute so a link can be copied from one directory to another
+def replaceSymlink(target, linkPath):
+    comDavra.ensureDirectoryExists(os.path.dirname(linkPath))
+    tmpLink = linkPath + '.new'
+    if(os.path.lexists(tmpLink)):
+        os.remove(tmpLink)
+    os.symlink(target, tmpLink)
+    os.rename(tmpLink, linkPath)
+
+
+def downloadFromRepository(path, headers = None):
+    startTime = time.time()
+    try:
+        r = comDavra.getHttpSession().get(getRepositoryUrl() + path, headers=headers or {}, \
+            timeout=comDavra.getTimeoutForDestination(path))
+    except Exception as e:
+        comDavra.recordHttpRequest(int((time.time() - startTime) * 1000), True)
+        raise UpdateError('Could not reach agent repository: ' + str(e))
+    comDavra.recordHttpRequest(int((time.time() - startTime) * 1000), False)
+    updateStats['bytesDownloaded'] += len(r.content)
+    return r
+
+
+# Returns the latest published version and the validators to save once it is dealt with,
+# or (None, None) if it has not changed since the last check
+def getPublishedVersion():
+    try:
+        with open(stateFile) as data_file:
+            state = json.load(data_file)
+    except (IOError, ValueError):
+        state = {}
+    headers = {}
+    if(state.get('etag')):
+        headers['If-None-Match'] = state['etag']
+    if(state.get('lastModified')):
+        headers['If-Modified-Since'] = state['lastModified']
+    r = downloadFromRepository('/build_version.txt', headers)
+    if(r.status_code == 304):
+        return (None, None)
+    if(r.status_code != 200):
+        raise UpdateError('Could not get build_version.txt: ' + str(r.status_code))
+    state = {"etag": r.headers.get('ETag'), "lastModified": r.headers.get('Last-Modified'), "version": r.content.strip()}
+    return (state['version'], state)
+
+
+# Build the release in a staging directory beside the others, then move it into place
+def stageRelease(manifest):
+    releaseDir = releasesDir + '/' + ''.join(ch for ch in manifest['version'] if ch.isalnum() or ch in '._-')
+    stagingDir = releaseDir + '.staging'
+    shutil.rmtree(stagingDir, True)
+    try:
+        for relativePath, fileInfo in sorted(manifest['files'].items()):
+            if(os.path.isabs(relativePath) or '..' in relativePath.split('/')):
+                raise UpdateError('Bad path in manifest: ' + relativePath)
+            stagedPath = os.path.join(stagingDir, relativePath)
+            comDavra.ensureDirectoryExists(os.path.dirname(stagedPath))
+            runningPath = os.path.join(runningReleaseDir, relativePath)
+            if(os.path.isfile(runningPath) and hashFile(runningPath) == fileInfo['sha256']):
+                shutil.copy2(runningPath, stagedPath)
+                updateStats['filesReused'] += 1
+            else:
+                r = downloadFromRepository('/files/' + fileInfo['sha256'])
+                if(r.status_code != 200):
+                    raise UpdateError('Could not download ' + relativePath + ': ' + str(r.status_code))
+                if(hashlib.sha256(r.content).hexdigest() != fileInfo['sha256']):
+                    raise UpdateError('Checksum mismatch for ' + relativePath)
+                with open(stagedPath, 'wb') as outfile:
+                    outfile.write(r.content)
+                updateStats['filesDownloaded'] += 1
+            os.chmod(stagedPath, int(fileInfo.get('mode', '755'), 8))
+        # Make sure everything is on disk before the release can be switched to
+        comDavra.runCommandWithTimeout('sync', 60)
+        shutil.rmtree(releaseDir, True)
+        os.rename(stagingDir, releaseDir)
+    except Exception:
+        shutil.rmtree(stagingDir, True)
+        raise
+    return releaseDir
+
+
+# Point the service at a release. Installs the unit file of the release if it has changed,
+# eg. so an agent installed before releases existed is run from the current link
+def switchToRelease(releaseDir):
+    replaceSymlink(releaseDir, currentLink)
+    for (source, destination) in [(releaseDir + '/davra_rollback.sh', comDavra.installationDir + '/davra_rollback.sh'), \
+    (releaseDir + '/davra_agent.service', serviceFile)]:
+        if(os.path.isfile(source) and readTextFile(source) != readTextFile(destination)):
+            shutil.copy2(source, destination + '.new')
+            os.rename(destination + '.new', destination)
+            if(destination == serviceFile):
+                os.chmod(serviceFile, 0644)
+                comDavra.runCommandWithTimeout('systemctl daemon-reload', 30)
+
+
+# Check for a new release and install it. Returns True if the agent should now restart to run it
+def checkForUpdate():
+    updateStats['checks'] += 1
+    if(os.path.isfile(trialFile)):
+        # Do not update again until the release on trial has proven itself
+        return False
+    (version, state) = getPublishedVersion()
+    if(version is None):
+        return False
+    if(version == comDavra.davraAgentVersion):
+        writeTextFile(stateFile, json.dumps(state))
+        return False
+    if(version in getBadVersions()):
+        comDavra.log('Update: not installing ' + version + ' as it was rolled back before')
+        writeTextFile(stateFile, json.dumps(state))
+        return False
+    r = downloadFromRepository('/manifest.json')
+    if(r.status_code != 200):
+        raise UpdateError('Could not get manifest.json: ' + str(r.status_code))
+    manifest = r.json()
+    if(manifest.get('version') != version):
+        raise UpdateError('Manifest is for ' + str(manifest.get('version')) + ', not ' + version)
+    comDavra.logInfo('Update: staging agent version ' + version)
+    previousRequirements = readTextFile(runningReleaseDir + '/requirements.txt')
+    releaseDir = stageRelease(manifest)
+    if(readTextFile(releaseDir + '/requirements.txt') != previousRequirements):
+        requirementsResponse = comDavra.runCommandWithTimeout('pip install -r ' + releaseDir + '/requirements.txt', 600)
+        if(requirementsResponse[0] != 0):
+            raise UpdateError('Could not install requirements: ' + str(requirementsResponse[1]))
+    # The previous release is remembered before switching, so a failed start can always roll back
+    replaceSymlink(runningReleaseDir, previousLink)
+    writeTextFile(trialVersionFile, version)
+    writeTextFile(trialFile, '0')
+    switchToRelease(releaseDir)
+    # Only now, so the next check downloads build_version.txt again if anything above failed
+    writeTextFile(stateFile, json.dumps(state))
+    updateStats['updates'] += 1
+    comDavra.logInfo('Update: switched to agent version ' + version + '. ' + str(updateStats['filesDownloaded']) \
+        + ' files downloaded, ' + str(updateStats['filesReused']) + ' reused')
+    return True
+
+
+def isOnTrial():
+    return os.path.isfile(trialFile) and readTextFile(trialVersionFile) == comDavra.davraAgentVersion
+
+
+# The release on trial has sent a heartbeat, so it is kept. Older releases are removed
+def confirmUpdate():
+    if(isOnTrial() is False):
+        return
+    os.remove(trialFile)
+    comDavra.logInfo('Update: agent version ' + comDavra.davraAgentVersion + ' confirmed')
+    keepReleases = [os.path.realpath(runningReleaseDir), os.path.realpath(previousLink)]
+    if(os.path.isdir(releasesDir)):
+        for releaseName in os.listdir(releasesDir):
+            releaseDir = os.path.realpath(releasesDir + '/' + releaseName)
+            if(releaseDir not in keepReleases):
+                shutil.rmtree(releaseDir, True)
+
+
+# Go back to the previous release. Returns True if the agent should now restart to run it.
+# isBadVersion is False when the release may be fine, so it can be installed again later
+def rollBack(reason, isBadVersion = True):
+    if(os.path.lexists(previousLink) is False):
+        return False
+    comDavra.logError('Update: rolling back agent version ' + comDavra.davraAgentVersion + ': ' + reason)
+    if(isBadVersion):
+        with open(badVersionsFile, 'a') as outfile:
+            outfile.write(readTextFile(trialVersionFile) + '\n')
+    replaceSymlink(os.readlink(previousLink), currentLink)
+    os.remove(trialFile)
+    # So the next check downloads build_version.txt again rather than getting a 304,
+    # and can install the version again if it was not bad
+    if(os.path.isfile(stateFile)):
+        os.remove(stateFile)
+    return True
+
+
+# The release on trial has started and is running its heartbeat, so davra_rollback.sh only
+# rolls it back if it fails to start again several times from now
+def recordTrialRunning():
+    global isTrialRunningRecorded
+    if(isTrialRunningRecorded is False and isOnTrial()):
+        writeTextFile(trialFile, '0')
+    isTrialRunningRecorded = True
+
+
+# Called after a heartbeat the server did not accept. Returns True if the release on trial has
+# run out of time to send one, and was rolled back. The clock only runs while the server answers
+def checkTrialExpired(isServerReachable):
+    global trialPausedSeconds, lastTrialCheckTime
+    now = time.time()
+    if(isServerReachable is False):
+        trialPausedSeconds += now - lastTrialCheckTime
+    lastTrialCheckTime = now
+    trialSeconds = int(comDavra.conf.get('updateTrialSeconds', 1800))
+    if(isOnTrial() and now - trialStartTime - trialPausedSeconds > trialSeconds):
+        return rollBack('no heartbeat accepted within ' + str(trialSeconds) + ' seconds', False)
+    return False
+
+
+def getUpdateStats():
+    stats = dict(updateStats)
+    stats['onTrial'] = isOnTrial()
+    return stats
@@ -0,0 +1,493 @@
+# Davra Uplink
+# Metrics and events destined for /api/v1/iotdata are collected here from the agent and
+# from device apps, then sent to the server as one array per flush rather than one
+# http request per item.
+# If the server cannot be reached, the batch is kept in the on-disk spool (davra_spool)
+# and replayed once a later flush succeeds.
+# A flush happens when any of these limits is reached (tunable in config.json):
+#   uplinkBatchMaxItems: number of datums/events in the batch (default 100)
+#   uplinkBatchMaxBytes: size of the json encoded batch (default 65536)
+#   uplinkBatchMaxDelay: seconds the oldest item may wait before being sent (default 5)
+# Batches sent by http may be sent in a compact format (see encodeCompactBatch) to a server-side
+# adapter which expands them, rather than as an array of complete items:
+#   uplinkCompactBatches: send batches in the compact format (default False)
+#   uplinkCompactEndpoint: where compact batches are sent (default "/api/v1/iotdata/compact").
+#     If the server does not have it (404 or 415) the batch is sent as usual, as are all later batches
+# Batches go by http PUT, or over the agent's persistent mqtt connection to the broker of the
+# Davra server, which costs far less than a request per batch on a cellular link:
+#   uplinkTransport: "http" (default) or "mqtt"
+#   uplinkMqttTopic: topic the batches are published to, with QoS 1 (default "devices/<UUID>/iotdata")
+#   uplinkMqttInflight: batches published but not yet acknowledged by the broker (default 10)
+#   uplinkMqttAckTimeout: seconds to wait for the broker to acknowledge a batch (default 30)
+# A batch goes by http instead while the mqtt connection is down or the in-flight window is full.
+# A batch which is not acknowledged in time, or is in flight when the connection drops, is sent
+# again by http, so an item may arrive twice but is not lost. A batch sent by http is removed from
+# the mqtt client, so it is not also published again when the client reconnects. The batches in flight are also
+# saved to mqttInFlightFile, so any not acknowledged when the agent stops are sent again when it starts.
+#
+import os
+import threading
+import time
+import json
+import atexit
+import paho.mqtt.client as mqtt
+import davra_lib as comDavra
+import davra_spool
+
+
+pendingItems = [] # Tuples of (item, encodedSize, queuedTime) waiting to be sent
+pendingBytes = 0
+uplinkLock = threading.Lock()
+flushLock = threading.Lock() # Only one flush talks to the server at a time
+uplinkWakeup = comDavra.WakeupSignal()
+uplinkThread = None
+uplinkStats = {"flushes": 0, "itemsSent": 0, "failedFlushes": 0, \
+    "lastBatchSize": 0, "maxBatchSize": 0, "lastFlushLatencyMs": 0, "maxFlushLatencyMs": 0, \
+    "mqttPublished": 0, "mqttAcked": 0, "mqttAckTimeouts": 0, "mqttFallbacks": 0, \
+    "compactBatches": 0, "bytesExpanded": 0, "bytesCompact": 0}
+
+compactRefused = False # The server has no adapter for compact batches
+
+mqttLock = threading.Lock()
+mqttClient = None # Connection to the broker of the Davra server, see setMqttClient
+mqttConnected = False
+mqttInFlight = {} # Message id -> (batch, publishTime) of batches awaiting PUBACK
+# Message id -> ackTime of acknowledgements for messages not in flight. One may be for a batch
+# still being published, as publish is called without mqttLock, see publishBatch
+mqttEarlyAcks = {}
+mqttInFlightFile = comDavra.installationDir + '/mqtt_inflight.json'
+
+
+def getBatchMaxItems():
+    return int(comDavra.conf.get('uplinkBatchMaxItems', 100))
+
+def getBatchMaxBytes():
+    return int(comDavra.conf.get('uplinkBatchMaxBytes', 65536))
+
+def getBatchMaxDelay():
+    return float(comDavra.conf.get('uplinkBatchMaxDelay', 5))
+
+
+# Add a datum/event (or a list of them) to the next batch going to the server.
+# Items should already be complete, ie have UUID, name, value, msg_type
+def queueIotData(dataToSend):
+    global pendingBytes
+    items = dataToSend if type(dataToSend) == type([]) else [dataToSend]
+    with uplinkLock:
+        wasEmpty = len(pendingItems) == 0
+        queuedTime = time.time()
+        for item in items:
+            encodedSize = len(json.dumps(item))
+            pendingItems.append((item, encodedSize, queuedTime))
+            pendingBytes += encodedSize
+        isBatchFull = isBatchReady()
+    startUplink()
+    # Wake the uplink thread so it can send a full batch or start timing a new one
+    if(isBatchFull or wasEmpty):
+        uplinkWakeup.set()
+    return
+
+
+# Call with uplinkLock held
+def isBatchReady():
+    return len(pendingItems) >= getBatchMaxItems() or pendingBytes >= getBatchMaxBytes()
+
+
+# Take the next batch from the pending items, respecting the size limits
+def takeBatch():
+    global pendingItems, pendingBytes
+    with uplinkLock:
+        maxItems = getBatchMaxItems()
+        maxBytes = getBatchMaxBytes()
+        batchBytes = 0
+        count = 0
+        for (item, encodedSize, queuedTime) in pendingItems:
+            if(count >= maxItems or (count > 0 and batchBytes + encodedSize > maxBytes)):
+                break
+            batchBytes += encodedSize
+            count += 1
+        batch = [entry[0] for entry in pendingItems[:count]]
+        pendingItems = pendingItems[count:]
+        pendingBytes -= batchBytes
+    return batch
+
+
+# Send everything which is pending to the server now
+# Returns the response of the last request made, or None if nothing was pending
+def flushUplink():
+    r = None
+    with flushLock:
+        while True:
+            batch = takeBatch()
+            if(len(batch) == 0):
+                return r
+            r = sendBatch(batch)
+
+
+# Send data straight away, along with anything else pending, rather than waiting for the batch
+# Returns the response of the request, like comDavra.sendDataToServer
+def sendIotDataNow(dataToSend):
+    queueIotData(dataToSend)
+    r = flushUplink()
+    return r if r is not None else comDavra.emptyRequestsObject()
+
+
+# Send a batch by mqtt if configured and possible, otherwise by http
+def sendBatch(batch):
+    for unacknowledgedBatch in takeUnacknowledgedBatches():
+        sendBatchByHttp(unacknowledgedBatch)
+    if(comDavra.conf.get('uplinkTransport', 'http') == 'mqtt'):
+        r = publishBatch(batch)
+        if(r is not None):
+            return r
+        with uplinkLock:
+            uplinkStats['mqttFallbacks'] += 1
+    return sendBatchByHttp(batch)
+
+
+def sendBatchByHttp(batch):
+    global compactRefused
+    startTime = time.time()
+    if(comDavra.conf.get('uplinkCompactBatches', False) is True and compactRefused is False):
+        compactBatch = encodeCompactBatch(batch)
+        r = comDavra.httpPut(comDavra.conf['server'] + comDavra.conf.get('uplinkCompactEndpoint', '/api/v1/iotdata/compact'), \
+            compactBatch)
+        if(r.status_code in [404, 415]):
+            comDavra.logWarning('Server does not take compact batches, sending complete items from now on')
+            compactRefused = True
+            r = comDavra.sendDataToServer(batch)
+        else:
+            with uplinkLock:
+                uplinkStats['compactBatches'] += 1
+                uplinkStats['bytesExpanded'] += len(json.dumps(batch, separators=(',', ':')))
+                uplinkStats['bytesCompact'] += len(json.dumps(compactBatch, separators=(',', ':')))
+    else:
+        r = comDavra.sendDataToServer(batch)
+    flushLatencyMs = int((time.time() - startTime) * 1000)
+    with uplinkLock:
+        uplinkStats['flushes'] += 1
+        uplinkStats['lastBatchSize'] = len(batch)
+        uplinkStats['maxBatchSize'] = max(uplinkStats['maxBatchSize'], len(batch))
+        uplinkStats['lastFlushLatencyMs'] = flushLatencyMs
+        uplinkStats['maxFlushLatencyMs'] = max(uplinkStats['maxFlushLatencyMs'], flushLatencyMs)
+        if(r.status_code == 200):
+            uplinkStats['itemsSent'] += len(batch)
+        else:
+            uplinkStats['failedFlushes'] += 1
+    comDavra.log('Uplink flushed batch of ' + str(len(batch)) + ' items in ' + str(flushLatencyMs) \
+        + 'ms. Response: ' + str(r.status_code))
+    if(r.status_code == 200):
+        # The server is reachable so send anything stored while it was not
+        davra_spool.startReplay()
+    elif(r.status_code >= 500):
+        # Server unreachable or unavailable. Keep the data to send later
+        davra_spool.spoolData('/api/v1/iotdata', batch)
+    return r
+
+
+###########################   Compact batch format
+
+# A batch of items in the format of /api/v1/iotdata, with the fields they share factored out:
+#   {"format": "compact-1", "UUID": <most common UUID>, "msg_type": <most common msg_type>,
+#    "tags": <tags, if every item has the same>, "names": [<each metric/event name once>],
+#    "timestamp": <timestamp of the first item>,
+#    "items": [[<index in names>, <timestamp minus that of the item before>, <value>, <other fields>,
+#               <absent fields>], ...]}
+# An item without a timestamp has null in its place, and does not move the running timestamp.
+# <other fields> is only present if the item has fields besides those, or its UUID or msg_type
+# differ from the batch's. <absent fields> lists which of UUID, msg_type, name and value the item
+# did not have, and is only present if there are any (with {} as <other fields> if need be).
+# expandCompactBatch turns it back into exactly the items, eg. for a local stand-in for the
+# server-side adapter
+
+def getMostCommon(values):
+    counts = {}
+    for value in values:
+        counts[json.dumps(value, sort_keys=True)] = counts.get(json.dumps(value, sort_keys=True), 0) + 1
+    return json.loads(max(counts.items(), key = lambda item: item[1])[0]) if len(counts) > 0 else None
+
+
+def encodeCompactBatch(batch):
+    compactBatch = {"format": "compact-1", "UUID": getMostCommon([item.get('UUID') for item in batch]), \
+        "msg_type": getMostCommon([item.get('msg_type') for item in batch]), "names": [], "items": []}
+    allTags = [item.get('tags') for item in batch]
+    sharedTags = allTags[0] if len(batch) > 0 and 'tags' in batch[0] and allTags.count(allTags[0]) == len(batch) else None
+    if(sharedTags is not None):
+        compactBatch['tags'] = sharedTags
+    nameIndexes = {}
+    previousTimestamp = None
+    for item in batch:
+        if(item.get('name') not in nameIndexes):
+            nameIndexes[item.get('name')] = len(compactBatch['names'])
+            compactBatch['names'].append(item.get('name'))
+        timestampDelta = None
+        if(item.get('timestamp') is not None):
+            if(previousTimestamp is None):
+                compactBatch['timestamp'] = item['timestamp']
+                previousTimestamp = item['timestamp']
+            timestampDelta = item['timestamp'] - previousTimestamp
+            previousTimestamp = item['timestamp']
+        compactItem = [nameIndexes[item.get('name')], timestampDelta, item.get('value')]
+        # A timestamp of null is kept as an other field, as null in the item's place means it had none
+        otherFields = dict((key, value) for key, value in item.items() if key not in ['name', 'value'] \
+            and not (key == 'timestamp' and value is not None) \
+            and not (key == 'UUID' and value == compactBatch['UUID']) \
+            and not (key == 'msg_type' and value == compactBatch['msg_type']) \
+            and not (key == 'tags' and sharedTags is not None))
+        absentFields = [key for key in ['UUID', 'msg_type', 'name', 'value'] if key not in item]
+        if(len(otherFields) > 0 or len(absentFields) > 0):
+            compactItem.append(otherFields)
+        if(len(absentFields) > 0):
+            compactItem.append(absentFields)
+        compactBatch['items'].append(compactItem)
+    return compactBatch
+
+
+def expandCompactBatch(compactBatch):
+    batch = []
+    previousTimestamp = compactBatch.get('timestamp')
+    for compactItem in compactBatch['items']:
+        item = {"UUID": compactBatch['UUID'], "msg_type": compactBatch['msg_type'], \
+            "name": compactBatch['names'][compactItem[0]], "value": compactItem[2]}
+        if('tags' in compactBatch):
+            item['tags'] = compactBatch['tags']
+        if(compactItem[1] is not None):
+            item['timestamp'] = previousTimestamp + compactItem[1]
+            previousTimestamp = item['timestamp']
+        if(len(compactItem) > 3):
+            item.update(compactItem[3])
+        if(len(compactItem) > 4):
+            for key in compactItem[4]:
+                item.pop(key, None)
+        batch.append(item)
+    return batch
+
+
+def getUplinkStats():
+    with uplinkLock:
+        stats = dict(uplinkStats)
+        stats['pendingItems'] = len(pendingItems)
+        stats['pendingBytes'] = pendingBytes
+    with mqttLock:
+        stats['mqttInFlight'] = len(mqttInFlight)
+    return stats
+
+
+###########################   MQTT transport
+
+# What a batch published by mqtt returns in place of an http response
+class mqttPublishedObject(object):
+    status_code = 200
+    content = ""
+
+
+# Was the response of eg. sendIotDataNow accepted by the server. A batch published by mqtt
+# has not been yet, so this is judged by whether the broker has acknowledged any batch
+def isAcceptedByServer(r):
+    if(isinstance(r, mqttPublishedObject)):
+        with uplinkLock:
+            return uplinkStats['mqttAcked'] > 0
+    return r.status_code == 200
+
+
+# The agent hands over its client for the broker of the Davra server, and reports when it connects
+# and disconnects. Acknowledgements are taken from the client's on_publish callback
+def setMqttClient(client):
+    global mqttClient
+    with mqttLock:
+        mqttClient = client
+    client.on_publish = onMqttPublish
+    loadMqttInFlight()
+
+
+# Save the batches in flight. Debounced, so a burst of publishes and acknowledgements is one write
+def saveMqttInFlight():
+    with mqttLock:
+        batches = [batch for (batch, publishTime) in mqttInFlight.values()]
+    tmpFile = mqttInFlightFile + '.tmp'
+    with open(tmpFile, 'w') as outfile:
+        json.dump(batches, outfile)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.rename(tmpFile, mqttInFlightFile)
+
+mqttInFlightSave = comDavra.DebouncedCall('davra-uplink-inflight-save', saveMqttInFlight, lambda: 1)
+atexit.register(mqttInFlightSave.flush)
+
+
+# Queue again the batches which were in flight when the agent last stopped
+def loadMqttInFlight():
+    if(os.path.isfile(mqttInFlightFile) is False):
+        return
+    try:
+        with open(mqttInFlightFile) as data_file:
+            batches = json.load(data_file)
+    except ValueError:
+        batches = []
+    os.remove(mqttInFlightFile)
+    for batch in batches:
+        queueIotData(batch)
+    if(len(batches) > 0):
+        comDavra.log('Uplink queued ' + str(len(batches)) + ' mqtt batches which were in flight when the agent stopped')
+
+
+def setMqttConnected(isConnected):
+    global mqttConnected
+    with mqttLock:
+        mqttConnected = isConnected
+    if(isConnected is False):
+        # Batches in flight may never be acknowledged now, so send them by http straight away
+        uplinkWakeup.set()
+
+
+# Is the client connected to the broker now. paho before 1.5 has no is_connected
+def isMqttClientConnected(client):
+    if(hasattr(client, 'is_connected')):
+        return client.is_connected()
+    return client._state == mqtt.mqtt_cs_connected and client._sock is not None
+
+
+# Remove a message from the outgoing queue of the client, as its batch is going by http instead.
+# Otherwise paho keeps a message it could not send, or which is unacknowledged, and publishes it
+# again on reconnect. paho has no call for this, so its queue is changed directly.
+# Not to be called with mqttLock held, as paho calls onMqttPublish holding the same mutex
+def discardMqttMessage(client, mid):
+    with client._out_message_mutex:
+        message = client._out_messages.pop(mid, None)
+        if(message is not None and message.state == mqtt.mqtt_ms_wait_for_puback):
+            client._inflight_messages = max(client._inflight_messages - 1, 0)
+
+
+def getMqttTopic():
+    return comDavra.conf.get('uplinkMqttTopic', 'devices/' + comDavra.conf['UUID'] + '/iotdata')
+
+
+# Publish a batch with QoS 1. Returns None if it cannot be published now, so should go by http
+def publishBatch(batch):
+    startTime = time.time()
+    with mqttLock:
+        if(mqttClient is None or mqttConnected is False):
+            return None
+        if(len(mqttInFlight) >= int(comDavra.conf.get('uplinkMqttInflight', 10))):
+            return None
+        client = mqttClient
+    # Not under mqttLock: paho calls onMqttPublish holding its own lock, which publish also takes
+    if(isMqttClientConnected(client) is False):
+        return None
+    messageInfo = client.publish(getMqttTopic(), json.dumps(batch), qos=1)
+    if(messageInfo.rc != 0):
+        comDavra.logWarning('Uplink could not publish batch by mqtt: ' + str(messageInfo.rc))
+        discardMqttMessage(client, messageInfo.mid)
+        return None
+    with mqttLock:
+        # The acknowledgement may have been handled already
+        ackTime = mqttEarlyAcks.pop(messageInfo.mid, None)
+        isAcked = ackTime is not None and ackTime >= startTime
+        if(isAcked is False):
+            mqttInFlight[messageInfo.mid] = (batch, time.time())
+    if(isAcked):
+        with uplinkLock:
+            uplinkStats['mqttAcked'] += 1
+            uplinkStats['itemsSent'] += len(batch)
+    else:
+        mqttInFlightSave.schedule()
+    publishLatencyMs = int((time.time() - startTime) * 1000)
+    with uplinkLock:
+        uplinkStats['flushes'] += 1
+        uplinkStats['mqttPublished'] += 1
+        uplinkStats['lastBatchSize'] = len(batch)
+        uplinkStats['maxBatchSize'] = max(uplinkStats['maxBatchSize'], len(batch))
+        uplinkStats['lastFlushLatencyMs'] = publishLatencyMs
+        uplinkStats['maxFlushLatencyMs'] = max(uplinkStats['maxFlushLatencyMs'], publishLatencyMs)
+    comDavra.log('Uplink published batch of ' + str(len(batch)) + ' items by mqtt as message ' + str(messageInfo.mid))
+    return mqttPublishedObject()
+
+
+# Called on the mqtt network thread when the broker acknowledges a message
+def onMqttPublish(client, userdata, mid):
+    now = time.time()
+    with mqttLock:
+        entry = mqttInFlight.pop(mid, None)
+        if(entry is None):
+            # Also called for the agent's other messages, so only recent acknowledgements are kept
+            if(len(mqttEarlyAcks) >= 100):
+                for earlyMid, ackTime in mqttEarlyAcks.items():
+                    if(now - ackTime > 60):
+                        del mqttEarlyAcks[earlyMid]
+            mqttEarlyAcks[mid] = now
+    if(entry is not None):
+        mqttInFlightSave.schedule()
+        with uplinkLock:
+            uplinkStats['mqttAcked'] += 1
+            uplinkStats['itemsSent'] += len(entry[0])
+
+
+# The batches which have waited too long for an acknowledgement, or were in flight when the
+# connection dropped. They are no longer tracked, so a late acknowledgement is ignored
+def takeUnacknowledgedBatches():
+    ackTimeout = float(comDavra.conf.get('uplinkMqttAckTimeout', 30))
+    now = time.time()
+    with mqttLock:
+        expired = [mid for mid, (batch, publishTime) in mqttInFlight.items() \
+            if mqttConnected is False or now - publishTime >= ackTimeout]
+        batches = [mqttInFlight.pop(mid)[0] for mid in sorted(expired)]
+        client = mqttClient
+    for mid in expired:
+        discardMqttMessage(client, mid)
+    if(len(batches) > 0):
+        mqttInFlightSave.schedule()
+        with uplinkLock:
+            uplinkStats['mqttAckTimeouts'] += len(batches)
+        comDavra.logWarning('Uplink sending ' + str(len(batches)) + ' unacknowledged mqtt batches by http')
+    return batches
+
+
+# Call with uplinkLock held. When the oldest batch in flight is due to time out, or None
+def getNextAckDeadline():
+    with mqttLock:
+        if(len(mqttInFlight) == 0):
+            return None
+        if(mqttConnected is False):
+            return time.time()
+        return min([publishTime for (batch, publishTime) in mqttInFlight.values()]) \
+            + float(comDavra.conf.get('uplinkMqttAckTimeout', 30))
+
+
+# Background thread which sleeps until the oldest item is due or a batch fills up
+def runUplink():
+    while True:
+        with uplinkLock:
+            uplinkWakeup.clear()
+            if(len(pendingItems) == 0):
+                waitTime = None
+            elif(isBatchReady()):
+                waitTime = 0
+            else:
+                waitTime = pendingItems[0][2] + getBatchMaxDelay() - time.time()
+            # Also wake to resend a batch by http if its mqtt acknowledgement does not arrive
+            ackDeadline = getNextAckDeadline()
+            if(ackDeadline is not None):
+                waitTime = ackDeadline - time.time() if waitTime is None else min(waitTime, ackDeadline - time.time())
+        if(waitTime is not None and waitTime <= 0):
+            try:
+                for unacknowledgedBatch in takeUnacknowledgedBatches():
+                    sendBatchByHttp(unacknowledgedBatch)
+                flushUplink()
+            except Exception as e:
+                comDavra.logError('Uplink flush failed: ' + str(e))
+        else:
+            uplinkWakeup.wait(waitTime)
+
+
+def startUplink():
+    global uplinkThread
+    with uplinkLock:
+        if(uplinkThread is None):
+            uplinkThread = threading.Thread(target=runUplink, name='davra-uplink')
+            uplinkThread.daemon = True
+            uplinkThread.start()
+    return
+
+
+# Anything still pending is sent when the agent exits
+atexit.register(flushUplink)
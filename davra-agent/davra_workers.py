@@ -0,0 +1,130 @@
+# Davra Workers
+# Runs the functions which the agent enacts itself (eg. run a script, install an app) on a
+# bounded pool of worker threads, so several jobs can be in flight at once and a long install
+# does not hold up a quick diagnostic script.
+# Each capability may be limited in how many of it run at once. A limit of "exclusive" means
+# the function only starts when nothing else is running and nothing else starts until it finishes
+# (eg. rebooting the device). Functions are started in the order they were submitted, except
+# that one held back by its limit does not hold up those behind it, unless it is exclusive.
+# Tunable in config.json:
+#   workerPoolSize: most functions running at once (default 4)
+#   capabilityConcurrency: dict of capability name to its limit, a number or "exclusive".
+#     Merged over the defaults in defaultCapabilityConcurrency. Unlisted capabilities are
+#     limited only by the pool size
+#
+import threading
+import time
+import davra_lib as comDavra
+
+
+defaultCapabilityConcurrency = {
+    'agent-action-rebootDevice': 'exclusive',
+    'agent-action-pushAppWithInstaller': 1,
+    'agent-action-updateAgentConfig': 1
+}
+
+workersCondition = threading.Condition(threading.Lock())
+queuedWork = [] # Dicts of capabilityName, functionUuid, function, queuedTime in submission order
+runningWork = {} # functionUuid -> capabilityName of the functions being run now
+workerThreads = []
+workerStats = {"started": 0, "finished": 0, "failed": 0, "maxQueued": 0, "maxRunning": 0, \
+    "lastQueuedMs": 0, "maxQueuedMs": 0}
+
+
+def getPoolSize():
+    return max(1, int(comDavra.conf.get('workerPoolSize', 4)))
+
+
+def getCapabilityConcurrency(capabilityName):
+    concurrency = dict(defaultCapabilityConcurrency)
+    concurrency.update(comDavra.conf.get('capabilityConcurrency', {}))
+    return concurrency.get(capabilityName)
+
+
+# Run functionToRun on a worker thread when the pool and the capability's limit allow.
+# onStart, if given, is called on the worker thread just before functionToRun.
+# onFailure(error), if given, is called if functionToRun raises, eg. to mark the function failed
+def submitWork(capabilityName, functionUuid, functionToRun, onStart = None, onFailure = None):
+    with workersCondition:
+        queuedWork.append({"capabilityName": capabilityName, "functionUuid": functionUuid, \
+            "function": functionToRun, "onStart": onStart, "onFailure": onFailure, "queuedTime": time.time()})
+        workerStats['maxQueued'] = max(workerStats['maxQueued'], len(queuedWork))
+        # Start another worker if there is more work than workers and the pool has room
+        if(len(workerThreads) < getPoolSize() and len(workerThreads) < len(runningWork) + len(queuedWork)):
+            workerThread = threading.Thread(target=runWorker, name='davra-worker-' + str(len(workerThreads)))
+            workerThread.daemon = True
+            workerThreads.append(workerThread)
+            workerThread.start()
+        workersCondition.notify_all()
+    comDavra.log('Workers: queued ' + capabilityName + ' ' + str(functionUuid))
+
+
+# Call with workersCondition held. Can a function of this capability start now
+def canStart(capabilityName):
+    if(len(runningWork) >= getPoolSize()):
+        return False
+    # Nothing runs alongside an exclusive function
+    if('exclusive' in [getCapabilityConcurrency(name) for name in runningWork.values()]):
+        return False
+    limit = getCapabilityConcurrency(capabilityName)
+    if(limit == 'exclusive'):
+        return len(runningWork) == 0
+    if(limit is not None):
+        return runningWork.values().count(capabilityName) < int(limit)
+    return True
+
+
+# Call with workersCondition held. Take the first queued work which can start now, or None
+def takeStartableWork():
+    for index, work in enumerate(queuedWork):
+        if(canStart(work["capabilityName"])):
+            return queuedWork.pop(index)
+        # An exclusive function waits for the others to finish, so do not start more behind it
+        if(getCapabilityConcurrency(work["capabilityName"]) == 'exclusive'):
+            return None
+    return None
+
+
+def runWorker():
+    while True:
+        with workersCondition:
+            work = takeStartableWork()
+            while(work is None):
+                # No timeout so the thread truly sleeps until work is submitted or finishes
+                workersCondition.wait()
+                work = takeStartableWork()
+            runningWork[work["functionUuid"]] = work["capabilityName"]
+            queuedMs = int((time.time() - work["queuedTime"]) * 1000)
+            workerStats['started'] += 1
+            workerStats['lastQueuedMs'] = queuedMs
+            workerStats['maxQueuedMs'] = max(workerStats['maxQueuedMs'], queuedMs)
+            workerStats['maxRunning'] = max(workerStats['maxRunning'], len(runningWork))
+        isFailed = False
+        try:
+            if(work["onStart"] is not None):
+                work["onStart"]()
+            work["function"]()
+        except Exception as e:
+            isFailed = True
+            comDavra.logError('Workers: ' + work["capabilityName"] + ' failed: ' + str(e))
+            if(work["onFailure"] is not None):
+                try:
+                    work["onFailure"](e)
+                except Exception as e:
+                    comDavra.logError('Workers: ' + work["capabilityName"] + ' failure handling failed: ' + str(e))
+        with workersCondition:
+            runningWork.pop(work["functionUuid"], None)
+            workerStats['finished'] += 1
+            if(isFailed):
+                workerStats['failed'] += 1
+            # Finishing may let queued work start, eg. behind a concurrency limit
+            workersCondition.notify_all()
+
+
+def getWorkerStats():
+    with workersCondition:
+        stats = dict(workerStats)
+        stats['queued'] = len(queuedWork)
+        stats['running'] = len(runningWork)
+        stats['threads'] = len(workerThreads)
+    return stats
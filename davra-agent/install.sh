@@ -15,7 +15,6 @@ if [[ ! -d "${installationDir}" ]];
 then
 	echo "Creating installation directory at ${installationDir}"
 	mkdir -p "${installationDir}"
-    mkdir -p "${installationDir}/currentJob"
 else 
     echo "This is an upgrade."
     installOrUpgrade="upgrade"
@@ -24,6 +23,8 @@ fi
 # echo "Setting file permissons ..."
 cp -r . "${installationDir}"
 chmod -R 755 "${installationDir}"
+# The service runs the agent through this link, which self-updates point at newer releases
+ln -sfn "${installationDir}" "${installationDir}/current"
 cd "${installationDir}"
 
 logFile="/var/log/davra_agent.log"